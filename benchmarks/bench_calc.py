@@ -0,0 +1,163 @@
+#!/usr/bin/env python3
+"""
+Benchmark de /calc: caché de compilación, rangos con numpy y aislamiento del loop
+
+Mide en el propio proceso:
+
+* compilación: validar y compilar una expresión (AST con lista blanca)
+  frente a recuperarla de la caché LRU,
+* rangos: ``sin(x)*cos(x) for x in 0..N`` elemento a elemento frente a
+  vectorizado con numpy (si está instalado),
+* aislamiento: ``--light`` expresiones ligeras concurrentes con
+  ``--heavy`` rangos costosos, evaluando todo en el event loop frente a
+  Calculator (rangos en el pool de procesos). Se muestra el peor retraso
+  del loop y el p99 de latencia de las expresiones ligeras,
+* hostiles: expresiones que se evalúan en el event loop pero construirían
+  enteros enormes (``round(7, -10**7)``); deben rechazarse al instante.
+
+Uso:
+    python benchmarks/bench_calc.py [--points 100000] [--light 2000] [--heavy 4] [--no-numpy]
+"""
+
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import bot  # noqa: E402
+
+EXPRESSIONS = ['2*(3+4)', 'sqrt(2)^10', '(1+2.5)*3/7 - 4 % 3', 'sin(pi/4)*cos(pi/3) + log10(1000)']
+RANGE_EXPRESSION = 'sin(x)*cos(x) + sqrt(abs(x))'
+HOSTILE_EXPRESSIONS = ['round(7, -10000000)', 'round(1, -100000000)', 'round(2.5, 10000000)',
+                       'round(7, -1000000)']
+
+
+def bench_compile(repeat=20000):
+    print(f"{'expresión':<36} | {'sin caché':>10} | {'con caché':>10}")
+    print('-' * 64)
+    for expression in EXPRESSIONS:
+        start = time.perf_counter()
+        for _ in range(repeat // 10):
+            bot.compile_expression.__wrapped__(expression)
+        cold = (time.perf_counter() - start) / (repeat // 10)
+        bot.compile_expression(expression)
+        start = time.perf_counter()
+        for _ in range(repeat):
+            bot.compile_expression(expression)
+        warm = (time.perf_counter() - start) / repeat
+        print(f"{expression:<36} | {cold * 1e6:>7.1f} µs | {warm * 1e6:>7.2f} µs")
+
+
+def bench_range(points):
+    print(f"\n{'rango (' + str(points) + ' puntos)':<36} | {'tiempo':>10}")
+    print('-' * 50)
+    numpy = bot._load_numpy()
+    modes = [('elemento a elemento', False)] + ([('numpy', numpy)] if numpy else [])
+    previous = bot._numpy
+    for name, module in modes:
+        bot._numpy = module
+        start = time.perf_counter()
+        bot.calc_range(RANGE_EXPRESSION, 0.0, 1.0, points)
+        print(f"{name:<36} | {(time.perf_counter() - start) * 1000:>7.1f} ms")
+    bot._numpy = previous
+
+
+async def bench_hostile():
+    """Cada expresión hostil debe fallar con CalcError sin bloquear el loop"""
+    print(f"\n{'expresión hostil':<36} | {'tiempo':>10} | resultado")
+    print('-' * 72)
+    calculator = bot.Calculator(workers=1, timeout=60)
+    for expression in HOSTILE_EXPRESSIONS:
+        start = time.perf_counter()
+        try:
+            result = await calculator.evaluate(expression)
+        except bot.CalcError as e:
+            result = f'rechazada: {e}'
+        elapsed = time.perf_counter() - start
+        print(f"{expression:<36} | {elapsed * 1000:>7.2f} ms | {result}")
+        if elapsed > 0.1:
+            raise SystemExit(f"{expression} bloqueó el loop {elapsed:.2f} s")
+    calculator.shutdown()
+
+
+async def isolation(strategy, args):
+    """Peor retraso del loop y p99 de las ligeras con ``strategy`` ("loop" o "pool")"""
+    calculator = bot.Calculator(workers=args.workers, timeout=60)
+    # El pool se arranca antes de medir (en el bot lo hace la primera expresión costosa)
+    if strategy == 'pool':
+        await calculator.evaluate('2^2')
+    lags = []
+    stop = asyncio.Event()
+
+    async def monitor():
+        loop = asyncio.get_running_loop()
+        while not stop.is_set():
+            expected = loop.time() + 0.005
+            await asyncio.sleep(0.005)
+            lags.append(loop.time() - expected)
+
+    async def light(i):
+        # Latencia desde la llegada prevista: incluye la espera si el loop estaba ocupado
+        arrival = base + i * args.spacing
+        await asyncio.sleep(arrival - time.perf_counter())
+        await calculator.evaluate(EXPRESSIONS[i % len(EXPRESSIONS)].replace('^', '*'))
+        return time.perf_counter() - arrival
+
+    async def heavy(i):
+        await asyncio.sleep(base + i * args.light * args.spacing / args.heavy - time.perf_counter())
+        expression = f'{RANGE_EXPRESSION} for x in 0..{args.points - 1}'
+        if strategy == 'pool':
+            await calculator.evaluate(expression)
+        else:
+            bot.calc_range(RANGE_EXPRESSION, 0.0, 1.0, args.points)
+
+    # Margen para crear todas las tareas antes de la primera llegada
+    base = time.perf_counter() + 0.1
+    monitor_task = asyncio.create_task(monitor())
+    results = await asyncio.gather(*(light(i) for i in range(args.light)),
+                                   *(heavy(i) for i in range(args.heavy)))
+    elapsed = time.perf_counter() - base
+    stop.set()
+    await monitor_task
+    calculator.shutdown()
+    latencies = sorted(results[:args.light])
+    p99 = latencies[int(len(latencies) * 0.99) - 1]
+    return elapsed, max(lags), p99, statistics.median(latencies)
+
+
+async def bench_isolation(args):
+    print(f"\n{args.light} ligeras + {args.heavy} rangos de {args.points} puntos "
+          f"(numpy: {'sí' if bot._load_numpy() else 'no'})")
+    print(f"{'estrategia':<20} | {'total':>8} | {'lag máx':>9} | {'ligeras p50':>11} | {'ligeras p99':>11}")
+    print('-' * 72)
+    for strategy, label in (('loop', 'todo en el loop'), ('pool', 'Calculator')):
+        elapsed, lag, p99, p50 = await isolation(strategy, args)
+        print(f"{label:<20} | {elapsed:>6.2f} s | {lag * 1000:>6.1f} ms | "
+              f"{p50 * 1000:>8.2f} ms | {p99 * 1000:>8.2f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--points', type=int, default=100_000, help='puntos de cada rango costoso')
+    parser.add_argument('--light', type=int, default=2000, help='expresiones ligeras')
+    parser.add_argument('--heavy', type=int, default=4, help='rangos costosos')
+    parser.add_argument('--spacing', type=float, default=0.001, help='separación entre ligeras (s)')
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--no-numpy', action='store_true', help='evaluar los rangos sin numpy')
+    args = parser.parse_args()
+    if args.no_numpy:
+        # Los procesos de cálculo heredan el entorno y vuelven a leer CALC_USE_NUMPY
+        os.environ['CALC_USE_NUMPY'] = 'false'
+        bot._numpy = False
+    bench_compile()
+    bench_range(args.points)
+    asyncio.run(bench_hostile())
+    asyncio.run(bench_isolation(args))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+"""
+Benchmark de botones inline: llamadas a la Bot API por pulsación
+
+Arranca FakeTelegramAPI y bot.py (``--bot``, por defecto el del repo) en
+modo polling. Envía /start y un mensaje de texto para obtener los teclados
+del bot, y después pulsa ``--presses`` veces cada botón con el
+callback_data real de esos teclados. Para cada botón cuenta las llamadas a
+la API que provoca una pulsación (sin getUpdates), separando los mensajes
+nuevos en el chat (sendMessage) de las ediciones y respuestas.
+
+Para comparar con otra versión del bot:
+    git show <rev>:bot.py > /tmp/bot_old.py
+    python benchmarks/bench_callbacks.py --bot /tmp/bot_old.py
+
+Uso:
+    python benchmarks/bench_callbacks.py [--presses 20]
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import shutil
+import signal
+import sys
+import tempfile
+import time
+from collections import Counter
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fake_telegram import FakeTelegramAPI, make_callback_update, make_message_update  # noqa: E402
+
+BOT_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'bot.py')
+USER_ID = 4242
+
+
+def api_calls(api, since):
+    return Counter(method for method, _, _ in api.calls[since:] if method != 'getUpdates')
+
+
+async def settle(api, since, quiet=0.2, timeout=10):
+    """Esperar a la primera llamada del bot desde ``since`` y a que deje de llamar ``quiet`` segundos"""
+    deadline = time.monotonic() + timeout
+    while not api_calls(api, since) and time.monotonic() < deadline:
+        await asyncio.sleep(0.01)
+    count = -1
+    while time.monotonic() < deadline:
+        current = sum(api_calls(api, since).values())
+        if current == count:
+            return
+        count = current
+        await asyncio.sleep(quiet)
+
+
+def keyboard_buttons(params):
+    """Botones (texto, callback_data) del reply_markup de una llamada"""
+    markup = params.get('reply_markup')
+    if isinstance(markup, str):
+        markup = json.loads(markup)
+    if not markup:
+        return []
+    return [(button['text'], button['callback_data'])
+            for row in markup.get('inline_keyboard', []) for button in row if 'callback_data' in button]
+
+
+async def run(args):
+    api = FakeTelegramAPI()
+    base_url = await api.start(port=args.api_port)
+    workdir = tempfile.mkdtemp(prefix='bench_callbacks_')
+    env = dict(
+        os.environ,
+        TELEGRAM_BOT_TOKEN='123456:CALLBACKS',
+        TELEGRAM_API_BASE_URL=base_url,
+        BOT_MODE='polling',
+        THROTTLE_USER_LIMIT='100000',
+        THROTTLE_CHAT_LIMIT='100000',
+    )
+    bot = await asyncio.create_subprocess_exec(
+        sys.executable, os.path.abspath(args.bot), cwd=workdir, env=env,
+        stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.DEVNULL,
+    )
+    try:
+        deadline = time.monotonic() + 30
+        while not api.calls_by_method['getUpdates']:
+            if time.monotonic() > deadline:
+                raise RuntimeError("El bot no arrancó a tiempo")
+            await asyncio.sleep(0.1)
+
+        # Teclados que muestra el bot: el de /start y el de respuesta rápida
+        buttons = {}
+        for text in ('/start', 'un mensaje cualquiera'):
+            since = len(api.calls)
+            api.updates.put_nowait(make_message_update(USER_ID, text))
+            await settle(api, since)
+            for method, params, _ in api.calls[since:]:
+                if method == 'sendMessage':
+                    for label, data in keyboard_buttons(params):
+                        buttons.setdefault(data, label)
+
+        print(f"{'botón':<18} | {'callback_data':<14} | {'llamadas':>8} | {'mensajes nuevos':>15} | métodos")
+        print('-' * 95)
+        totals = Counter()
+        for data, label in buttons.items():
+            since = len(api.calls)
+            for _ in range(args.presses):
+                press = len(api.calls)
+                api.updates.put_nowait(make_callback_update(USER_ID, data))
+                await settle(api, press)
+            calls = api_calls(api, since)
+            totals.update(calls)
+            per_press = sum(calls.values()) / args.presses
+            new_messages = calls['sendMessage'] / args.presses
+            methods = ', '.join(f"{method} {count / args.presses:g}" for method, count in sorted(calls.items()))
+            print(f"{label:<18} | {data:<14} | {per_press:>8.2f} | {new_messages:>15.2f} | {methods}")
+        presses = args.presses * len(buttons)
+        print('-' * 95)
+        print(f"{'media':<18} | {'':<14} | {sum(totals.values()) / presses:>8.2f} | "
+              f"{totals['sendMessage'] / presses:>15.2f} |")
+    finally:
+        bot.send_signal(signal.SIGTERM)
+        try:
+            await asyncio.wait_for(bot.wait(), timeout=30)
+        except asyncio.TimeoutError:
+            bot.kill()
+        await api.stop()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--bot', default=BOT_PATH, help='bot.py a medir')
+    parser.add_argument('--presses', type=int, default=20, help='pulsaciones por botón')
+    parser.add_argument('--api-port', type=int, default=8081)
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+"""
+Benchmark del modo inline: latencia por pulsación con y sin caché
+
+Simula ``--users`` usuarios que escriben consultas inline carácter a
+carácter (cada pulsación es una consulta nueva, como las envía Telegram) y
+mide en el propio proceso lo que tarda InlineQueryEngine en preparar los
+resultados:
+
+* sin caché: capacidad 0, cada pulsación se calcula desde cero,
+* primer usuario: caché vacía, el filtrado de ayuda parte del prefijo
+  anterior ya calculado,
+* resto de usuarios: las mismas consultas, servidas del LRU.
+
+También muestra cuántas respuestas puede repetir Telegram por su cuenta
+(``cache_time`` medio y proporción de respuestas no personales).
+
+Uso:
+    python benchmarks/bench_inline.py [--users 200] [--rounds 5]
+"""
+
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import time
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import bot  # noqa: E402
+
+QUERIES = ['hora', 'hora buenos aires', 'hora tokio', 'stats', 'ayuda calculadora', 'help tiempo',
+           'echo hola a todos', 'weather', 'que tal estás']
+
+
+class FakeAnalytics:
+    loaded = True
+
+    async def get_totals_async(self):
+        return 1200, 45000, 9000
+
+
+def keystrokes(query):
+    return [query[:end] for end in range(1, len(query) + 1)]
+
+
+def make_context(bot_data, user_data):
+    return SimpleNamespace(bot_data=bot_data, user_data=user_data)
+
+
+async def type_queries(engine, contexts):
+    """Latencias (s) de cada pulsación de cada usuario y respuestas obtenidas"""
+    latencies, answers = [], []
+    for context in contexts:
+        for query in QUERIES:
+            for text in keystrokes(query):
+                start = time.perf_counter()
+                answer = await engine.answer(context, text)
+                latencies.append(time.perf_counter() - start)
+                answers.append(answer)
+    return latencies, answers
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+async def run(args):
+    bot_data = {'timezones': bot.TimeZoneService(), 'analytics': FakeAnalytics()}
+    bot_data['timezones'].lookup('Madrid')
+    personal = int(args.users * args.personal)
+    contexts = [make_context(bot_data, {'timezone': 'America/Argentina/Buenos_Aires'} if i < personal else {})
+                for i in range(args.users)]
+    strokes = sum(len(query) for query in QUERIES)
+    print(f"{len(QUERIES)} consultas ({strokes} pulsaciones) por usuario, {args.users} usuarios, "
+          f"mediana de {args.rounds} rondas")
+    print(f"{'caso':<22} | {'p50':>9} | {'p99':>9} | {'máx':>9}")
+    print('-' * 58)
+
+    cases = {'sin caché': [], 'primer usuario': [], 'resto de usuarios': []}
+    answers = []
+    for _ in range(args.rounds):
+        latencies, _ = await type_queries(bot.InlineQueryEngine(capacity=0), contexts)
+        cases['sin caché'].append(latencies)
+        engine = bot.InlineQueryEngine()
+        first, _ = await type_queries(engine, contexts[-1:])
+        rest, answers = await type_queries(engine, contexts[:-1])
+        cases['primer usuario'].append(first)
+        cases['resto de usuarios'].append(rest)
+    for name, rounds in cases.items():
+        p50 = statistics.median(percentile(latencies, 0.5) for latencies in rounds)
+        p99 = statistics.median(percentile(latencies, 0.99) for latencies in rounds)
+        worst = statistics.median(max(latencies) for latencies in rounds)
+        print(f"{name:<22} | {p50 * 1e6:>6.1f} µs | {p99 * 1e6:>6.1f} µs | {worst * 1e6:>6.1f} µs")
+
+    print(f"\ncaché del servidor: {engine.metrics()}")
+    shared = [cache_time for _, cache_time, is_personal in answers if not is_personal]
+    print(f"respuestas que Telegram puede compartir entre usuarios: {len(shared) / len(answers):.0%} "
+          f"(cache_time medio {statistics.mean(shared):.0f} s)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--rounds', type=int, default=5)
+    parser.add_argument('--personal', type=float, default=0.2,
+                        help='proporción de usuarios con zona horaria propia')
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == '__main__':
+    main()
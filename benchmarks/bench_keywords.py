@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+"""
+Micro-benchmark de respuestas automáticas de handle_message
+
+Compara el bucle original (reconstruir el dict de respuestas con dos
+``datetime.now().strftime`` por mensaje y probar ``keyword in texto`` una
+a una) con KeywordMatcher, con las 7 reglas por defecto y con cientos de
+palabras clave sintéticas.
+
+Uso:
+    python benchmarks/bench_keywords.py [--keywords 7 100 500] [--messages 20000]
+"""
+
+import argparse
+import os
+import random
+import string
+import sys
+import time
+from datetime import datetime
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import bot  # noqa: E402
+
+
+def make_rules(count, rng):
+    """Reglas por defecto más palabras clave aleatorias hasta ``count``"""
+    rules = list(bot.DEFAULT_KEYWORD_RULES)
+    while len(rules) < count:
+        word = ''.join(rng.choice(string.ascii_lowercase) for _ in range(rng.randint(5, 10)))
+        rules.append({'keywords': [word], 'reply': f"Respuesta para {word}, {{first_name}}"})
+    return rules
+
+
+def original_loop(rules, message, user):
+    """Bucle original de handle_message, generalizado a ``rules``"""
+    message_lower = message.lower()
+    now_date = datetime.now().strftime('%d/%m/%Y')
+    now_time = datetime.now().strftime('%H:%M')
+    responses = {
+        rule['keywords'][0]: rule['reply'].format(
+            first_name=user.first_name, username=user.username, date=now_date, time=now_time
+        )
+        for rule in rules
+    }
+    for keyword, response in responses.items():
+        if keyword in message_lower:
+            return response
+    return None
+
+
+def make_messages(count, rng):
+    words = ['que', 'tal', 'el', 'dia', 'de', 'hoy', 'me', 'gusta', 'mucho', 'esto',
+             'hola', 'gracias', 'hora', 'nada', 'interesante', 'pregunta', 'bot']
+    return [' '.join(rng.choice(words) for _ in range(rng.randint(3, 15))) for _ in range(count)]
+
+
+def bench(func, messages):
+    start = time.perf_counter()
+    for message in messages:
+        func(message)
+    return (time.perf_counter() - start) / len(messages)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--keywords', type=int, nargs='+', default=[7, 100, 500])
+    parser.add_argument('--messages', type=int, default=20_000)
+    args = parser.parse_args()
+
+    rng = random.Random(42)
+    user = SimpleNamespace(first_name='Ana', username='ana')
+    messages = make_messages(args.messages, rng)
+
+    print(f"{'keywords':>9} | {'bucle original':>15} | {'KeywordMatcher':>15} | {'speedup':>8}")
+    print('-' * 57)
+    for count in args.keywords:
+        rules = make_rules(count, rng)
+        matcher = bot.KeywordMatcher(rules)
+        for message in messages[:1000]:
+            assert matcher.reply_for(message, user) == original_loop(rules, message, user), message
+        t_old = bench(lambda m: original_loop(rules, m, user), messages)
+        t_new = bench(lambda m: matcher.reply_for(m, user), messages)
+        print(f"{count:>9} | {t_old * 1e6:>12.2f} µs | {t_new * 1e6:>12.2f} µs | {t_old / t_new:>7.1f}x")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+"""
+Benchmark de memoria: bytes por usuario de las estadísticas en memoria
+
+Compara un ``Dict[int, UserStats]`` (dataclass con ``__dict__``, dos
+cadenas y un ``datetime`` por usuario) con la tabla columnar UserTable.
+Mide con tracemalloc la memoria asignada al construir cada estructura.
+
+Uso:
+    python benchmarks/bench_memory.py [--sizes 10000 100000 1000000]
+"""
+
+import argparse
+import os
+import random
+import sys
+import tracemalloc
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import bot  # noqa: E402
+
+FIRST_NAMES = ['Ana', 'Luis', 'María', 'Carlos', 'Lucía', 'Javier', 'Sofía', 'Pablo']
+
+
+def generate(size):
+    """Filas sintéticas; se generan fuera de la medición"""
+    rng = random.Random(size)
+    base = datetime(2024, 1, 1)
+    rows = []
+    for i in range(size):
+        username = f'user{i}' if rng.random() < 0.7 else 'Sin username'
+        rows.append((
+            10_000_000 + i,
+            username,
+            rng.choice(FIRST_NAMES),
+            rng.randint(0, 500),
+            rng.randint(0, 100),
+            base + timedelta(seconds=rng.randint(0, 10_000_000)),
+        ))
+    return rows
+
+
+def build_dict(rows):
+    return {
+        user_id: bot.UserStats(
+            user_id=user_id,
+            username=''.join(username),  # cadena nueva, como al cargar de JSON
+            first_name=''.join(first_name),
+            message_count=message_count,
+            command_count=command_count,
+            last_seen=last_seen,
+        )
+        for user_id, username, first_name, message_count, command_count, last_seen in rows
+    }
+
+
+def build_table(rows):
+    table = bot.UserTable()
+    for user_id, username, first_name, message_count, command_count, last_seen in rows:
+        table.add(user_id, ''.join(username), ''.join(first_name),
+                  message_count, command_count, last_seen.timestamp())
+    return table
+
+
+def measure(builder, rows):
+    tracemalloc.start()
+    result = builder(rows)
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del result
+    return current, peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10_000, 100_000, 1_000_000])
+    args = parser.parse_args()
+
+    print(f"{'usuarios':>10} | {'dict UserStats':>16} | {'UserTable':>12} | {'ahorro':>7}")
+    print('-' * 56)
+    for size in args.sizes:
+        rows = generate(size)
+        before, _ = measure(build_dict, rows)
+        after, _ = measure(build_table, rows)
+        print(f"{size:>10} | {before / size:>10.1f} B/usr | {after / size:>6.1f} B/usr | "
+              f"{1 - after / before:>6.0%}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+"""
+Benchmark del limitador de envíos contra una Bot API falsa
+
+Envía ``--messages`` mensajes repartidos en ``--chats`` chats a la vez a
+través de un ExtBot con TokenBucketRateLimiter. La API falsa responde 429
+cada ``--flood-every`` envíos para ejercitar los reintentos. Comprueba que
+no se supera el límite global en ninguna ventana de 1 s e informa de los
+percentiles de latencia del limitador. También comprueba que los mensajes
+de cada chat llegan en el orden en que se enviaron (los ``message_id`` de
+la API falsa crecen en el orden en que acepta los envíos).
+
+Uso:
+    python benchmarks/bench_outbound.py [--messages 300] [--chats 100] [--flood-every 50]
+"""
+
+import argparse
+import asyncio
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from telegram.ext import ExtBot  # noqa: E402
+from telegram.request import HTTPXRequest  # noqa: E402
+
+import bot  # noqa: E402
+from fake_telegram import FakeTelegramAPI  # noqa: E402
+
+
+def max_in_window(times, window=1.0):
+    """Máximo de envíos en cualquier ventana de ``window`` segundos"""
+    times = sorted(times)
+    best = start = 0
+    for end, t in enumerate(times):
+        while t - times[start] > window:
+            start += 1
+        best = max(best, end - start + 1)
+    return best
+
+
+async def run(args):
+    api = FakeTelegramAPI(flood_every=args.flood_every, retry_after=1)
+    base_url = await api.start(port=args.api_port)
+    limiter = bot.TokenBucketRateLimiter()
+    ext_bot = ExtBot(
+        token='123456:BENCHMARK',
+        base_url=base_url,
+        rate_limiter=limiter,
+        request=HTTPXRequest(connection_pool_size=bot.OUTBOUND_POOL_SIZE),
+    )
+    async with ext_bot:
+        start = time.perf_counter()
+        messages = await asyncio.gather(*(
+            ext_bot.send_message(chat_id=1000 + i % args.chats, text=f'mensaje {i}')
+            for i in range(args.messages)
+        ))
+        elapsed = time.perf_counter() - start
+    await api.stop()
+
+    send_times = [t for method, _, t in api.calls if method == 'sendMessage']
+    ids_by_chat = {}
+    for message in messages:
+        ids_by_chat.setdefault(message.chat_id, []).append(message.message_id)
+    unordered = sum(ids != sorted(ids) for ids in ids_by_chat.values())
+    expected = args.messages / bot.OUTBOUND_GLOBAL_RATE
+    print(f"mensajes:               {args.messages} en {args.chats} chats")
+    print(f"tiempo total:           {elapsed:.2f} s (mínimo teórico a "
+          f"{bot.OUTBOUND_GLOBAL_RATE:.0f} msg/s: {expected:.2f} s)")
+    print(f"máximo en 1 s:          {max_in_window(send_times)} llamadas (límite "
+          f"{bot.OUTBOUND_GLOBAL_RATE:.0f} + ráfaga de {bot.OUTBOUND_GLOBAL_BURST:.0f})")
+    print(f"llamadas a la API:      {len(send_times)} (429 simulados: "
+          f"{args.messages and len(send_times) - args.messages})")
+    print(f"chats fuera de orden:   {unordered} de {len(ids_by_chat)}")
+    print(f"métricas del limitador: {limiter.metrics()}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--messages', type=int, default=300)
+    parser.add_argument('--chats', type=int, default=100)
+    parser.add_argument('--flood-every', type=int, default=50)
+    parser.add_argument('--api-port', type=int, default=8082)
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == '__main__':
+    main()
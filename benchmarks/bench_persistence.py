@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+"""
+Benchmark de persistencia: volcado de SQLitePersistence frente a pickle
+
+Rellena ambas persistencias con ``--chats`` chats (chat_data y user_data
+pequeños, como los de un bot real) y mide el volcado tras modificar un
+``--changed`` % de ellos:
+
+* PicklePersistence con ``on_flush=True``: los cambios quedan en memoria y
+  ``flush()`` reescribe el fichero completo (su mejor caso).
+* PicklePersistence por defecto (``on_flush=False``): cada ``update_*``
+  reescribe el fichero completo; se mide una llamada y se multiplica.
+* SQLitePersistence: solo se escriben las filas modificadas, en un lote.
+
+Uso:
+    python benchmarks/bench_persistence.py [--chats 10000 100000] [--changed 1]
+"""
+
+import argparse
+import asyncio
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from telegram.ext import PicklePersistence
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import bot  # noqa: E402
+
+
+def chat_data(i, version=0):
+    return {'lang': 'es', 'count': i + version, 'history': [f'mensaje {i}-{n}' for n in range(5)]}
+
+
+def user_data(i, version=0):
+    return {'tz': 'Europe/Madrid', 'seen': i + version, 'name': f'Usuario{i}'}
+
+
+async def fill(persistence, chats):
+    for i in range(chats):
+        await persistence.update_chat_data(i, chat_data(i))
+        await persistence.update_user_data(i, user_data(i))
+
+
+async def change(persistence, changed):
+    for i in changed:
+        await persistence.update_chat_data(i, chat_data(i, 1))
+        await persistence.update_user_data(i, user_data(i, 1))
+
+
+async def bench_pickle(chats, changed):
+    persistence = PicklePersistence('bot_data.pickle', on_flush=True)
+    await fill(persistence, chats)
+    await persistence.flush()
+
+    await change(persistence, changed)
+    start = time.perf_counter()
+    await persistence.flush()
+    flush = time.perf_counter() - start
+
+    # Por defecto cada update_* vuelca el fichero completo
+    persistence = PicklePersistence('bot_data.pickle')
+    await persistence.get_chat_data()
+    await persistence.get_user_data()
+    start = time.perf_counter()
+    await persistence.update_chat_data(0, chat_data(0, 2))
+    per_key = time.perf_counter() - start
+    size = os.path.getsize('bot_data.pickle')
+    # Que SQLitePersistence no lo tome como fichero antiguo a migrar
+    os.remove('bot_data.pickle')
+    return flush, per_key * 2 * len(changed), size
+
+
+async def bench_sqlite(chats, changed):
+    persistence = bot.SQLitePersistence('bot_data.db')
+    await fill(persistence, chats)
+    await persistence._commit_task
+
+    rows = persistence.rows_written
+    await change(persistence, changed)
+    start = time.perf_counter()
+    await persistence._commit_task
+    flush = time.perf_counter() - start
+    assert persistence.rows_written - rows == 2 * len(changed)
+    await persistence.flush()
+    return flush, os.path.getsize('bot_data.db')
+
+
+async def run(args):
+    print(f"{'chats':>8} | {'cambios':>7} | {'pickle flush':>12} | {'pickle def.':>11} | "
+          f"{'sqlite':>9} | {'pickle':>8} | {'sqlite':>8}")
+    print('-' * 82)
+    for chats in args.chats:
+        changed = range(max(1, chats * args.changed // 100))
+        workdir = tempfile.mkdtemp(prefix='bench_persistence_')
+        cwd = os.getcwd()
+        os.chdir(workdir)
+        try:
+            pickle_flush, pickle_default, pickle_size = await bench_pickle(chats, changed)
+            sqlite_flush, sqlite_size = await bench_sqlite(chats, changed)
+        finally:
+            os.chdir(cwd)
+            shutil.rmtree(workdir)
+        print(f"{chats:>8} | {len(changed):>7} | {pickle_flush * 1000:>9.1f} ms | "
+              f"{pickle_default:>9.1f} s | {sqlite_flush * 1000:>6.1f} ms | "
+              f"{pickle_size / 1e6:>5.1f} MB | {sqlite_size / 1e6:>5.1f} MB")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--chats', type=int, nargs='+', default=[10_000, 100_000])
+    parser.add_argument('--changed', type=int, default=1, help='porcentaje de chats modificados')
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == '__main__':
+    main()
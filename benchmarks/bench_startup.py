@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+"""
+Benchmark de arranque: del inicio del proceso al primer update atendido
+
+Genera un histórico de ``--users`` usuarios en el backend de analytics
+(``--backend``), arranca FakeTelegramAPI con una latencia por llamada
+(``--api-latency``, para simular el RTT con Telegram) y lanza bot.py en
+modo polling con un /start ya encolado. Mide, desde que se lanza el
+proceso:
+
+* primera respuesta: el /start respondido,
+* estadísticas completas: primer /stats sin la marca de cifras
+  provisionales (histórico cargado).
+
+Repite ``--runs`` veces y muestra la mediana.
+
+Uso:
+    python benchmarks/bench_startup.py [--users 10000 200000] [--runs 3]
+"""
+
+import argparse
+import asyncio
+import os
+import shutil
+import signal
+import statistics
+import sys
+import tempfile
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+BOT_PATH = os.path.join(BENCH_DIR, '..', 'bot.py')
+sys.path.insert(0, BENCH_DIR)
+sys.path.insert(0, os.path.join(BENCH_DIR, '..'))
+
+import bot  # noqa: E402
+from fake_telegram import FakeTelegramAPI, make_message_update  # noqa: E402
+
+CHAT_ID = 42
+PROVISIONAL_MARK = 'provisionales'
+
+
+def generate_history(workdir, backend, users):
+    """Histórico sintético en el formato del backend elegido"""
+    base = time.time() - 86400
+    columns = (
+        list(range(10_000_000, 10_000_000 + users)),
+        [f'user{i}' for i in range(users)],
+        [f'Usuario{i}' for i in range(users)],
+        [i % 500 for i in range(users)],
+        [i % 50 for i in range(users)],
+        [base + i % 86400 for i in range(users)],
+    )
+    snapshot = {'users': columns, 'daily_stats': {}, 'log_seq': 0}
+    if backend == 'sqlite':
+        store = bot.SQLiteAnalyticsStore(os.path.join(workdir, 'stats.db'))
+        store.write_events([
+            {'u': u, 'n': n, 'f': f, 'm': m, 'c': c, 't': t, 's': 0}
+            for u, n, f, m, c, t in zip(*columns)
+        ])
+    else:
+        store = bot.JSONAnalyticsStore(os.path.join(workdir, 'stats.json'),
+                                       os.path.join(workdir, 'stats.log.jsonl'),
+                                       binary_path=os.path.join(workdir, 'stats.bin'))
+        store.compact(snapshot)
+    store.close()
+
+
+async def measure(args, history_dir):
+    api = FakeTelegramAPI(latency=args.api_latency)
+    base_url = await api.start(port=args.api_port)
+    workdir = tempfile.mkdtemp(prefix='bench_startup_')
+    for name in os.listdir(history_dir):
+        shutil.copy(os.path.join(history_dir, name), workdir)
+
+    env = dict(
+        os.environ,
+        TELEGRAM_BOT_TOKEN='123456:STARTUP',
+        TELEGRAM_API_BASE_URL=base_url,
+        BOT_MODE='polling',
+        ANALYTICS_BACKEND=args.backend,
+    )
+    replies = asyncio.Queue()
+    api.on_reply(lambda chat_id, when: replies.put_nowait(when))
+    api.updates.put_nowait(make_message_update(CHAT_ID, '/start'))
+
+    start = time.perf_counter()
+    process = await asyncio.create_subprocess_exec(
+        sys.executable, os.path.abspath(BOT_PATH), cwd=workdir, env=env,
+        stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.DEVNULL,
+    )
+    try:
+        first_reply = await asyncio.wait_for(replies.get(), timeout=args.timeout) - start
+
+        # /stats hasta que deja de mostrar cifras provisionales
+        while True:
+            sent = len(api.calls)
+            api.updates.put_nowait(make_message_update(CHAT_ID, '/stats'))
+            when = await asyncio.wait_for(replies.get(), timeout=args.timeout)
+            texts = [params.get('text', '') for method, params, _ in api.calls[sent:] if method == 'sendMessage']
+            if texts and PROVISIONAL_MARK not in texts[-1]:
+                stats_ready = when - start
+                break
+            await asyncio.sleep(args.poll)
+    finally:
+        process.send_signal(signal.SIGTERM)
+        try:
+            await asyncio.wait_for(process.wait(), timeout=60)
+        except asyncio.TimeoutError:
+            process.kill()
+        await api.stop()
+        shutil.rmtree(workdir, ignore_errors=True)
+    return first_reply, stats_ready
+
+
+async def run(args):
+    print(f"backend {args.backend}, latencia de la API {args.api_latency * 1000:.0f} ms, "
+          f"mediana de {args.runs} ejecuciones")
+    print(f"{'usuarios':>10} | {'primera respuesta':>17} | {'estadísticas completas':>22}")
+    print('-' * 57)
+    for users in args.users:
+        history_dir = tempfile.mkdtemp(prefix='bench_startup_history_')
+        try:
+            generate_history(history_dir, args.backend, users)
+            results = [await measure(args, history_dir) for _ in range(args.runs)]
+        finally:
+            shutil.rmtree(history_dir, ignore_errors=True)
+        first = statistics.median(r[0] for r in results)
+        ready = statistics.median(r[1] for r in results)
+        print(f"{users:>10} | {first * 1000:>14.0f} ms | {ready * 1000:>19.0f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--users', type=int, nargs='+', default=[10_000, 200_000])
+    parser.add_argument('--backend', choices=('json', 'sqlite'), default='json')
+    parser.add_argument('--runs', type=int, default=3)
+    parser.add_argument('--api-latency', type=float, default=0.05, help='retardo de la API falsa (s)')
+    parser.add_argument('--api-port', type=int, default=8081)
+    parser.add_argument('--poll', type=float, default=0.25, help='intervalo entre /stats de sondeo (s)')
+    parser.add_argument('--timeout', type=float, default=120)
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == '__main__':
+    main()
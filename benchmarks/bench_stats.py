@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+"""
+Benchmark de /stats: agregados incrementales frente a sumar y ordenar
+
+Compara el cálculo original de stats_command (dos sumas sobre todos los
+usuarios más un sort completo para el top 5) con ``get_totals`` y
+``get_top_users`` de AnalyticsMiddleware.
+
+Uso:
+    python benchmarks/bench_stats.py [--sizes 10000 100000 1000000]
+"""
+
+import argparse
+import os
+import random
+import sys
+import time
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import bot  # noqa: E402
+
+
+class MemoryStore(bot.AnalyticsStore):
+    """Backend vacío: el benchmark solo mide el trabajo en memoria"""
+
+    def load(self, progress=None):
+        return {}, {}, 0
+
+    def write_events(self, events):
+        pass
+
+
+def sum_and_sort(analytics):
+    """Cálculo original de stats_command"""
+    total_messages = sum(u.message_count for u in analytics.user_stats.values())
+    total_commands = sum(u.command_count for u in analytics.user_stats.values())
+    active_users = len(analytics.user_stats)
+    top_users = sorted(
+        analytics.user_stats.values(),
+        key=lambda x: x.message_count + x.command_count,
+        reverse=True
+    )[:5]
+    return active_users, total_messages, total_commands, top_users
+
+
+def incremental(analytics):
+    return (*analytics.get_totals(), analytics.get_top_users(5))
+
+
+def timeit(func, *args, repeat=5):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(*args)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def build(size):
+    analytics = bot.AnalyticsMiddleware(store=MemoryStore(), max_dirty=size + 1)
+    rng = random.Random(size)
+    users = [SimpleNamespace(id=i, username=f'user{i}', first_name=f'Nombre{i}') for i in range(size)]
+    for user in users:
+        for _ in range(rng.randint(1, 5)):
+            analytics.track_message(user)
+    return analytics
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10_000, 100_000, 1_000_000])
+    args = parser.parse_args()
+
+    print(f"{'usuarios':>10} | {'sum+sort':>12} | {'incremental':>12} | {'speedup':>9}")
+    print('-' * 52)
+    for size in args.sizes:
+        analytics = build(size)
+        old = sum_and_sort(analytics)
+        new = incremental(analytics)
+        assert old[:3] == new[:3], (old[:3], new[:3])
+        assert [u.message_count + u.command_count for u in old[3]] == \
+            [u.message_count + u.command_count for u in new[3]]
+
+        t_old = timeit(sum_and_sort, analytics)
+        t_new = timeit(incremental, analytics)
+        print(f"{size:>10} | {t_old * 1000:>9.2f} ms | {t_new * 1e6:>9.2f} µs | {t_old / t_new:>8.0f}x")
+
+
+if __name__ == '__main__':
+    main()
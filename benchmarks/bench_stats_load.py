@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+"""
+Benchmark de carga de estadísticas: snapshot JSON completo, incremental y binario
+
+Genera un snapshot de ``--sizes`` usuarios y mide, con tracemalloc, el
+tiempo y el pico de memoria de:
+
+* json.load: el cargador original (``json.load`` del fichero entero, un
+  UserStats con ``datetime.fromisoformat`` por usuario y UserTable al final),
+* incremental: JSONSnapshotReader por bloques, directo a UserTable (el
+  bot solo lo usa a partir de ``STATS_STREAM_MIN_BYTES``; por debajo carga
+  con ``json.load``, que es igual o más rápido),
+* binario: BinarySnapshot (``STATS_SNAPSHOT_FORMAT=binary``).
+
+La columna "tabla" es la memoria que ocupa el resultado; el pico por
+encima de ella es lo que cuesta la carga en sí. tracemalloc ralentiza
+todos los casos por igual; los tiempos sin él se miden aparte.
+
+Uso:
+    python benchmarks/bench_stats_load.py [--sizes 100000 1000000]
+"""
+
+import argparse
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+from array import array
+from datetime import datetime
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import bot  # noqa: E402
+
+FIRST_NAMES = ['Ana', 'Luis', 'María', 'Carlos', 'Lucía', 'Javier', 'Sofía', 'Pablo']
+
+
+def generate(size):
+    rng = random.Random(size)
+    base = time.time() - 90 * 86400
+    return {
+        'users': (
+            array('q', range(10_000_000, 10_000_000 + size)),
+            [f'user{i}' if rng.random() < 0.7 else 'Sin username' for i in range(size)],
+            [rng.choice(FIRST_NAMES) for _ in range(size)],
+            array('q', (rng.randint(0, 500) for _ in range(size))),
+            array('q', (rng.randint(0, 100) for _ in range(size))),
+            array('d', (base + rng.random() * 90 * 86400 for _ in range(size))),
+        ),
+        'daily_stats': {},
+        'log_seq': 0,
+    }
+
+
+def load_original(path):
+    """Cargador anterior: json.load + UserStats + UserTable.from_records"""
+    users = {}
+    with open(path, 'r', encoding='utf-8') as f:
+        data = json.load(f)
+        for user_data in data.get('users', []):
+            user = bot.UserStats(
+                user_id=user_data['user_id'],
+                username=user_data['username'],
+                first_name=user_data['first_name'],
+                message_count=user_data['message_count'],
+                command_count=user_data['command_count'],
+                last_seen=datetime.fromisoformat(user_data['last_seen']) if user_data['last_seen'] else None
+            )
+            users[user.user_id] = user
+    return bot.UserTable.from_records(users.values())
+
+
+def load_streaming(path):
+    table = bot.UserTable()
+    bot.JSONAnalyticsStore._load_json(path, table, {}, stream=True)
+    return table
+
+
+def load_binary(path):
+    with open(path, 'rb') as f:
+        return bot.BinarySnapshot.read(f)[0]
+
+
+def measure(loader, path):
+    start = time.perf_counter()
+    table = loader(path)
+    elapsed = time.perf_counter() - start
+    del table
+
+    tracemalloc.start()
+    table = loader(path)
+    resident, _ = tracemalloc.get_traced_memory()
+    del table
+    tracemalloc.stop()
+
+    tracemalloc.start()
+    loader(path)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return elapsed, resident, peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--sizes', type=int, nargs='+', default=[100_000, 1_000_000])
+    args = parser.parse_args()
+
+    print(f"{'usuarios':>10} | {'cargador':>11} | {'fichero':>8} | {'tiempo':>8} | {'tabla':>8} | {'pico':>8}")
+    print('-' * 70)
+    for size in args.sizes:
+        workdir = tempfile.mkdtemp(prefix='bench_stats_load_')
+        try:
+            json_path = os.path.join(workdir, 'stats.json')
+            binary_path = os.path.join(workdir, 'stats.bin')
+            snapshot = generate(size)
+            bot.JSONAnalyticsStore(json_path, os.path.join(workdir, 'log'), binary_path=binary_path,
+                                   snapshot_format='json')._write_json(snapshot)
+            bot.JSONAnalyticsStore(json_path, os.path.join(workdir, 'log'), binary_path=binary_path,
+                                   snapshot_format='binary')._write_binary(snapshot)
+            del snapshot
+            for name, loader, path in (('json.load', load_original, json_path),
+                                       ('incremental', load_streaming, json_path),
+                                       ('binario', load_binary, binary_path)):
+                elapsed, resident, peak = measure(loader, path)
+                print(f"{size:>10} | {name:>11} | {os.path.getsize(path) / 1e6:>5.1f} MB | "
+                      f"{elapsed:>6.2f} s | {resident / 1e6:>5.1f} MB | {peak / 1e6:>5.1f} MB")
+        finally:
+            shutil.rmtree(workdir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+"""
+Benchmark de /time: render por petición frente a TimeZoneService
+
+Mide en el propio proceso el coste de generar el texto de /time:
+
+* original: el handler anterior (``import pytz`` en cada llamada, cuatro
+  ``pytz.timezone`` y ``strftime`` por zona),
+* TimeZoneService: zonas precargadas, hora formateada por segundo y texto
+  compartido vía RenderCache.
+
+Cada caso atiende ``--burst`` peticiones seguidas (una ráfaga de /time y
+del botón de hora). También mide la construcción del índice de ciudades y
+las búsquedas exacta, por prefijo y aproximada.
+
+Uso:
+    python benchmarks/bench_time.py [--burst 1000] [--rounds 20]
+"""
+
+import argparse
+import os
+import statistics
+import sys
+import time
+from datetime import datetime
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import bot  # noqa: E402
+
+
+def render_original():
+    """Handler anterior de /time, sin el envío"""
+    import pytz
+
+    zones = {
+        '🌍 Madrid': 'Europe/Madrid',
+        '🇺🇸 NY': 'America/New_York',
+        '🇯🇵 Tokyo': 'Asia/Tokyo',
+        '🇦🇺 Sydney': 'Australia/Sydney'
+    }
+    time_text = "🕐 *HORA ACTUAL*\n\n"
+    for name, tz in zones.items():
+        tz_obj = pytz.timezone(tz)
+        current_time = datetime.now(tz_obj).strftime('%Y-%m-%d %H:%M:%S')
+        time_text += f"{name}: `{current_time}`\n"
+    return time_text
+
+
+def make_context(user_data):
+    return SimpleNamespace(
+        bot_data={'timezones': bot.TimeZoneService(), 'render_cache': bot.RenderCache()},
+        user_data=user_data,
+    )
+
+
+def measure(render, burst, rounds):
+    """Mediana por ráfaga (s) de ``rounds`` ráfagas de ``burst`` renders"""
+    results = []
+    for _ in range(rounds):
+        start = time.perf_counter()
+        for _ in range(burst):
+            render()
+        results.append(time.perf_counter() - start)
+    return statistics.median(results)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--burst', type=int, default=1000)
+    parser.add_argument('--rounds', type=int, default=20)
+    args = parser.parse_args()
+
+    context = make_context({})
+    preferred = make_context({'timezone': 'America/Argentina/Buenos_Aires'})
+    cases = [
+        ('original', render_original),
+        ('TimeZoneService /time', lambda: bot.view_time(context)),
+        ('TimeZoneService /time (zona propia)', lambda: bot.view_time(preferred)),
+        ('TimeZoneService botón de hora', lambda: bot.view_clock(context)),
+    ]
+    print(f"ráfagas de {args.burst} renders, mediana de {args.rounds}")
+    print(f"{'implementación':<38} | {'por ráfaga':>10} | {'por render':>10}")
+    print('-' * 66)
+    for name, render in cases:
+        elapsed = measure(render, args.burst, args.rounds)
+        print(f"{name:<38} | {elapsed * 1000:>7.2f} ms | {elapsed / args.burst * 1e6:>7.2f} µs")
+
+    service = bot.TimeZoneService()
+    start = time.perf_counter()
+    service.lookup('Madrid')
+    print(f"\níndice de ciudades: {(time.perf_counter() - start) * 1000:.1f} ms "
+          f"({len(service._keys)} claves, una vez)")
+    print(f"{'búsqueda':<24} | {'zona':<32} | {'tiempo':>10}")
+    print('-' * 74)
+    for kind, query in (('exacta', 'Buenos Aires'), ('alias', 'Nueva York'), ('prefijo', 'Johann'),
+                        ('aproximada', 'Kolkatta'), ('sin resultado', 'xyzzy')):
+        start = time.perf_counter()
+        for _ in range(100):
+            zone = service.lookup(query)
+        elapsed = (time.perf_counter() - start) / 100
+        print(f"{kind + ' (' + query + ')':<24} | {str(zone):<32} | {elapsed * 1e6:>7.1f} µs")
+
+
+if __name__ == '__main__':
+    main()
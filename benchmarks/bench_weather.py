@@ -0,0 +1,243 @@
+#!/usr/bin/env python3
+"""
+Benchmark de /weather: sesión compartida, caché, coalescencia y circuit breaker
+
+Arranca un proveedor falso (API compatible con Open-Meteo, ``--latency``
+por respuesta) y compara WeatherService con una implementación ingenua
+(una ClientSession y dos llamadas al proveedor por petición, sin caché):
+
+* ráfaga: ``--burst`` peticiones simultáneas de la misma ciudad (con
+  variantes de mayúsculas, tildes y espacios),
+* mezcla: ``--requests`` peticiones a lo largo de ``--duration`` segundos
+  repartidas entre ``--cities`` ciudades (Zipf),
+* caída: el proveedor deja de responder; peticiones de ciudades distintas
+  con y sin circuit breaker (que cuenta como fallo cada llamada sin
+  respuesta pasados ``--slow-call`` segundos; por defecto la fracción
+  ``WEATHER_BREAKER_SLOW_CALL_RATIO`` del timeout, como en el bot),
+* proveedor lento: ``--slow-latency`` por respuesta, por debajo del
+  timeout; el circuit breaker no debe cortar ninguna petición (se compara
+  con un umbral fijo de llamada lenta de 1 s).
+
+Para cada caso muestra llamadas al proveedor, conexiones TCP abiertas,
+peticiones cortadas por el circuit breaker sin llamar al proveedor y
+latencia p50/p99.
+
+Uso:
+    python benchmarks/bench_weather.py [--burst 500] [--requests 2000] [--latency 0.05]
+"""
+
+import argparse
+import asyncio
+import os
+import random
+import sys
+import time
+
+import aiohttp
+from aiohttp import web
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import bot  # noqa: E402
+
+
+class FakeWeatherProvider:
+    """Geocodificación y previsión falsas que cuentan llamadas y conexiones"""
+
+    def __init__(self, latency: float):
+        self.latency = latency
+        self.down = False
+        self.calls = 0
+        self.connections = set()
+        self._runner = None
+
+    async def _respond(self, request, payload):
+        self.calls += 1
+        self.connections.add(request.transport.get_extra_info('peername'))
+        # Proveedor colgado: no responde mientras esté caído (más que el timeout del cliente)
+        while self.down:
+            await asyncio.sleep(0.05)
+        await asyncio.sleep(self.latency)
+        return web.json_response(payload)
+
+    async def search(self, request):
+        name = request.query['name']
+        return await self._respond(request, {'results': [
+            {'name': name.strip().title(), 'country': 'España', 'latitude': 40.4, 'longitude': -3.7},
+        ]})
+
+    async def forecast(self, request):
+        return await self._respond(request, {'current': {
+            'time': '2024-05-01T12:00', 'temperature_2m': 21.5, 'apparent_temperature': 20.9,
+            'relative_humidity_2m': 40, 'weather_code': 2, 'wind_speed_10m': 12.0,
+        }})
+
+    def reset(self):
+        self.calls = 0
+        self.connections = set()
+
+    async def start(self, port):
+        app = web.Application()
+        app.router.add_get('/v1/search', self.search)
+        app.router.add_get('/v1/forecast', self.forecast)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, '127.0.0.1', port).start()
+        base = f'http://127.0.0.1:{port}/v1'
+        return f'{base}/search', f'{base}/forecast'
+
+    async def stop(self):
+        self.down = False
+        await self._runner.cleanup()
+
+
+class NaiveWeather:
+    """Lo que haría un handler directo: sesión nueva y dos llamadas por petición"""
+
+    def __init__(self, geocoding_url, forecast_url, timeout):
+        self.geocoding_url = geocoding_url
+        self.forecast_url = forecast_url
+        self.timeout = timeout
+
+    async def get(self, city):
+        timeout = aiohttp.ClientTimeout(total=self.timeout)
+        try:
+            async with aiohttp.ClientSession(timeout=timeout) as session:
+                async with session.get(self.geocoding_url, params={'name': city}) as response:
+                    place = (await response.json())['results'][0]
+                async with session.get(self.forecast_url, params={
+                        'latitude': place['latitude'], 'longitude': place['longitude']}) as response:
+                    await response.json()
+        except asyncio.TimeoutError:
+            raise bot.WeatherError("timeout") from None
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+async def timed_request(service, city, latencies, failures):
+    start = time.perf_counter()
+    try:
+        await service.get(city)
+    except bot.WeatherError:
+        failures.append(city)
+    latencies.append(time.perf_counter() - start)
+
+
+def report(label, provider, latencies, failures, shed, elapsed):
+    print(f"{label:<34} | {provider.calls:>7} | {len(provider.connections):>9} | {shed:>8} | "
+          f"{percentile(latencies, 0.5) * 1000:>8.1f} ms | {percentile(latencies, 0.99) * 1000:>8.1f} ms | "
+          f"{len(failures):>6} | {elapsed:>6.2f} s")
+
+
+def header(title):
+    print(f"\n{title}")
+    print(f"{'implementación':<34} | {'llamadas':>7} | {'conexiones':>9} | {'cortadas':>8} | {'p50':>11} | "
+          f"{'p99':>11} | {'fallos':>6} | {'total':>8}")
+    print('-' * 120)
+
+
+async def run_case(label, provider, service, cities, arrivals):
+    provider.reset()
+    latencies, failures = [], []
+    start = time.perf_counter()
+
+    async def request(city, delay):
+        await asyncio.sleep(delay)
+        await timed_request(service, city, latencies, failures)
+
+    await asyncio.gather(*(request(city, delay) for city, delay in zip(cities, arrivals)))
+    shed = 0
+    if isinstance(service, bot.WeatherService):
+        shed = service.geocoding.breaker.rejected + service.forecast.breaker.rejected
+    report(label, provider, latencies, failures, shed, time.perf_counter() - start)
+
+
+def make_service(urls, timeout=bot.WEATHER_FORECAST_TIMEOUT, breaker=True, slow_call=None):
+    service = bot.WeatherService(*urls)
+    for endpoint in (service.geocoding, service.forecast):
+        endpoint.timeout = timeout
+        endpoint.breaker = bot.CircuitBreaker(failures=10 ** 9) if not breaker else \
+            bot.CircuitBreaker(slow_call=slow_call or timeout * bot.WEATHER_BREAKER_SLOW_CALL_RATIO)
+    return service
+
+
+async def run(args):
+    provider = FakeWeatherProvider(args.latency)
+    urls = await provider.start(args.port)
+    try:
+        # Ráfaga: la misma ciudad escrita de varias formas
+        variants = ['Madrid', 'madrid', 'MADRID', '  Madrid ', 'mádrid']
+        cities = [variants[i % len(variants)] for i in range(args.burst)]
+        header(f"ráfaga: {args.burst} peticiones simultáneas de la misma ciudad")
+        await run_case('ingenua', provider, NaiveWeather(*urls, timeout=30), cities, [0] * args.burst)
+        service = make_service(urls)
+        await run_case('WeatherService', provider, service, cities, [0] * args.burst)
+        await run_case('WeatherService (segunda ráfaga)', provider, service, cities, [0] * args.burst)
+        await service.close()
+
+        # Mezcla Zipf a lo largo del tiempo
+        rng = random.Random(0)
+        names = [f'Ciudad{i}' for i in range(args.cities)]
+        weights = [1 / (i + 1) for i in range(args.cities)]
+        cities = rng.choices(names, weights, k=args.requests)
+        arrivals = sorted(rng.uniform(0, args.duration) for _ in range(args.requests))
+        header(f"mezcla: {args.requests} peticiones en {args.duration:g} s, {args.cities} ciudades (Zipf)")
+        await run_case('ingenua', provider, NaiveWeather(*urls, timeout=30), cities, arrivals)
+        service = make_service(urls)
+        await run_case('WeatherService', provider, service, cities, arrivals)
+        await service.close()
+
+        # Caída del proveedor: timeouts cortos para no alargar el benchmark
+        provider.down = True
+        cities = [f'Pueblo{i}' for i in range(args.outage)]
+        arrivals = [i * 0.02 for i in range(args.outage)]
+        slow_call = args.slow_call or args.timeout * bot.WEATHER_BREAKER_SLOW_CALL_RATIO
+        header(f"caída: {args.outage} ciudades distintas (una cada 20 ms), "
+               f"proveedor sin responder (timeout {args.timeout:g} s, llamada lenta {slow_call:g} s)")
+        await run_case('ingenua', provider, NaiveWeather(*urls, timeout=args.timeout), cities, arrivals)
+        for label, breaker in (('WeatherService sin circuit breaker', False), ('WeatherService', True)):
+            service = make_service(urls, timeout=args.timeout, breaker=breaker, slow_call=slow_call)
+            await run_case(label, provider, service, cities, arrivals)
+            await service.close()
+        
+        # Proveedor lento pero sano: responde antes del timeout, no debe abrirse el circuito
+        provider.down = False
+        provider.latency = args.slow_latency
+        # Pool holgado: aquí solo se mide el circuit breaker, no la espera de conexión
+        pool_size, bot.WEATHER_POOL_SIZE = bot.WEATHER_POOL_SIZE, 4 * args.outage
+        header(f"proveedor lento: {args.outage} ciudades distintas (una cada 20 ms), "
+               f"{args.slow_latency:g} s por respuesta (timeouts del bot)")
+        for label, slow_call in (('llamada lenta fija de 1 s', 1.0), ('WeatherService', None)):
+            service = bot.WeatherService(*urls)
+            if slow_call is not None:
+                for endpoint in (service.geocoding, service.forecast):
+                    endpoint.breaker = bot.CircuitBreaker(slow_call=slow_call)
+            await run_case(label, provider, service, [f'Aldea{i}{label[0]}' for i in range(args.outage)], arrivals)
+            await service.close()
+        bot.WEATHER_POOL_SIZE = pool_size
+    finally:
+        await provider.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--burst', type=int, default=500)
+    parser.add_argument('--requests', type=int, default=2000)
+    parser.add_argument('--duration', type=float, default=5)
+    parser.add_argument('--cities', type=int, default=100)
+    parser.add_argument('--outage', type=int, default=200)
+    parser.add_argument('--latency', type=float, default=0.05, help='retardo del proveedor falso (s)')
+    parser.add_argument('--timeout', type=float, default=1, help='timeout por llamada en la caída (s)')
+    parser.add_argument('--slow-call', type=float, default=None,
+                        help='llamada sin respuesta que cuenta como fallo en la caída (s)')
+    parser.add_argument('--slow-latency', type=float, default=1.5,
+                        help='retardo del proveedor lento pero sano (s)')
+    parser.add_argument('--port', type=int, default=8082)
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+"""
+Benchmark del modo webhook contra una Bot API falsa
+
+Arranca FakeTelegramAPI en este proceso y bot.py en modo webhook como
+subproceso (en un directorio temporal, para no tocar stats.json ni
+bot_data.pickle). Después envía por POST ``--updates`` mensajes de texto
+con ``--concurrency`` peticiones en paralelo, cada uno desde un chat
+distinto. Mide la latencia extremo a extremo, desde el POST hasta que la
+respuesta del bot llega a la API falsa, y al final para el bot con SIGTERM
+para comprobar el drenado. El límite global de envíos se desactiva por
+defecto (``--outbound-rate``) para medir el bot y no el limitador.
+
+Uso:
+    python benchmarks/bench_webhook.py [--updates 2000] [--concurrency 50]
+"""
+
+import argparse
+import asyncio
+import os
+import signal
+import sys
+import tempfile
+import time
+
+import aiohttp
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fake_telegram import FakeTelegramAPI, make_message_update  # noqa: E402
+
+BOT_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'bot.py')
+SECRET = 'bench-secret'
+
+
+def percentile(values, pct):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+
+async def wait_healthy(session, url, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            async with session.get(url) as response:
+                if response.status == 200:
+                    return
+        except aiohttp.ClientError:
+            pass
+        await asyncio.sleep(0.2)
+    raise RuntimeError("El bot no respondió en /health")
+
+
+async def run(args):
+    api = FakeTelegramAPI(latency=args.api_latency)
+    base_url = await api.start(port=args.api_port)
+
+    workdir = tempfile.mkdtemp(prefix='bench_webhook_')
+    env = dict(
+        os.environ,
+        TELEGRAM_BOT_TOKEN='123456:BENCHMARK',
+        TELEGRAM_API_BASE_URL=base_url,
+        BOT_MODE='webhook',
+        WEBHOOK_LISTEN='127.0.0.1',
+        WEBHOOK_PORT=str(args.port),
+        WEBHOOK_SECRET_TOKEN=SECRET,
+        OUTBOUND_GLOBAL_RATE=str(args.outbound_rate),
+        OUTBOUND_GLOBAL_BURST=str(args.outbound_rate),
+    )
+    bot = await asyncio.create_subprocess_exec(
+        sys.executable, os.path.abspath(BOT_PATH), cwd=workdir, env=env,
+        stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.DEVNULL,
+    )
+
+    webhook_url = f'http://127.0.0.1:{args.port}/webhook'
+    sent_at = {}
+    latencies = []
+    done = asyncio.Event()
+
+    def on_reply(chat_id, when):
+        start = sent_at.pop(chat_id, None)
+        if start is not None:
+            latencies.append(when - start)
+            if len(latencies) == args.updates:
+                done.set()
+
+    api.on_reply(on_reply)
+
+    try:
+        async with aiohttp.ClientSession() as session:
+            await wait_healthy(session, f'http://127.0.0.1:{args.port}/health')
+
+            # Secret token incorrecto: debe rechazarse
+            async with session.post(webhook_url, json=make_message_update(1, 'x'),
+                                    headers={'X-Telegram-Bot-Api-Secret-Token': 'mal'}) as response:
+                assert response.status == 403, response.status
+
+            semaphore = asyncio.Semaphore(args.concurrency)
+            headers = {'X-Telegram-Bot-Api-Secret-Token': SECRET}
+
+            async def post(i):
+                chat_id = 10_000_000 + i
+                payload = make_message_update(chat_id, 'mensaje de prueba')
+                async with semaphore:
+                    sent_at[chat_id] = time.perf_counter()
+                    async with session.post(webhook_url, json=payload, headers=headers) as response:
+                        assert response.status == 200, response.status
+
+            start = time.perf_counter()
+            await asyncio.gather(*(post(i) for i in range(args.updates)))
+            accepted = time.perf_counter() - start
+            try:
+                await asyncio.wait_for(done.wait(), timeout=120)
+            except asyncio.TimeoutError:
+                pass
+            total = time.perf_counter() - start
+
+            async with session.get(f'http://127.0.0.1:{args.port}/health') as response:
+                health = await response.json()
+    finally:
+        bot.send_signal(signal.SIGTERM)
+        try:
+            await asyncio.wait_for(bot.wait(), timeout=60)
+        except asyncio.TimeoutError:
+            bot.kill()
+        await api.stop()
+
+    print(f"updates enviados:      {args.updates} (concurrencia {args.concurrency})")
+    print(f"aceptados por webhook: {args.updates / accepted:,.0f} updates/s")
+    print(f"respondidos:           {len(latencies)} en {total:.2f} s → {len(latencies) / total:,.0f} updates/s")
+    if latencies:
+        print(f"latencia p50/p99:      {percentile(latencies, 50) * 1000:.1f} / "
+              f"{percentile(latencies, 99) * 1000:.1f} ms")
+    print(f"health al final:       {health}")
+    print(f"salida del bot:        código {bot.returncode}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--updates', type=int, default=2000)
+    parser.add_argument('--concurrency', type=int, default=50)
+    parser.add_argument('--port', type=int, default=8443)
+    parser.add_argument('--api-port', type=int, default=8081)
+    parser.add_argument('--api-latency', type=float, default=0.0, help='retardo de la API falsa (s)')
+    parser.add_argument('--outbound-rate', type=float, default=100000,
+                        help='límite global de envíos del bot (por defecto sin límite efectivo)')
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == '__main__':
+    main()
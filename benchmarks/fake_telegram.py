@@ -0,0 +1,317 @@
+#!/usr/bin/env python3
+"""
+Bot API de Telegram falsa para pruebas y benchmarks sin red
+
+Implementa con aiohttp los métodos que usa el bot (getMe, setMyCommands,
+sendMessage, editMessageText, answerCallbackQuery, setWebhook,
+deleteWebhook, getUpdates...) y registra cada llamada con su instante de
+llegada. El bot se apunta a ella con ``TELEGRAM_API_BASE_URL``:
+
+    TELEGRAM_API_BASE_URL=http://127.0.0.1:8081/bot python bot.py
+
+También incluye generadores de updates sintéticos (mensajes, comandos y
+callback queries) con el mismo formato JSON que envía Telegram, y
+SyntheticTraffic, que los mezcla en proporciones fijas entre N usuarios.
+
+Uso independiente:
+    python benchmarks/fake_telegram.py [--port 8081]
+"""
+
+import argparse
+import asyncio
+import itertools
+import json
+import random
+import time
+from collections import defaultdict
+
+from aiohttp import web
+
+BOT_USER = {
+    'id': 1000000001,
+    'is_bot': True,
+    'first_name': 'Fake Bot',
+    'username': 'fake_bot',
+    'can_join_groups': True,
+    'can_read_all_group_messages': False,
+    'supports_inline_queries': True,
+}
+
+
+# ============================================================================
+# GENERADORES DE UPDATES
+# ============================================================================
+
+_update_ids = itertools.count(1)
+_message_ids = itertools.count(1)
+
+
+def _user(user_id):
+    return {'id': user_id, 'is_bot': False, 'first_name': f'Usuario{user_id}',
+            'username': f'user{user_id}', 'language_code': 'es'}
+
+
+def _message(user_id, text, chat_id=None):
+    message = {
+        'message_id': next(_message_ids),
+        'date': int(time.time()),
+        'chat': {'id': chat_id or user_id, 'type': 'private', 'first_name': f'Usuario{user_id}'},
+        'from': _user(user_id),
+        'text': text,
+    }
+    if text.startswith('/'):
+        command = text.split(maxsplit=1)[0]
+        message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(command)}]
+    return message
+
+
+def make_message_update(user_id, text, chat_id=None):
+    """Update de mensaje de texto (o comando si empieza por /)"""
+    return {'update_id': next(_update_ids), 'message': _message(user_id, text, chat_id)}
+
+
+# Chat de cada callback query generada, para atribuir las respuestas con notificación
+_callback_chats = {}
+
+
+def make_callback_update(user_id, data, chat_id=None):
+    """Update de pulsación de botón inline sobre un mensaje del bot"""
+    message = _message(BOT_USER['id'], 'menú', chat_id or user_id)
+    message['from'] = BOT_USER
+    query_id = str(next(_message_ids))
+    _callback_chats[query_id] = chat_id or user_id
+    return {
+        'update_id': next(_update_ids),
+        'callback_query': {
+            'id': query_id,
+            'from': _user(user_id),
+            'chat_instance': str(chat_id or user_id),
+            'message': message,
+            'data': data,
+        },
+    }
+
+
+# Usuario de cada consulta inline generada (no hay chat), para atribuir las respuestas
+_inline_users = {}
+
+
+def make_inline_query_update(user_id, query):
+    """Update de consulta inline"""
+    query_id = str(next(_message_ids))
+    _inline_users[query_id] = user_id
+    return {
+        'update_id': next(_update_ids),
+        'inline_query': {'id': query_id, 'from': _user(user_id),
+                         'query': query, 'offset': ''},
+    }
+
+
+class SyntheticTraffic:
+    """Mezcla reproducible de comandos, textos y callback queries
+
+    Cada llamada a ``next_update`` elige un usuario entre ``users`` y un
+    tipo de update según los pesos dados; con la misma semilla la
+    secuencia es idéntica entre ejecuciones. Devuelve ``(tipo, chat_id, update)``.
+    """
+
+    COMMANDS = ('/start', '/help', '/info', '/stats', '/time', '/echo hola', '/feedback todo bien')
+    TEXTS = ('hola', 'muchas gracias', 'tengo una pregunta', 'adiós', 'un mensaje cualquiera',
+             'qué tal va todo', 'hay algún problema con el bot')
+    CALLBACKS = ('1:v:help', '1:v:info', '1:v:stats', '1:v:time', '1:v:settings')
+
+    def __init__(self, users: int = 1000, commands: float = 0.2, texts: float = 0.7,
+                 callbacks: float = 0.1, seed: int = 0, first_user_id: int = 10_000_000):
+        self.users = users
+        self.first_user_id = first_user_id
+        self.rng = random.Random(seed)
+        self.kinds = ('command', 'text', 'callback')
+        self.weights = (commands, texts, callbacks)
+
+    def next_update(self):
+        user_id = self.first_user_id + self.rng.randrange(self.users)
+        kind = self.rng.choices(self.kinds, self.weights)[0]
+        if kind == 'command':
+            return kind, user_id, make_message_update(user_id, self.rng.choice(self.COMMANDS))
+        if kind == 'text':
+            return kind, user_id, make_message_update(user_id, self.rng.choice(self.TEXTS))
+        return kind, user_id, make_callback_update(user_id, self.rng.choice(self.CALLBACKS))
+
+
+# ============================================================================
+# SERVIDOR
+# ============================================================================
+
+class FakeTelegramAPI:
+    """Servidor Bot API falso que registra todas las llamadas
+
+    ``latency`` añade un retardo artificial a cada respuesta y ``flood_every``
+    responde 429 (con ``retry_after``) cada N envíos para probar reintentos.
+    """
+
+    def __init__(self, latency: float = 0.0, flood_every: int = 0, retry_after: int = 1):
+        self.latency = latency
+        self.flood_every = flood_every
+        self.retry_after = retry_after
+        self.calls = []
+        self.calls_by_method = defaultdict(int)
+        self.sent_by_chat = defaultdict(list)
+        self.updates = asyncio.Queue()
+        self.webhook_url = None
+        self._send_count = 0
+        self._waiters = []
+        self._runner = None
+
+    @staticmethod
+    async def _params(request):
+        """Parámetros de la llamada: JSON o formulario con valores codificados en JSON"""
+        if request.content_type == 'application/json':
+            return await request.json()
+        params = {}
+        for key, value in (await request.post()).items():
+            try:
+                params[key] = json.loads(value)
+            except (TypeError, ValueError):
+                params[key] = value
+        return params
+
+    async def handle(self, request):
+        method = request.match_info['method']
+        params = await self._params(request)
+        now = time.perf_counter()
+        self.calls.append((method, params, now))
+        self.calls_by_method[method] += 1
+
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+        handler = getattr(self, f'api_{method}', None)
+        if handler is None:
+            return web.json_response({'ok': True, 'result': True})
+        return await handler(params, now)
+
+    async def api_getMe(self, params, now):
+        return web.json_response({'ok': True, 'result': BOT_USER})
+
+    async def api_sendMessage(self, params, now):
+        self._send_count += 1
+        if self.flood_every and self._send_count % self.flood_every == 0:
+            return web.json_response({
+                'ok': False, 'error_code': 429,
+                'description': f'Too Many Requests: retry after {self.retry_after}',
+                'parameters': {'retry_after': self.retry_after},
+            }, status=429)
+
+        chat_id = int(params['chat_id'])
+        self.sent_by_chat[chat_id].append(now)
+        for waiter in list(self._waiters):
+            waiter(chat_id, now)
+        return web.json_response({'ok': True, 'result': {
+            'message_id': next(_message_ids),
+            'date': int(time.time()),
+            'chat': {'id': chat_id, 'type': 'private'},
+            'from': BOT_USER,
+            'text': params.get('text', ''),
+        }})
+
+    async def api_editMessageText(self, params, now):
+        chat_id = int(params.get('chat_id', 0))
+        for waiter in list(self._waiters):
+            waiter(chat_id, now)
+        return web.json_response({'ok': True, 'result': {
+            'message_id': int(params.get('message_id', 1)),
+            'date': int(time.time()),
+            'chat': {'id': chat_id, 'type': 'private'},
+            'from': BOT_USER,
+            'text': params.get('text', ''),
+        }})
+
+    async def api_answerCallbackQuery(self, params, now):
+        # Con texto, la respuesta es una notificación visible: cuenta como respuesta al usuario
+        chat_id = _callback_chats.pop(str(params.get('callback_query_id')), None)
+        if params.get('text') and chat_id is not None:
+            for waiter in list(self._waiters):
+                waiter(chat_id, now)
+        return web.json_response({'ok': True, 'result': True})
+
+    async def api_answerInlineQuery(self, params, now):
+        user_id = _inline_users.pop(str(params.get('inline_query_id')), None)
+        if user_id is not None:
+            for waiter in list(self._waiters):
+                waiter(user_id, now)
+        return web.json_response({'ok': True, 'result': True})
+
+    async def api_getUpdates(self, params, now):
+        timeout = float(params.get('timeout', 0) or 0)
+        updates = []
+        try:
+            updates.append(await asyncio.wait_for(self.updates.get(), timeout=max(timeout, 0.01)))
+        except asyncio.TimeoutError:
+            pass
+        while not self.updates.empty() and len(updates) < int(params.get('limit', 100) or 100):
+            updates.append(self.updates.get_nowait())
+        return web.json_response({'ok': True, 'result': updates})
+
+    async def api_setWebhook(self, params, now):
+        self.webhook_url = params.get('url')
+        return web.json_response({'ok': True, 'result': True})
+
+    async def api_deleteWebhook(self, params, now):
+        self.webhook_url = None
+        return web.json_response({'ok': True, 'result': True})
+
+    def on_reply(self, callback):
+        """Registrar ``callback(chat_id, instante)`` para cada mensaje enviado o editado,
+        cada notificación de callback query y cada respuesta inline (con el usuario como chat)"""
+        self._waiters.append(callback)
+
+    def outbound_calls(self):
+        """Número de llamadas que generan tráfico visible para el usuario"""
+        methods = ('sendMessage', 'editMessageText', 'answerCallbackQuery', 'answerInlineQuery')
+        return sum(self.calls_by_method[m] for m in methods)
+
+    def build_app(self):
+        app = web.Application(client_max_size=10 * 1024 * 1024)
+        app.router.add_post('/bot{token}/{method}', self.handle)
+        return app
+
+    async def start(self, host='127.0.0.1', port=8081):
+        """Arrancar el servidor y devolver la URL base para el bot"""
+        self._runner = web.AppRunner(self.build_app(), access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, host, port)
+        await site.start()
+        return f'http://{host}:{port}/bot'
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+
+async def _serve(port, latency, flood_every):
+    api = FakeTelegramAPI(latency=latency, flood_every=flood_every)
+    base_url = await api.start(port=port)
+    print(f"Bot API falsa en {base_url} (Ctrl+C para salir)")
+    try:
+        while True:
+            await asyncio.sleep(5)
+            print(f"llamadas: {dict(api.calls_by_method)}")
+    finally:
+        await api.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--port', type=int, default=8081)
+    parser.add_argument('--latency', type=float, default=0.0, help='retardo por respuesta (s)')
+    parser.add_argument('--flood-every', type=int, default=0, help='responder 429 cada N envíos')
+    args = parser.parse_args()
+    try:
+        asyncio.run(_serve(args.port, args.latency, args.flood_every))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,313 @@
+#!/usr/bin/env python3
+"""
+Prueba de carga del bot completo contra una Bot API falsa
+
+Arranca FakeTelegramAPI en este proceso y bot.py como subproceso (en un
+directorio temporal), en modo polling (los updates salen de getUpdates),
+webhook (se envían por POST) o sharded (POST al proceso frontal, que los
+reparte entre ``--workers`` procesos). SyntheticTraffic reparte una mezcla de
+comandos, textos y callback queries entre ``--users`` usuarios, a ritmo
+fijo (``--rate``) o lo más rápido posible. Informa de:
+
+* updates/s respondidos y latencia p50/p99 (del envío del update a la
+  primera respuesta del bot en ese chat),
+* CPU consumida por el bot (para saber si el límite es el bot o el arnés);
+  en modo sharded, CPU, memoria y disco suman el frontal y sus workers,
+* memoria del proceso del bot (RSS al empezar y al terminar, y pico),
+* bytes escritos a disco por el bot (``/proc/<pid>/io``) y tamaño final
+  de sus ficheros.
+
+Con ``--output`` añade el resultado como una línea JSON para comparar
+ejecuciones entre cambios.
+
+Uso:
+    python benchmarks/load_test.py [--mode polling] [--updates 5000] [--users 1000]
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+from collections import defaultdict, deque
+
+import aiohttp
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fake_telegram import FakeTelegramAPI, SyntheticTraffic  # noqa: E402
+
+BOT_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'bot.py')
+SECRET = 'load-test-secret'
+
+
+def percentile(values, pct):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+
+def process_tree(pid):
+    """El proceso y todos sus descendientes (según /proc/<pid>/task/*/children)"""
+    pids = [pid]
+    for current in pids:
+        try:
+            for task in os.listdir(f'/proc/{current}/task'):
+                with open(f'/proc/{current}/task/{task}/children') as f:
+                    pids.extend(int(child) for child in f.read().split())
+        except OSError:
+            pass
+    return pids
+
+
+def proc_status(pid):
+    """(RSS, pico de RSS) en bytes según /proc; (0, 0) si no está disponible"""
+    values = {}
+    try:
+        with open(f'/proc/{pid}/status') as f:
+            for line in f:
+                key, _, value = line.partition(':')
+                if key in ('VmRSS', 'VmHWM'):
+                    values[key] = int(value.split()[0]) * 1024
+    except OSError:
+        pass
+    return values.get('VmRSS', 0), values.get('VmHWM', 0)
+
+
+def proc_cpu_seconds(pid):
+    """Tiempo de CPU (usuario + sistema) consumido por el proceso"""
+    try:
+        with open(f'/proc/{pid}/stat') as f:
+            fields = f.read().rsplit(')', 1)[1].split()
+        return (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+    except (OSError, IndexError, ValueError):
+        return None
+
+
+def proc_write_bytes(pid):
+    """Bytes escritos a disco por el proceso, o None si /proc/<pid>/io no es legible"""
+    try:
+        with open(f'/proc/{pid}/io') as f:
+            for line in f:
+                if line.startswith('write_bytes:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+def dir_size(path):
+    return sum(os.path.getsize(os.path.join(root, name))
+               for root, _, names in os.walk(path) for name in names)
+
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(BOT_PATH))).stdout.strip()
+    except OSError:
+        return None
+
+
+def tree_totals(pid):
+    """(RSS, pico de RSS, CPU, bytes escritos) sumados sobre el árbol de procesos"""
+    rss = peak = 0
+    cpu = written = None
+    for child in process_tree(pid):
+        child_rss, child_peak = proc_status(child)
+        rss += child_rss
+        peak += child_peak
+        child_cpu, child_written = proc_cpu_seconds(child), proc_write_bytes(child)
+        if child_cpu is not None:
+            cpu = (cpu or 0) + child_cpu
+        if child_written is not None:
+            written = (written or 0) + child_written
+    return rss, peak, cpu, written
+
+
+async def wait_ready(args, api, session):
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        if args.mode == 'polling':
+            if api.calls_by_method['getUpdates']:
+                return
+        else:
+            try:
+                async with session.get(f'http://127.0.0.1:{args.port}/health') as response:
+                    if response.status == 200:
+                        return
+            except aiohttp.ClientError:
+                pass
+        await asyncio.sleep(0.1)
+    raise RuntimeError("El bot no arrancó a tiempo")
+
+
+async def run(args):
+    api = FakeTelegramAPI(latency=args.api_latency)
+    base_url = await api.start(port=args.api_port)
+
+    workdir = tempfile.mkdtemp(prefix='load_test_')
+    limits = str(args.outbound_rate)
+    env = dict(
+        os.environ,
+        TELEGRAM_BOT_TOKEN='123456:LOADTEST',
+        TELEGRAM_API_BASE_URL=base_url,
+        BOT_MODE=args.mode,
+        SHARD_WORKERS=str(args.workers),
+        WEBHOOK_LISTEN='127.0.0.1',
+        WEBHOOK_PORT=str(args.port),
+        WEBHOOK_SECRET_TOKEN=SECRET,
+        OUTBOUND_GLOBAL_RATE=limits,
+        OUTBOUND_GLOBAL_BURST=limits,
+        OUTBOUND_CHAT_RATE=limits,
+        OUTBOUND_CHAT_BURST=limits,
+        THROTTLE_USER_LIMIT=str(args.updates),
+        THROTTLE_CHAT_LIMIT=str(args.updates),
+    )
+    bot = await asyncio.create_subprocess_exec(
+        sys.executable, os.path.abspath(BOT_PATH), cwd=workdir, env=env,
+        stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.DEVNULL,
+    )
+
+    traffic = SyntheticTraffic(users=args.users, commands=args.commands, texts=args.texts,
+                               callbacks=args.callbacks, seed=args.seed)
+    # Instantes de envío pendientes de respuesta, por chat y en orden
+    pending = defaultdict(deque)
+    latencies = []
+    latencies_by_kind = defaultdict(list)
+    done = asyncio.Event()
+
+    def on_reply(chat_id, when):
+        queue = pending.get(chat_id)
+        if queue:
+            kind, start = queue.popleft()
+            latencies.append(when - start)
+            latencies_by_kind[kind].append(when - start)
+            if len(latencies) == args.updates:
+                done.set()
+
+    api.on_reply(on_reply)
+
+    try:
+        async with aiohttp.ClientSession() as session:
+            await wait_ready(args, api, session)
+            await asyncio.sleep(args.warmup)
+            rss_start, _, cpu_start, written_start = tree_totals(bot.pid)
+            headers = {'X-Telegram-Bot-Api-Secret-Token': SECRET}
+            webhook_url = f'http://127.0.0.1:{args.port}/webhook'
+            semaphore = asyncio.Semaphore(args.concurrency)
+
+            async def post(payload):
+                async with semaphore:
+                    async with session.post(webhook_url, json=payload, headers=headers) as response:
+                        response.release()
+
+            start = time.perf_counter()
+            posts = []
+            for i in range(args.updates):
+                if args.rate:
+                    delay = start + i / args.rate - time.perf_counter()
+                    if delay > 0:
+                        await asyncio.sleep(delay)
+                kind, chat_id, update = traffic.next_update()
+                pending[chat_id].append((kind, time.perf_counter()))
+                if args.mode == 'polling':
+                    api.updates.put_nowait(update)
+                else:
+                    posts.append(asyncio.create_task(post(update)))
+                if i % 256 == 0:
+                    await asyncio.sleep(0)
+            await asyncio.gather(*posts)
+            try:
+                await asyncio.wait_for(done.wait(), timeout=args.timeout)
+            except asyncio.TimeoutError:
+                pass
+            elapsed = time.perf_counter() - start
+            rss_end, rss_peak, cpu_end, written_end = tree_totals(bot.pid)
+            harness_cpu = time.process_time()
+    finally:
+        bot.send_signal(signal.SIGTERM)
+        try:
+            await asyncio.wait_for(bot.wait(), timeout=60)
+        except asyncio.TimeoutError:
+            bot.kill()
+        await api.stop()
+
+    files_size = dir_size(workdir)
+    shutil.rmtree(workdir, ignore_errors=True)
+
+    result = {
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'revision': git_revision(),
+        'mode': args.mode,
+        'workers': args.workers if args.mode == 'sharded' else 1,
+        'updates': args.updates,
+        'users': args.users,
+        'rate': args.rate,
+        'answered': len(latencies),
+        'elapsed_s': round(elapsed, 3),
+        'updates_per_s': round(len(latencies) / elapsed, 1),
+        'latency_p50_ms': round(percentile(latencies, 50) * 1000, 2) if latencies else None,
+        'latency_p99_ms': round(percentile(latencies, 99) * 1000, 2) if latencies else None,
+        'latency_p99_by_kind_ms': {kind: round(percentile(values, 99) * 1000, 2)
+                                   for kind, values in sorted(latencies_by_kind.items())},
+        'bot_cpu_s': round(cpu_end - cpu_start, 2) if cpu_start is not None and cpu_end is not None else None,
+        'rss_start_mb': round(rss_start / 1e6, 1),
+        'rss_end_mb': round(rss_end / 1e6, 1),
+        'rss_peak_mb': round(rss_peak / 1e6, 1),
+        'disk_written_kb': round((written_end - written_start) / 1024, 1)
+        if written_start is not None and written_end is not None else None,
+        'files_kb': round(files_size / 1024, 1),
+        'api_calls': dict(api.calls_by_method),
+        'exit_code': bot.returncode,
+    }
+
+    workers = f", {args.workers} workers" if args.mode == 'sharded' else ''
+    print(f"modo:                  {args.mode}{workers} ({args.users} usuarios, "
+          f"{'sin límite' if not args.rate else f'{args.rate:g} updates/s'})")
+    print(f"respondidos:           {result['answered']}/{args.updates} en {elapsed:.2f} s "
+          f"→ {result['updates_per_s']:,.0f} updates/s")
+    print(f"latencia p50/p99:      {result['latency_p50_ms']} / {result['latency_p99_ms']} ms")
+    print(f"p99 por tipo:          {result['latency_p99_by_kind_ms']}")
+    print(f"CPU del bot:           {result['bot_cpu_s']} s "
+          f"(el arnés y la API falsa: {harness_cpu:.2f} s)")
+    print(f"memoria (RSS):         {result['rss_start_mb']} → {result['rss_end_mb']} MB "
+          f"(pico {result['rss_peak_mb']} MB)")
+    print(f"escrito a disco:       {result['disk_written_kb']} KB (ficheros finales {result['files_kb']} KB)")
+    print(f"llamadas a la API:     {result['api_calls']}")
+    print(f"salida del bot:        código {bot.returncode}")
+
+    if args.output:
+        with open(args.output, 'a', encoding='utf-8') as f:
+            f.write(json.dumps(result, ensure_ascii=False) + '\n')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--mode', choices=('polling', 'webhook', 'sharded'), default='polling')
+    parser.add_argument('--workers', type=int, default=2, help='procesos worker en modo sharded')
+    parser.add_argument('--updates', type=int, default=5000)
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--rate', type=float, default=0, help='updates/s a inyectar (0 = sin límite)')
+    parser.add_argument('--commands', type=float, default=0.2, help='peso de los comandos en la mezcla')
+    parser.add_argument('--texts', type=float, default=0.7, help='peso de los mensajes de texto')
+    parser.add_argument('--callbacks', type=float, default=0.1, help='peso de las callback queries')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--concurrency', type=int, default=50, help='POST simultáneos en modo webhook')
+    parser.add_argument('--port', type=int, default=8443)
+    parser.add_argument('--api-port', type=int, default=8081)
+    parser.add_argument('--api-latency', type=float, default=0.0, help='retardo de la API falsa (s)')
+    parser.add_argument('--outbound-rate', type=float, default=100000,
+                        help='límites de envío del bot (por defecto sin límite efectivo)')
+    parser.add_argument('--warmup', type=float, default=1.0, help='segundos de espera tras arrancar')
+    parser.add_argument('--timeout', type=float, default=120, help='espera máxima de respuestas (s)')
+    parser.add_argument('--output', help='fichero JSONL donde añadir el resultado')
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == '__main__':
+    main()
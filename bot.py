@@ -11,15 +11,49 @@ Características:
 """
 
 import os
+import sys
+import ast
+import hmac
 import json
+import re
+import struct
+import secrets
+import string
+import atexit
+import bisect
+import codecs
+import copy
+import difflib
 import logging
+import logging.handlers
+import math
+import multiprocessing
+import pickle
+import queue
 import asyncio
-from datetime import datetime, timedelta
-from typing import Dict, Optional, List
+import heapq
+import itertools
+import threading
+import time
+import unicodedata
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from functools import lru_cache, partial, wraps
+from array import array
+from datetime import date, datetime, timedelta
+from typing import Callable, Dict, Optional, List, Tuple
 from dataclasses import dataclass, asdict
-from collections import defaultdict
+from collections import OrderedDict, defaultdict, deque
 
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram import (
+    Update,
+    InlineKeyboardButton,
+    InlineKeyboardMarkup,
+    InlineQueryResultArticle,
+    InputTextMessageContent,
+)
+from telegram.error import BadRequest, RetryAfter
+from telegram.helpers import escape_markdown
 from telegram.ext import (
     Application,
     CommandHandler,
@@ -27,37 +61,195 @@ from telegram.ext import (
     filters,
     ContextTypes,
     CallbackQueryHandler,
+    InlineQueryHandler,
     ConversationHandler,
-    PicklePersistence,
+    BasePersistence,
+    TypeHandler,
+    BaseUpdateProcessor,
+    BaseRateLimiter,
+    ApplicationHandlerStop,
 )
 
 # ============================================================================
 # CONFIGURACIÓN Y CONSTANTES
 # ============================================================================
 
-# Cargar variables de entorno desde archivo .env si existe
-try:
-    from dotenv import load_dotenv
-    load_dotenv()
-except ImportError:
-    pass
+# Cargar variables de entorno desde archivo .env si existe (junto al script o en
+# el directorio actual); sin .env no se importa python-dotenv
+_env_files = [path for path in (os.path.join(os.path.dirname(os.path.abspath(__file__)), '.env'), '.env')
+              if os.path.isfile(path)]
+if _env_files:
+    try:
+        from dotenv import load_dotenv
+        for _env_file in _env_files:
+            load_dotenv(_env_file)
+    except ImportError:
+        pass
 
 # Constantes
+# Sin valor por defecto: main() se niega a arrancar sin token
 TOKEN = os.environ.get("TELEGRAM_BOT_TOKEN")
-if not TOKEN:
-    # Token hardcodeado solo para desarrollo - ELIMINAR en producción
-    TOKEN = "7524353782:AAEwgHLdwMSvietPvFk25cKH9lJCMU1tTBI"
-    print("⚠️  ADVERTENCIA: Usando token hardcodeado. NO usar en producción.")
+
+# URL base de la Bot API (permite apuntar a un servidor local de pruebas)
+TELEGRAM_API_BASE_URL = os.environ.get("TELEGRAM_API_BASE_URL")
+
+# Modo de recepción de updates: "polling", "webhook" o "sharded" (webhook + N workers)
+BOT_MODE = os.environ.get("BOT_MODE", "polling").lower()
+DROP_PENDING_UPDATES = os.environ.get("DROP_PENDING_UPDATES", "false").lower() == "true"
+WEBHOOK_URL = os.environ.get("WEBHOOK_URL")
+WEBHOOK_LISTEN = os.environ.get("WEBHOOK_LISTEN", "0.0.0.0")
+WEBHOOK_PORT = int(os.environ.get("WEBHOOK_PORT", "8443"))
+WEBHOOK_PATH = os.environ.get("WEBHOOK_PATH", "/webhook")
+WEBHOOK_SECRET_TOKEN = os.environ.get("WEBHOOK_SECRET_TOKEN")
+WEBHOOK_DRAIN_TIMEOUT = float(os.environ.get("WEBHOOK_DRAIN_TIMEOUT", "30"))
+
+# Modo sharded: workers locales (puertos consecutivos), cola máxima por worker y tamaño de lote
+SHARD_WORKERS = int(os.environ.get("SHARD_WORKERS", str(os.cpu_count() or 2)))
+SHARD_BASE_PORT = int(os.environ.get("SHARD_BASE_PORT", str(WEBHOOK_PORT + 1)))
+SHARD_MAX_PENDING = int(os.environ.get("SHARD_MAX_PENDING", "10000"))
+SHARD_BATCH_SIZE = int(os.environ.get("SHARD_BATCH_SIZE", "100"))
+# Índice del worker cuando el proceso es un worker del modo sharded (lo fija el frontal)
+SHARD_INDEX = os.environ.get("SHARD_INDEX", "")
+
+# Concurrencia: handlers simultáneos y updates admitidos antes de aplicar backpressure
+UPDATE_MAX_RUNNING = int(os.environ.get("UPDATE_MAX_RUNNING", "64"))
+UPDATE_MAX_PENDING = int(os.environ.get("UPDATE_MAX_PENDING", "2048"))
+
+# Límites de envío de Telegram (mensajes/s) y reintentos ante 429
+OUTBOUND_GLOBAL_RATE = float(os.environ.get("OUTBOUND_GLOBAL_RATE", "30"))
+OUTBOUND_GLOBAL_BURST = float(os.environ.get("OUTBOUND_GLOBAL_BURST", "5"))
+OUTBOUND_CHAT_RATE = float(os.environ.get("OUTBOUND_CHAT_RATE", "1"))
+OUTBOUND_CHAT_BURST = float(os.environ.get("OUTBOUND_CHAT_BURST", "3"))
+OUTBOUND_GROUP_RATE = float(os.environ.get("OUTBOUND_GROUP_RATE", str(20 / 60)))
+OUTBOUND_MAX_RETRIES = int(os.environ.get("OUTBOUND_MAX_RETRIES", "3"))
+OUTBOUND_MAX_CHAT_BUCKETS = 10000
+# Conexiones HTTP simultáneas hacia la Bot API
+OUTBOUND_POOL_SIZE = int(os.environ.get("OUTBOUND_POOL_SIZE", "32"))
+
+# Anti-spam de entrada: máximo de updates por ventana (segundos) por usuario y por chat
+THROTTLE_WINDOW = float(os.environ.get("THROTTLE_WINDOW", "10"))
+THROTTLE_USER_LIMIT = int(os.environ.get("THROTTLE_USER_LIMIT", "20"))
+THROTTLE_CHAT_LIMIT = int(os.environ.get("THROTTLE_CHAT_LIMIT", "60"))
+# Consultas inline (una por pulsación) y botones: cupo propio por usuario, más amplio
+THROTTLE_INTERACTION_LIMIT = int(os.environ.get("THROTTLE_INTERACTION_LIMIT", "120"))
+THROTTLE_MAX_KEYS = int(os.environ.get("THROTTLE_MAX_KEYS", "100000"))
 
 # Estados para conversaciones
 ASK_QUESTION, CONFIRM_DELETE = range(2)
 
+# Persistencia de analytics: snapshot + log de eventos append-only
+STATS_FILE = os.environ.get("STATS_FILE", "stats.json")
+STATS_LOG_FILE = os.environ.get("STATS_LOG_FILE", "stats.log.jsonl")
+STATS_COMPACT_EVERY = int(os.environ.get("STATS_COMPACT_EVERY", "10000"))
+# Formato del snapshot: "json" (stats.json) o "binary" (columnas empaquetadas, carga rápida)
+STATS_SNAPSHOT_FORMAT = os.environ.get("STATS_SNAPSHOT_FORMAT", "json").lower()
+STATS_BINARY_FILE = os.environ.get("STATS_BINARY_FILE", "stats.bin")
+# Tamaño de bloque del lector incremental de stats.json (bytes)
+STATS_LOAD_CHUNK_SIZE = int(os.environ.get("STATS_LOAD_CHUNK_SIZE", str(1024 * 1024)))
+# Por debajo de este tamaño stats.json se carga entero con json.load (más rápido);
+# por encima se usa el lector incremental (pico de memoria acotado)
+STATS_STREAM_MIN_BYTES = int(os.environ.get("STATS_STREAM_MIN_BYTES", str(8 * 1024 * 1024)))
+# Volcado en segundo plano: cada N segundos o al acumular N usuarios pendientes
+STATS_FLUSH_INTERVAL = float(os.environ.get("STATS_FLUSH_INTERVAL", "5"))
+STATS_FLUSH_MAX_DIRTY = int(os.environ.get("STATS_FLUSH_MAX_DIRTY", "1000"))
+# Backend de analytics: "json" (snapshot + log) o "sqlite"
+ANALYTICS_BACKEND = os.environ.get("ANALYTICS_BACKEND", "json").lower()
+STATS_DB_FILE = os.environ.get("STATS_DB_FILE", "stats.db")
+# Backend compartido por varios procesos: /stats lee totales y ranking del backend
+ANALYTICS_SHARED = os.environ.get("ANALYTICS_SHARED", "false").lower() == "true"
+# Tamaño del ranking mantenido incrementalmente para /stats
+TOP_USERS_CAPACITY = 10
+# Retención de los histogramas de actividad (número de cubetas)
+ACTIVITY_MINUTE_BUCKETS = int(os.environ.get("ACTIVITY_MINUTE_BUCKETS", "120"))
+ACTIVITY_HOUR_BUCKETS = int(os.environ.get("ACTIVITY_HOUR_BUCKETS", str(24 * 7)))
+ACTIVITY_DAY_BUCKETS = int(os.environ.get("ACTIVITY_DAY_BUCKETS", "90"))
+MAX_TRACKED_COMMANDS = 50
+
+# Feedback: JSONL append-only con rotación por tamaño
+FEEDBACK_FILE = os.environ.get("FEEDBACK_FILE", "feedback.jsonl")
+FEEDBACK_LEGACY_FILE = "feedback.json"
+FEEDBACK_MAX_BYTES = int(os.environ.get("FEEDBACK_MAX_BYTES", str(5 * 1024 * 1024)))
+FEEDBACK_BACKUP_COUNT = int(os.environ.get("FEEDBACK_BACKUP_COUNT", "5"))
+
+# Reglas de respuestas automáticas (si no existe se usan las de por defecto)
+KEYWORDS_FILE = os.environ.get("KEYWORDS_FILE", "keywords.json")
+
+# Métricas Prometheus: puerto local de /metrics (0 = desactivado). Nunca se sirven en el
+# listener público del webhook: exponen comandos, errores y colas
+METRICS_LISTEN = os.environ.get("METRICS_LISTEN", "127.0.0.1")
+METRICS_PORT = int(os.environ.get("METRICS_PORT", "0"))
+LOOP_LAG_INTERVAL = float(os.environ.get("LOOP_LAG_INTERVAL", "0.5"))
+
+# Vista de /stats: segundos que se reutiliza el ranking aunque haya actividad nueva
+STATS_VIEW_TTL = float(os.environ.get("STATS_VIEW_TTL", "2"))
+# Entradas máximas de la caché de vistas renderizadas (las claves de /time dependen de la ciudad pedida)
+RENDER_CACHE_SIZE = int(os.environ.get("RENDER_CACHE_SIZE", "1000"))
+
+# Calculadora (/calc): procesos de cálculo, límites por expresión y caché de expresiones compiladas
+CALC_WORKERS = int(os.environ.get("CALC_WORKERS", "1"))
+CALC_TIMEOUT = float(os.environ.get("CALC_TIMEOUT", "2"))
+CALC_MEMORY_LIMIT = int(os.environ.get("CALC_MEMORY_LIMIT_MB", "256")) * 1024 * 1024
+CALC_CACHE_SIZE = int(os.environ.get("CALC_CACHE_SIZE", "512"))
+CALC_RANGE_MAX_POINTS = int(os.environ.get("CALC_RANGE_MAX_POINTS", "100000"))
+# Rangos vectorizados con numpy si está instalado
+CALC_USE_NUMPY = os.environ.get("CALC_USE_NUMPY", "true").lower() == "true"
+CALC_MAX_LENGTH = 200
+CALC_MAX_NODES = 100
+# Tamaño máximo (bits) de una potencia entera: 9**9**9 se rechaza sin calcularla
+CALC_MAX_BITS = 100_000
+# Máximo de decimales (en valor absoluto) de round: round(7, -10**7) construiría 10**(10**7)
+CALC_MAX_ROUND_DIGITS = 100
+
+# Clima (/weather): API compatible con Open-Meteo (configurable para pruebas con un servidor local)
+WEATHER_GEOCODING_URL = os.environ.get("WEATHER_GEOCODING_URL", "https://geocoding-api.open-meteo.com/v1/search")
+WEATHER_FORECAST_URL = os.environ.get("WEATHER_FORECAST_URL", "https://api.open-meteo.com/v1/forecast")
+# Caché por ciudad: vigencia, respuesta caducada aceptable si el proveedor falla y "no encontrada"
+WEATHER_CACHE_TTL = float(os.environ.get("WEATHER_CACHE_TTL", "600"))
+WEATHER_STALE_TTL = float(os.environ.get("WEATHER_STALE_TTL", "21600"))
+WEATHER_NOT_FOUND_TTL = float(os.environ.get("WEATHER_NOT_FOUND_TTL", "300"))
+WEATHER_CACHE_SIZE = int(os.environ.get("WEATHER_CACHE_SIZE", "2000"))
+# Timeouts (s) por proveedor, conexiones simultáneas y circuit breaker
+WEATHER_GEOCODING_TIMEOUT = float(os.environ.get("WEATHER_GEOCODING_TIMEOUT", "3"))
+WEATHER_FORECAST_TIMEOUT = float(os.environ.get("WEATHER_FORECAST_TIMEOUT", "5"))
+WEATHER_CONNECT_TIMEOUT = float(os.environ.get("WEATHER_CONNECT_TIMEOUT", "2"))
+WEATHER_POOL_SIZE = int(os.environ.get("WEATHER_POOL_SIZE", "20"))
+WEATHER_BREAKER_FAILURES = int(os.environ.get("WEATHER_BREAKER_FAILURES", "5"))
+WEATHER_BREAKER_RESET = float(os.environ.get("WEATHER_BREAKER_RESET", "30"))
+# Una llamada aún sin respuesta pasada esta fracción de su timeout ya cuenta como fallo para el circuit breaker
+WEATHER_BREAKER_SLOW_CALL_RATIO = float(os.environ.get("WEATHER_BREAKER_SLOW_CALL_RATIO", "0.8"))
+
+# Zonas horarias que muestra /time (nombres IANA, separados por comas)
+TIME_ZONES = [zone.strip() for zone in os.environ.get(
+    "TIME_ZONES", "Europe/Madrid,America/New_York,Asia/Tokyo,Australia/Sydney").split(',') if zone.strip()]
+
+# Modo inline: respuestas en caché (entradas) y cache_time (s) de los resultados estáticos y de estadísticas
+INLINE_CACHE_SIZE = int(os.environ.get("INLINE_CACHE_SIZE", "5000"))
+INLINE_STATIC_CACHE_TIME = int(os.environ.get("INLINE_STATIC_CACHE_TIME", "3600"))
+INLINE_STATS_CACHE_TIME = int(os.environ.get("INLINE_STATS_CACHE_TIME", "30"))
+
+# Persistencia de user_data/chat_data/bot_data (SQLite) y fichero pickle antiguo a migrar
+PERSISTENCE_FILE = os.environ.get("PERSISTENCE_FILE", "bot_data.db")
+PERSISTENCE_LEGACY_FILE = "bot_data.pickle"
+PERSISTENCE_UPDATE_INTERVAL = float(os.environ.get("PERSISTENCE_UPDATE_INTERVAL", "60"))
+
+# Logging: formato ("text" o "json"), rotación ("size" o "time") y muestreo de mensajes
+LOG_FILE = os.environ.get("LOG_FILE", "bot.log")
+LOG_FORMAT = os.environ.get("LOG_FORMAT", "text").lower()
+LOG_ROTATION = os.environ.get("LOG_ROTATION", "size").lower()
+LOG_MAX_BYTES = int(os.environ.get("LOG_MAX_BYTES", str(10 * 1024 * 1024)))
+LOG_BACKUP_COUNT = int(os.environ.get("LOG_BACKUP_COUNT", "5"))
+LOG_MESSAGE_SAMPLE_EVERY = int(os.environ.get("LOG_MESSAGE_SAMPLE_EVERY", "100"))
+
 # ============================================================================
 # CONFIGURACIÓN AVANZADA DE LOGGING
 # ============================================================================
 
 class CustomFormatter(logging.Formatter):
-    """Formateador personalizado para logs"""
+    """Formateador personalizado para logs
+
+    Los formateadores por nivel se construyen una sola vez en ``__init__``
+    en lugar de crear un ``logging.Formatter`` nuevo por cada registro.
+    """
     
     grey = "\x1b[38;20m"
     yellow = "\x1b[33;20m"
@@ -74,28 +266,98 @@ class CustomFormatter(logging.Formatter):
         logging.CRITICAL: bold_red + format_str + reset
     }
     
+    def __init__(self):
+        super().__init__(self.format_str)
+        self._formatters = {level: logging.Formatter(fmt) for level, fmt in self.FORMATS.items()}
+    
     def format(self, record):
-        log_fmt = self.FORMATS.get(record.levelno)
-        formatter = logging.Formatter(log_fmt)
+        formatter = self._formatters.get(record.levelno, self._formatters[logging.INFO])
         return formatter.format(record)
 
-# Configurar logger principal
-logger = logging.getLogger(__name__)
-logger.setLevel(logging.INFO)
 
-# Handler para consola con colores
-console_handler = logging.StreamHandler()
-console_handler.setLevel(logging.INFO)
-console_handler.setFormatter(CustomFormatter())
+class JsonFormatter(logging.Formatter):
+    """Formateador JSON lines: un objeto por registro, apto para ingestión"""
+    
+    def format(self, record):
+        entry = {
+            'ts': datetime.fromtimestamp(record.created).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        if record.exc_info:
+            entry['exc_info'] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False)
+
+
+class SampledLog:
+    """Muestreo 1 de cada N para logs por mensaje
 
-# Handler para archivo
-file_handler = logging.FileHandler('bot.log', encoding='utf-8')
-file_handler.setLevel(logging.DEBUG)
-file_format = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-file_handler.setFormatter(file_format)
+    Un contador basta: el coste en el camino caliente es un incremento y
+    una comparación, y los registros descartados nunca se formatean.
+    """
+    
+    def __init__(self, every: int):
+        self.every = max(1, every)
+        self._count = 0
+    
+    def __call__(self) -> bool:
+        self._count += 1
+        if self._count >= self.every:
+            self._count = 0
+            return True
+        return False
+
+
+def _build_file_handler() -> logging.Handler:
+    """Handler de archivo con rotación por tamaño o diaria según LOG_ROTATION"""
+    if LOG_ROTATION == 'time':
+        handler = logging.handlers.TimedRotatingFileHandler(
+            LOG_FILE, when='midnight', backupCount=LOG_BACKUP_COUNT, encoding='utf-8'
+        )
+    else:
+        handler = logging.handlers.RotatingFileHandler(
+            LOG_FILE, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUP_COUNT, encoding='utf-8'
+        )
+    handler.setLevel(logging.DEBUG)
+    if LOG_FORMAT == 'json':
+        handler.setFormatter(JsonFormatter())
+    else:
+        handler.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
+    return handler
+
+
+def setup_logging() -> logging.handlers.QueueListener:
+    """Conectar el logger a una cola atendida por un hilo propio
+
+    El event loop solo encola el registro (QueueHandler); el formateo y la
+    escritura en consola y disco ocurren en el hilo del QueueListener.
+    """
+    console_handler = logging.StreamHandler()
+    console_handler.setLevel(logging.INFO)
+    console_handler.setFormatter(CustomFormatter())
+    
+    log_queue = queue.SimpleQueue()
+    logger.addHandler(logging.handlers.QueueHandler(log_queue))
+    listener = logging.handlers.QueueListener(
+        log_queue, console_handler, _build_file_handler(), respect_handler_level=True
+    )
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
+
+# Configurar logger principal; los handlers (y bot.log) se crean en main(),
+# así importar el módulo (benchmarks, workers) no abre ficheros ni hilos
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+log_listener: Optional[logging.handlers.QueueListener] = None
+sample_message_log = SampledLog(LOG_MESSAGE_SAMPLE_EVERY)
 
-logger.addHandler(console_handler)
-logger.addHandler(file_handler)
+def configure_logging():
+    """Arrancar el pipeline de logging (idempotente)"""
+    global log_listener
+    if log_listener is None:
+        log_listener = setup_logging()
 
 # ============================================================================
 # MODELOS DE DATOS
@@ -121,416 +383,4031 @@ class UserStats:
             'last_seen': self.last_seen.isoformat() if self.last_seen else None
         }
 
-class AnalyticsMiddleware:
-    """Middleware para tracking de uso"""
+class UserStatsView:
+    """Vista compatible con UserStats sobre una fila de UserTable"""
+    
+    __slots__ = ('_table', '_row')
+    
+    def __init__(self, table: 'UserTable', row: int):
+        self._table = table
+        self._row = row
+    
+    @property
+    def user_id(self) -> int:
+        return self._table.user_ids[self._row]
+    
+    @property
+    def username(self) -> str:
+        return self._table.usernames[self._row]
+    
+    @username.setter
+    def username(self, value: str):
+        self._table.usernames[self._row] = sys.intern(value)
+    
+    @property
+    def first_name(self) -> str:
+        return self._table.first_names[self._row]
+    
+    @first_name.setter
+    def first_name(self, value: str):
+        self._table.first_names[self._row] = sys.intern(value)
+    
+    @property
+    def message_count(self) -> int:
+        return self._table.message_counts[self._row]
+    
+    @message_count.setter
+    def message_count(self, value: int):
+        self._table.message_counts[self._row] = value
+    
+    @property
+    def command_count(self) -> int:
+        return self._table.command_counts[self._row]
+    
+    @command_count.setter
+    def command_count(self, value: int):
+        self._table.command_counts[self._row] = value
+    
+    @property
+    def last_seen(self) -> Optional[datetime]:
+        timestamp = self._table.last_seen[self._row]
+        return datetime.fromtimestamp(timestamp) if timestamp else None
+    
+    @last_seen.setter
+    def last_seen(self, value: Optional[datetime]):
+        self._table.last_seen[self._row] = value.timestamp() if value else 0.0
+    
+    def to_dict(self):
+        return {
+            'user_id': self.user_id,
+            'username': self.username,
+            'first_name': self.first_name,
+            'message_count': self.message_count,
+            'command_count': self.command_count,
+            'last_seen': self.last_seen.isoformat() if self.last_seen else None
+        }
+    
+    def __repr__(self):
+        return (f"UserStatsView(user_id={self.user_id}, username={self.username!r}, "
+                f"message_count={self.message_count}, command_count={self.command_count})")
+
+class UserTable:
+    """Tabla columnar de estadísticas de usuario
+
+    Un índice user_id → fila más columnas ``array`` para los contadores y el
+    last_seen (epoch en segundos, 0 = nunca). Los nombres se internan, así
+    que valores repetidos ('Sin username', nombres comunes) se comparten.
+    Se comporta como un ``Dict[int, UserStats]`` de solo lectura más
+    ``__setitem__``: indexar devuelve un UserStatsView.
+    """
     
     def __init__(self):
-        self.user_stats: Dict[int, UserStats] = {}
-        self.daily_stats = defaultdict(int)
-        self.load_stats()
+        self._index: Dict[int, int] = {}
+        self.user_ids = array('q')
+        self.message_counts = array('q')
+        self.command_counts = array('q')
+        self.last_seen = array('d')
+        self.usernames: List[str] = []
+        self.first_names: List[str] = []
     
-    def load_stats(self):
-        """Cargar estadísticas desde archivo"""
-        try:
-            if os.path.exists('stats.json'):
-                with open('stats.json', 'r', encoding='utf-8') as f:
-                    data = json.load(f)
-                    for user_data in data.get('users', []):
-                        user = UserStats(
-                            user_id=user_data['user_id'],
-                            username=user_data['username'],
-                            first_name=user_data['first_name'],
-                            message_count=user_data['message_count'],
-                            command_count=user_data['command_count'],
-                            last_seen=datetime.fromisoformat(user_data['last_seen']) if user_data['last_seen'] else None
-                        )
-                        self.user_stats[user.user_id] = user
-                logger.info(f"Estadísticas cargadas: {len(self.user_stats)} usuarios")
-        except Exception as e:
-            logger.error(f"Error cargando estadísticas: {e}")
+    def __len__(self) -> int:
+        return len(self._index)
     
-    def save_stats(self):
-        """Guardar estadísticas en archivo"""
-        try:
-            data = {
-                'users': [user.to_dict() for user in self.user_stats.values()],
-                'daily_stats': dict(self.daily_stats),
-                'last_updated': datetime.now().isoformat()
-            }
-            with open('stats.json', 'w', encoding='utf-8') as f:
-                json.dump(data, f, indent=2, ensure_ascii=False)
-        except Exception as e:
-            logger.error(f"Error guardando estadísticas: {e}")
+    def __contains__(self, user_id) -> bool:
+        return user_id in self._index
     
-    def track_user(self, user):
-        """Registrar actividad de usuario"""
-        today = datetime.now().strftime('%Y-%m-%d')
-        self.daily_stats[today] += 1
-        
-        if user.id not in self.user_stats:
-            self.user_stats[user.id] = UserStats(
-                user_id=user.id,
-                username=user.username or 'Sin username',
-                first_name=user.first_name or 'Sin nombre',
-                message_count=0,
-                command_count=0,
-                last_seen=datetime.now()
-            )
-        
-        stats = self.user_stats[user.id]
-        stats.last_seen = datetime.now()
-        
-        # Guardar cada 10 interacciones
-        if sum([stats.message_count, stats.command_count]) % 10 == 0:
-            self.save_stats()
+    def __iter__(self):
+        return iter(self._index)
     
-    def track_message(self, user):
-        """Registrar mensaje de usuario"""
-        self.track_user(user)
-        self.user_stats[user.id].message_count += 1
+    def __getitem__(self, user_id: int) -> UserStatsView:
+        return UserStatsView(self, self._index[user_id])
     
-    def track_command(self, user):
-        """Registrar comando de usuario"""
-        self.track_user(user)
-        self.user_stats[user.id].command_count += 1
+    def __setitem__(self, user_id: int, stats):
+        row = self._index.get(user_id)
+        if row is None:
+            self.add(user_id, stats.username, stats.first_name,
+                     stats.message_count, stats.command_count,
+                     stats.last_seen.timestamp() if stats.last_seen else 0.0)
+        else:
+            view = UserStatsView(self, row)
+            view.username = stats.username
+            view.first_name = stats.first_name
+            view.message_count = stats.message_count
+            view.command_count = stats.command_count
+            view.last_seen = stats.last_seen
+    
+    def get(self, user_id: int, default=None):
+        row = self._index.get(user_id)
+        return default if row is None else UserStatsView(self, row)
+    
+    def keys(self):
+        return self._index.keys()
+    
+    def values(self):
+        return (UserStatsView(self, row) for row in range(len(self.user_ids)))
+    
+    def items(self):
+        return ((user_id, UserStatsView(self, row)) for user_id, row in self._index.items())
+    
+    def row(self, user_id: int) -> Optional[int]:
+        """Fila de un usuario, o None si no existe"""
+        return self._index.get(user_id)
+    
+    def add(self, user_id: int, username: str, first_name: str,
+            message_count: int = 0, command_count: int = 0, last_seen: float = 0.0) -> int:
+        """Añadir un usuario nuevo y devolver su fila"""
+        row = len(self.user_ids)
+        self._index[user_id] = row
+        self.user_ids.append(user_id)
+        self.usernames.append(sys.intern(username))
+        self.first_names.append(sys.intern(first_name))
+        self.message_counts.append(message_count)
+        self.command_counts.append(command_count)
+        self.last_seen.append(last_seen)
+        return row
+    
+    @classmethod
+    def from_records(cls, records) -> 'UserTable':
+        """Construir la tabla a partir de objetos tipo UserStats"""
+        table = cls()
+        for stats in records:
+            table[stats.user_id] = stats
+        return table
+    
+    @classmethod
+    def from_columns(cls, user_ids: array, usernames: List[str], first_names: List[str],
+                     message_counts: array, command_counts: array, last_seen: array) -> 'UserTable':
+        """Construir la tabla adoptando columnas completas (snapshot binario)"""
+        table = cls()
+        table.user_ids = user_ids
+        table.message_counts = message_counts
+        table.command_counts = command_counts
+        table.last_seen = last_seen
+        table.usernames = list(map(sys.intern, usernames))
+        table.first_names = list(map(sys.intern, first_names))
+        table._index = dict(zip(user_ids, range(len(user_ids))))
+        return table
+    
+    def copy_columns(self) -> tuple:
+        """Copia de las columnas (user_id, username, first_name, mensajes, comandos, last_seen)"""
+        return (
+            self.user_ids[:], self.usernames[:], self.first_names[:],
+            self.message_counts[:], self.command_counts[:], self.last_seen[:]
+        )
 
 # ============================================================================
-# MANEJADORES DE COMANDOS MEJORADOS
+# BACKENDS DE ALMACENAMIENTO DE ANALYTICS
 # ============================================================================
 
-async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Manejador mejorado para /start"""
-    user = update.effective_user
-    analytics = context.bot_data.get('analytics')
+class AnalyticsStore:
+    """Interfaz de almacenamiento para AnalyticsMiddleware
+
+    Los eventos que recibe ``write_events`` son deltas agrupados por usuario:
+    ``u`` (user id), ``m``/``c`` (incrementos de mensajes/comandos), ``t``
+    (last_seen en epoch), ``i`` (interacciones agrupadas, 1 si falta), ``s``
+    (número de secuencia) y ``n``/``f`` (username/nombre, solo en usuarios
+    nuevos). ``write_events`` y ``compact`` pueden llamarse desde un hilo.
+    """
     
-    if analytics:
-        analytics.track_command(user)
+    # Atributos que no se copian al serializar (ver __getstate__)
+    _transient = ('_io_lock',)
     
-    # Mensaje de bienvenida personalizado
-    welcome_text = f"""
-✨ *¡Hola {user.first_name}!* ✨
+    def __init__(self):
+        self._io_lock = threading.RLock()
+    
+    def __getstate__(self):
+        # Locks, ficheros y conexiones no son serializables
+        state = self.__dict__.copy()
+        for key in self._transient:
+            state[key] = None
+        return state
+    
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._io_lock = threading.RLock()
+    
+    def load(self, progress: Optional[Callable[[float], None]] = None
+             ) -> Tuple[Dict[int, UserStats], Dict[str, int], int]:
+        """Devolver (usuarios, actividad diaria, último número de secuencia)
 
-🤖 Soy un bot avanzado de Telegram con muchas funcionalidades.
+        ``usuarios`` es un mapeo user_id → UserStats; los backends que pueden
+        devuelven directamente una UserTable. ``progress`` recibe la fracción
+        cargada (0..1) de vez en cuando, desde el hilo que carga.
+        """
+        raise NotImplementedError
+    
+    def write_events(self, events: List[dict]):
+        """Persistir un bloque de deltas"""
+        raise NotImplementedError
+    
+    def needs_compaction(self) -> bool:
+        """Indica si conviene llamar a ``compact`` con un snapshot completo"""
+        return False
+    
+    def compact(self, snapshot: dict):
+        """Sustituir el estado persistido por un snapshot completo
 
-📍 *Comandos principales:*
-/start - Iniciar el bot
-/help - Ayuda completa
-/info - Información del bot
-/stats - Ver estadísticas
-/ask - Hacerme una pregunta
-/settings - Configuraciones
+        ``snapshot['users']`` son las columnas de ``UserTable.copy_columns``.
+        """
+    
+    def totals(self) -> Optional[Tuple[int, int, int]]:
+        """(usuarios, mensajes, comandos) persistidos, o None si no se soporta"""
+        return None
+    
+    def top_users(self, limit: int) -> Optional[List[UserStats]]:
+        """Usuarios más activos persistidos, o None si no se soporta"""
+        return None
+    
+    def close(self):
+        """Liberar recursos"""
 
-💡 *Tip:* También puedes enviarme cualquier mensaje y te responderé.
 
-⚡ *Versión:* 2.0.0
-📊 *Usuarios activos:* {len(analytics.user_stats) if analytics else 'N/A'}
-"""
+class JSONSnapshotReader:
+    """Lector incremental de snapshots JSON de analytics
+
+    Mantiene en memoria un bloque del fichero (más el valor en curso si
+    cruza el límite del bloque) y decodifica cada valor con ``raw_decode``,
+    así que la memoria no depende del tamaño del fichero.
+    """
     
-    # Crear teclado inline
-    keyboard = [
-        [
-            InlineKeyboardButton("📋 Comandos", callback_data="help"),
-            InlineKeyboardButton("ℹ️ Info", callback_data="info"),
-        ],
-        [
-            InlineKeyboardButton("📊 Estadísticas", callback_data="stats"),
-            InlineKeyboardButton("⚙️ Settings", callback_data="settings"),
-        ]
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    _whitespace = re.compile(r'[ \t\n\r]*')
     
-    await update.message.reply_text(
-        welcome_text,
-        parse_mode='Markdown',
-        reply_markup=reply_markup
-    )
+    def __init__(self, f, chunk_size: int = STATS_LOAD_CHUNK_SIZE):
+        self.f = f
+        self.chunk_size = chunk_size
+        self.bytes_read = 0
+        self.buf = ''
+        self.pos = 0
+        self.eof = False
+        self._decoder = json.JSONDecoder()
+        self._utf8 = codecs.getincrementaldecoder('utf-8')()
     
-    # Registrar en log
-    logger.info(f"Nuevo usuario: {user.id} - {user.username}")
+    def _fill(self):
+        chunk = self.f.read(self.chunk_size)
+        self.bytes_read += len(chunk)
+        self.eof = not chunk
+        self.buf = self.buf[self.pos:] + self._utf8.decode(chunk, final=self.eof)
+        self.pos = 0
+    
+    def _peek(self) -> str:
+        """Siguiente carácter significativo sin consumirlo ('' al final)"""
+        while True:
+            self.pos = self._whitespace.match(self.buf, self.pos).end()
+            if self.pos < len(self.buf) or self.eof:
+                return self.buf[self.pos:self.pos + 1]
+            self._fill()
+    
+    def _expect(self, chars: str) -> str:
+        """Consumir un carácter que debe ser uno de ``chars``"""
+        char = self._peek()
+        if not char or char not in chars:
+            raise ValueError(f"JSON inesperado cerca del byte {self.bytes_read}: se esperaba {chars!r}")
+        self.pos += 1
+        return char
+    
+    def _value(self):
+        """Decodificar el siguiente valor completo"""
+        # Sin espacios (snapshots compactos) no hace falta pasar por _peek
+        if self.pos >= len(self.buf) or self.buf[self.pos] in ' \t\n\r':
+            self._peek()
+        while True:
+            try:
+                value, end = self._decoder.raw_decode(self.buf, self.pos)
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+                self._fill()
+                continue
+            # Un número al final del bloque puede continuar en el siguiente
+            if end == len(self.buf) and not self.eof:
+                self._fill()
+                continue
+            self.pos = end
+            return value
+    
+    def items(self):
+        """Generar ``(clave, valor)`` de primer nivel; ``users`` se genera elemento a elemento"""
+        self._expect('{')
+        if self._peek() == '}':
+            return
+        while True:
+            key = self._value()
+            self._expect(':')
+            if key == 'users' and self._peek() == '[':
+                self._expect('[')
+                if self._peek() == ']':
+                    self._expect(']')
+                else:
+                    while True:
+                        yield key, self._value()
+                        if self.buf[self.pos:self.pos + 1] == ',':
+                            self.pos += 1
+                        elif self._expect(',]') == ']':
+                            break
+            else:
+                yield key, self._value()
+            if self._expect(',}') == '}':
+                return
 
-async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Manejador mejorado para /help"""
-    help_text = """
-📚 *AYUDA COMPLETA DEL BOT*
 
-📍 *COMANDOS PRINCIPALES:*
-/start - Iniciar el bot
-/help - Ver esta ayuda
-/info - Información técnica
-/stats - Estadísticas de uso
-/ask - Hacer una pregunta
-/feedback - Enviar feedback
-/settings - Configuración
+def _iso_to_epoch(value: str, hours: Dict[str, float]) -> float:
+    """``datetime.fromisoformat(value).timestamp()`` con caché por hora local
 
-🛠 *COMANDOS AVANZADOS:*
-/time - Hora actual
-/echo [texto] - Repetir texto
-/calc [expresión] - Calculadora básica
-/weather [ciudad] - Clima (próximamente)
+    Los snapshots guardan last_seen como ISO local sin zona
+    ('YYYY-MM-DDTHH:MM:SS[.ffffff]'); convertir a epoch la hora una sola vez
+    evita el coste de ``timestamp()`` (conversión de zona) por usuario.
+    """
+    if len(value) in (19, 26) and value[10] == 'T' and value[13] == ':':
+        hour = value[:13]
+        base = hours.get(hour)
+        if base is None:
+            base = hours[hour] = datetime.fromisoformat(hour + ':00').timestamp()
+        return base + int(value[14:16]) * 60 + float(value[17:])
+    return datetime.fromisoformat(value).timestamp()
 
-📱 *INTERACCIÓN:*
-- Responde a mensajes de texto
-- Soporta Markdown
-- Teclados inline
-- Conversaciones interactivas
 
-🔐 *SEGURIDAD:*
-- Logging detallado
-- Manejo de errores
-- Protección contra spam
-- Stats anónimas
+class BinarySnapshot:
+    """Snapshot binario de analytics: columnas de UserTable empaquetadas
 
-📧 *SOPORTE:*
-Para reportar problemas o sugerencias:
-/feedback [tu mensaje]
-"""
+    Cabecera ``struct`` (magic, log_seq, usuarios, tamaño de la actividad
+    diaria), la actividad diaria en JSON, las cuatro columnas numéricas como
+    arrays little-endian y los nombres en dos bloques UTF-8 separados por
+    NUL. Cargarlo son unas pocas ``frombytes`` y un ``split`` por columna:
+    sin trabajo por usuario aparte de internar los nombres.
+    """
     
-    await update.message.reply_text(help_text, parse_mode='Markdown')
-
-async def info(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Manejador mejorado para /info"""
-    app = context.application
+    MAGIC = b'TGSTATS1'
+    HEADER = struct.Struct('<8sqqq')
     
-    info_text = f"""
-🤖 *INFORMACIÓN DEL BOT*
-
-⚙️ *Tecnología:*
-- Python {app.__version__ if hasattr(app, '__version__') else '3.11+'}
-- python-telegram-bot v20.7
-- Arquitectura async/await
+    @staticmethod
+    def _le(typecode: str, column) -> bytes:
+        """Columna como bytes little-endian"""
+        if not isinstance(column, array) or sys.byteorder == 'big':
+            column = array(typecode, column)
+            if sys.byteorder == 'big':
+                column.byteswap()
+        return column.tobytes()
+    
+    @classmethod
+    def write(cls, f, snapshot: dict):
+        user_ids, usernames, first_names, message_counts, command_counts, last_seen = snapshot['users']
+        daily = json.dumps(snapshot['daily_stats'], separators=(',', ':')).encode('utf-8')
+        f.write(cls.HEADER.pack(cls.MAGIC, snapshot['log_seq'], len(user_ids), len(daily)))
+        f.write(daily)
+        for typecode, column in zip('qqqd', (user_ids, message_counts, command_counts, last_seen)):
+            f.write(cls._le(typecode, column))
+        for names in (usernames, first_names):
+            blob = '\0'.join(name.replace('\0', '') for name in names).encode('utf-8')
+            f.write(struct.pack('<q', len(blob)))
+            f.write(blob)
+    
+    @classmethod
+    def read(cls, f, progress: Optional[Callable[[float], None]] = None
+             ) -> Tuple['UserTable', Dict[str, int], int]:
+        magic, log_seq, count, daily_size = cls.HEADER.unpack(f.read(cls.HEADER.size))
+        if magic != cls.MAGIC:
+            raise ValueError("Snapshot binario con formato desconocido")
+        daily_stats = json.loads(f.read(daily_size))
+        
+        columns = []
+        for typecode in 'qqqd':
+            column = array(typecode)
+            column.fromfile(f, count)
+            if sys.byteorder == 'big':
+                column.byteswap()
+            columns.append(column)
+        if progress:
+            progress(0.5)
+        
+        names = []
+        for _ in range(2):
+            (size,) = struct.unpack('<q', f.read(8))
+            names.append(f.read(size).decode('utf-8').split('\0') if count else [])
+        
+        user_ids, message_counts, command_counts, last_seen = columns
+        table = UserTable.from_columns(user_ids, names[0], names[1], message_counts, command_counts, last_seen)
+        return table, daily_stats, log_seq
 
-📈 *Estadísticas:*
-- Bot ID: {app.bot.id if app.bot else 'N/A'}
-- Username: @{app.bot.username if app.bot else 'N/A'}
-- Desarrollado con ❤️
 
-🔧 *Características:*
-- Logging avanzado
-- Persistencia de datos
-- Analytics
-- Manejo de errores
-- Middleware personalizado
+class JSONAnalyticsStore(AnalyticsStore):
+    """Snapshot (``stats.json`` o ``stats.bin``) más log append-only de eventos
 
-🚀 *Despliegue:*
-- Docker compatible
-- GitHub Actions
-- Variables de entorno
-- Configuración modular
+    Cada bloque de eventos se añade al log, y cuando el log supera
+    ``compact_every`` líneas se compacta en un snapshot nuevo. Si el proceso
+    muere entre escribir el snapshot y truncar el log, el ``log_seq`` del
+    snapshot evita reaplicar eventos que ya incluye.
 
-📄 *Licencia:* MIT
-📧 *Soporte:* Usa /feedback
-"""
+    El snapshot se escribe en ``snapshot_format`` ("json" o "binary"); al
+    cargar se usa el del formato configurado o, si no existe, el del otro
+    (así se migra de uno a otro). El JSON se lee por bloques y se vuelca
+    directamente en una UserTable, sin construir la lista completa de dicts.
+    """
+    
+    _transient = ('_io_lock', '_log_file')
+    
+    def __init__(self, snapshot_path: str = STATS_FILE, log_path: str = STATS_LOG_FILE,
+                 compact_every: int = STATS_COMPACT_EVERY, binary_path: str = STATS_BINARY_FILE,
+                 snapshot_format: str = STATS_SNAPSHOT_FORMAT):
+        super().__init__()
+        self.snapshot_path = snapshot_path
+        self.binary_path = binary_path
+        if snapshot_format not in ('json', 'binary'):
+            logger.warning(f"Formato de snapshot desconocido '{snapshot_format}', usando json")
+            snapshot_format = 'json'
+        self.snapshot_format = snapshot_format
+        self.log_path = log_path
+        self.compact_every = compact_every
+        self._log_entries = 0
+        self._log_file = None
+    
+    def _snapshot_paths(self) -> List[str]:
+        """Rutas de snapshot por orden de preferencia (formato configurado primero)"""
+        if self.snapshot_format == 'binary':
+            return [self.binary_path, self.snapshot_path]
+        return [self.snapshot_path, self.binary_path]
+    
+    def has_data(self) -> bool:
+        """Si existe algún snapshot o log que cargar"""
+        return any(os.path.exists(path) for path in (*self._snapshot_paths(), self.log_path))
+    
+    def load(self, progress: Optional[Callable[[float], None]] = None, strict: bool = False
+             ) -> Tuple[Dict[int, UserStats], Dict[str, int], int]:
+        """Ver ``AnalyticsStore.load``; con ``strict`` un snapshot ilegible lanza la excepción"""
+        users = UserTable()
+        daily_stats: Dict[str, int] = defaultdict(int)
+        snapshot_seq = 0
+        path = next((path for path in self._snapshot_paths() if os.path.exists(path)), None)
+        try:
+            if path == self.binary_path:
+                with open(path, 'rb') as f:
+                    users, daily, snapshot_seq = BinarySnapshot.read(f, progress)
+                daily_stats.update(daily)
+            elif path is not None:
+                snapshot_seq = self._load_json(path, users, daily_stats, progress)
+        except Exception as e:
+            if strict:
+                raise
+            logger.error(f"Error cargando estadísticas: {e}")
+            users, daily_stats, snapshot_seq = UserTable(), defaultdict(int), 0
+        
+        last_seq = self._replay_log(users, daily_stats, snapshot_seq)
+        if progress:
+            progress(1.0)
+        return users, daily_stats, last_seq
     
-    await update.message.reply_text(info_text, parse_mode='Markdown')
+    @staticmethod
+    def _load_json(path: str, users: 'UserTable', daily_stats: Dict[str, int],
+                   progress: Optional[Callable[[float], None]] = None,
+                   stream: Optional[bool] = None) -> int:
+        """Leer ``stats.json`` añadiendo cada usuario a ``users``; devuelve log_seq
 
-async def stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Mostrar estadísticas de uso"""
-    analytics = context.bot_data.get('analytics')
+        El lector incremental no es más rápido que ``json.load`` (algo más
+        lento en ficheros pequeños), solo acota el pico de memoria; por eso
+        se usa únicamente a partir de ``STATS_STREAM_MIN_BYTES`` salvo que
+        ``stream`` lo fuerce.
+        """
+        size = os.path.getsize(path) or 1
+        if stream is None:
+            stream = size >= STATS_STREAM_MIN_BYTES
+        hours: Dict[str, float] = {}
+        snapshot_seq = 0
+        with open(path, 'rb') as f:
+            if stream:
+                reader = JSONSnapshotReader(f)
+                items = reader.items()
+            else:
+                data = json.load(f)
+                items = itertools.chain(
+                    (('users', user_data) for user_data in data.get('users', [])),
+                    (item for item in data.items() if item[0] != 'users'),
+                )
+            for key, value in items:
+                if key == 'users':
+                    last_seen = value['last_seen']
+                    users.add(
+                        value['user_id'],
+                        value['username'],
+                        value['first_name'],
+                        value['message_count'],
+                        value['command_count'],
+                        _iso_to_epoch(last_seen, hours) if last_seen else 0.0,
+                    )
+                    if progress and stream and len(users) % 10000 == 0:
+                        progress(reader.bytes_read / size)
+                elif key == 'daily_stats':
+                    daily_stats.update(value)
+                elif key == 'log_seq':
+                    snapshot_seq = value
+        return snapshot_seq
     
-    if not analytics or not analytics.user_stats:
-        await update.message.reply_text("📊 *Estadísticas no disponibles aún*", parse_mode='Markdown')
-        return
+    def _replay_log(self, users: Dict[int, UserStats], daily_stats: Dict[str, int], snapshot_seq: int) -> int:
+        """Aplicar los eventos del log posteriores al snapshot"""
+        last_seq = snapshot_seq
+        replayed = 0
+        try:
+            if not os.path.exists(self.log_path):
+                return last_seq
+            with open(self.log_path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        event = json.loads(line)
+                    except ValueError:
+                        # Línea incompleta por un corte durante la escritura
+                        continue
+                    self._log_entries += 1
+                    if event['s'] <= snapshot_seq:
+                        continue
+                    self._apply_event(users, daily_stats, event)
+                    last_seq = max(last_seq, event['s'])
+                    replayed += 1
+        except Exception as e:
+            logger.error(f"Error reaplicando log de estadísticas: {e}")
+        logger.info(f"Log de estadísticas: {replayed} eventos reaplicados")
+        return last_seq
     
-    total_messages = sum(u.message_count for u in analytics.user_stats.values())
-    total_commands = sum(u.command_count for u in analytics.user_stats.values())
-    active_users = len(analytics.user_stats)
+    @staticmethod
+    def _apply_event(users: Dict[int, UserStats], daily_stats: Dict[str, int], event: dict):
+        """Aplicar un evento del log al estado en memoria"""
+        last_seen = datetime.fromtimestamp(event['t'])
+        stats = users.get(event['u'])
+        if stats is None:
+            users[event['u']] = UserStats(
+                user_id=event['u'],
+                username=event.get('n', 'Sin username'),
+                first_name=event.get('f', 'Sin nombre'),
+            )
+            # En una UserTable el objeto guardado es una copia: seguir con la vista
+            stats = users[event['u']]
+        stats.message_count += event.get('m', 0)
+        stats.command_count += event.get('c', 0)
+        stats.last_seen = last_seen
+        daily_stats[last_seen.strftime('%Y-%m-%d')] += event.get('i', 1)
     
-    # Top 5 usuarios más activos
-    top_users = sorted(
-        analytics.user_stats.values(),
-        key=lambda x: x.message_count + x.command_count,
-        reverse=True
-    )[:5]
+    def write_events(self, events: List[dict]):
+        """Añadir un bloque de eventos al log; coste proporcional al bloque, no al total"""
+        if not events:
+            return
+        with self._io_lock:
+            try:
+                if self._log_file is None:
+                    self._log_file = open(self.log_path, 'a', encoding='utf-8')
+                self._log_file.write(''.join(
+                    json.dumps(event, ensure_ascii=False, separators=(',', ':')) + '\n'
+                    for event in events
+                ))
+                self._log_file.flush()
+                self._log_entries += len(events)
+            except Exception as e:
+                logger.error(f"Error escribiendo log de estadísticas: {e}")
     
-    stats_text = f"""
-📊 *ESTADÍSTICAS DEL BOT*
+    def needs_compaction(self) -> bool:
+        return self._log_entries >= self.compact_every
+    
+    def compact(self, snapshot: dict):
+        """Escribir el snapshot de forma atómica y truncar el log"""
+        with self._io_lock:
+            try:
+                if self.snapshot_format == 'binary':
+                    self._write_binary(snapshot)
+                else:
+                    self._write_json(snapshot)
+                # El snapshot del otro formato queda obsoleto (el log se va a truncar)
+                stale = self.snapshot_path if self.snapshot_format == 'binary' else self.binary_path
+                if os.path.exists(stale):
+                    os.remove(stale)
+            except Exception as e:
+                logger.error(f"Error guardando estadísticas: {e}")
+                return
+            
+            # El snapshot ya cubre todos los eventos: se puede vaciar el log
+            try:
+                if self._log_file is not None:
+                    self._log_file.close()
+                self._log_file = open(self.log_path, 'w', encoding='utf-8')
+                self._log_entries = 0
+            except Exception as e:
+                self._log_file = None
+                logger.error(f"Error truncando log de estadísticas: {e}")
+    
+    def _write_json(self, snapshot: dict):
+        data = {
+            'users': [
+                {
+                    'user_id': user_id,
+                    'username': username,
+                    'first_name': first_name,
+                    'message_count': message_count,
+                    'command_count': command_count,
+                    'last_seen': datetime.fromtimestamp(last_seen).isoformat() if last_seen else None
+                }
+                for user_id, username, first_name, message_count, command_count, last_seen
+                in zip(*snapshot['users'])
+            ],
+            'daily_stats': snapshot['daily_stats'],
+            'log_seq': snapshot['log_seq'],
+            'last_updated': datetime.now().isoformat()
+        }
+        tmp_path = self.snapshot_path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(data, f, ensure_ascii=False, separators=(',', ':'))
+        os.replace(tmp_path, self.snapshot_path)
+    
+    def _write_binary(self, snapshot: dict):
+        tmp_path = self.binary_path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            BinarySnapshot.write(f, snapshot)
+        os.replace(tmp_path, self.binary_path)
+    
+    def close(self):
+        with self._io_lock:
+            if self._log_file is not None:
+                self._log_file.close()
+                self._log_file = None
 
-👥 *Usuarios:*
-- Total usuarios: {active_users}
-- Mensajes totales: {total_messages}
-- Comandos totales: {total_commands}
 
-🏆 *Top 5 usuarios:*
-"""
+class SQLiteAnalyticsStore(AnalyticsStore):
+    """Almacenamiento SQLite (modo WAL) con upserts por lotes
+
+    Los totales se mantienen en una fila propia (actualizada en la misma
+    transacción que los upserts) y el ranking usa un índice sobre la
+    actividad total, así que ``totals`` y ``top_users`` no recorren la tabla.
+    El número de usuarios lo sube un trigger AFTER INSERT, que no salta
+    cuando el upsert actualiza una fila existente: si varios workers ven al
+    mismo usuario como nuevo, se cuenta una vez.
+    """
     
-    for i, user in enumerate(top_users, 1):
-        last_seen = user.last_seen.strftime('%Y-%m-%d %H:%M') if user.last_seen else 'Nunca'
-        stats_text += f"{i}. {user.first_name} (@{user.username})\n"
-        stats_text += f"   📨 Msgs: {user.message_count} | ⚡ Cmds: {user.command_count}\n"
-        stats_text += f"   👀 Visto: {last_seen}\n"
+    _transient = ('_io_lock', '_conn')
+    
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS users (
+            user_id INTEGER PRIMARY KEY,
+            username TEXT NOT NULL,
+            first_name TEXT NOT NULL,
+            message_count INTEGER NOT NULL DEFAULT 0,
+            command_count INTEGER NOT NULL DEFAULT 0,
+            total INTEGER NOT NULL DEFAULT 0,
+            last_seen REAL
+        );
+        CREATE INDEX IF NOT EXISTS idx_users_total ON users (total DESC);
+        CREATE TABLE IF NOT EXISTS daily_stats (
+            day TEXT PRIMARY KEY,
+            count INTEGER NOT NULL DEFAULT 0
+        );
+        CREATE TABLE IF NOT EXISTS totals (
+            id INTEGER PRIMARY KEY CHECK (id = 0),
+            users INTEGER NOT NULL,
+            messages INTEGER NOT NULL,
+            commands INTEGER NOT NULL
+        );
+        INSERT OR IGNORE INTO totals (id, users, messages, commands) VALUES (0, 0, 0, 0);
+        CREATE TRIGGER IF NOT EXISTS users_count AFTER INSERT ON users
+        BEGIN
+            UPDATE totals SET users = users + 1 WHERE id = 0;
+        END;
+    """
+    
+    UPSERT_USER = """
+        INSERT INTO users (user_id, username, first_name, message_count, command_count, total, last_seen)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+        ON CONFLICT (user_id) DO UPDATE SET
+            message_count = message_count + excluded.message_count,
+            command_count = command_count + excluded.command_count,
+            total = total + excluded.total,
+            last_seen = excluded.last_seen
+    """
+    
+    UPSERT_DAY = """
+        INSERT INTO daily_stats (day, count) VALUES (?, ?)
+        ON CONFLICT (day) DO UPDATE SET count = count + excluded.count
+    """
+    
+    def __init__(self, path: str = STATS_DB_FILE):
+        super().__init__()
+        self.path = path
+        self._conn = None
+    
+    def import_json(self, source: 'JSONAnalyticsStore') -> int:
+        """Importar una sola vez el snapshot y el log JSON si la base está vacía
+
+        Devuelve los usuarios importados (0 si la base ya tenía datos o no hay
+        nada que importar). Los errores se propagan: arrancar con la base vacía
+        pondría /stats a cero sin avisar.
+        """
+        if not source.has_data():
+            return 0
+        with self._io_lock:
+            conn = self._connection()
+            if conn.execute("SELECT EXISTS (SELECT 1 FROM users)").fetchone()[0]:
+                return 0
+            users, daily_stats, _ = source.load(strict=True)
+            if not isinstance(users, UserTable):
+                users = UserTable.from_records(users.values())
+            rows = (
+                (user_id, username, first_name, messages, commands, messages + commands, last_seen or None)
+                for user_id, username, first_name, messages, commands, last_seen in zip(
+                    users.user_ids, users.usernames, users.first_names,
+                    users.message_counts, users.command_counts, users.last_seen)
+            )
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                # Otro proceso pudo importar mientras se leía el JSON
+                if conn.execute("SELECT EXISTS (SELECT 1 FROM users)").fetchone()[0]:
+                    conn.execute("ROLLBACK")
+                    return 0
+                conn.executemany(
+                    "INSERT INTO users (user_id, username, first_name, message_count, command_count, total, "
+                    "last_seen) VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+                conn.executemany(self.UPSERT_DAY, daily_stats.items())
+                conn.execute(
+                    "UPDATE totals SET messages = messages + ?, commands = commands + ? WHERE id = 0",
+                    (sum(users.message_counts), sum(users.command_counts))
+                )
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+        return len(users)
+    
+    def _connection(self):
+        if self._conn is None:
+            import sqlite3
+            # El volcado se hace desde hilos del pool de asyncio
+            self._conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.executescript(self.SCHEMA)
+        return self._conn
+    
+    def load(self, progress: Optional[Callable[[float], None]] = None
+             ) -> Tuple[Dict[int, UserStats], Dict[str, int], int]:
+        users = UserTable()
+        daily_stats: Dict[str, int] = defaultdict(int)
+        try:
+            with self._io_lock:
+                conn = self._connection()
+                (total,) = conn.execute("SELECT users FROM totals WHERE id = 0").fetchone()
+                for user_id, username, first_name, message_count, command_count, last_seen in conn.execute(
+                    "SELECT user_id, username, first_name, message_count, command_count, last_seen FROM users"
+                ):
+                    users.add(user_id, username, first_name, message_count, command_count, last_seen or 0.0)
+                    if progress and len(users) % 10000 == 0:
+                        progress(len(users) / max(total, 1))
+                daily_stats.update(conn.execute("SELECT day, count FROM daily_stats"))
+        except Exception as e:
+            logger.error(f"Error cargando estadísticas de SQLite: {e}")
+        if progress:
+            progress(1.0)
+        return users, daily_stats, 0
+    
+    def write_events(self, events: List[dict]):
+        """Aplicar un bloque de deltas en una única transacción"""
+        if not events:
+            return
+        user_rows = []
+        days: Dict[str, int] = defaultdict(int)
+        messages = commands = 0
+        for event in events:
+            m, c = event.get('m', 0), event.get('c', 0)
+            messages += m
+            commands += c
+            user_rows.append((
+                event['u'],
+                event.get('n', 'Sin username'),
+                event.get('f', 'Sin nombre'),
+                m, c, m + c,
+                event['t'],
+            ))
+            days[datetime.fromtimestamp(event['t']).strftime('%Y-%m-%d')] += event.get('i', 1)
+        
+        with self._io_lock:
+            try:
+                conn = self._connection()
+                conn.execute("BEGIN IMMEDIATE")
+                try:
+                    conn.executemany(self.UPSERT_USER, user_rows)
+                    conn.executemany(self.UPSERT_DAY, days.items())
+                    conn.execute(
+                        "UPDATE totals SET messages = messages + ?, commands = commands + ? WHERE id = 0",
+                        (messages, commands)
+                    )
+                    conn.execute("COMMIT")
+                except Exception:
+                    conn.execute("ROLLBACK")
+                    raise
+            except Exception as e:
+                logger.error(f"Error escribiendo estadísticas en SQLite: {e}")
+    
+    def totals(self) -> Optional[Tuple[int, int, int]]:
+        with self._io_lock:
+            return tuple(self._connection().execute(
+                "SELECT users, messages, commands FROM totals WHERE id = 0"
+            ).fetchone())
+    
+    def top_users(self, limit: int) -> Optional[List[UserStats]]:
+        with self._io_lock:
+            rows = self._connection().execute(
+                "SELECT user_id, username, first_name, message_count, command_count, last_seen "
+                "FROM users ORDER BY total DESC LIMIT ?",
+                (limit,)
+            ).fetchall()
+        return [
+            UserStats(
+                user_id=user_id,
+                username=username,
+                first_name=first_name,
+                message_count=message_count,
+                command_count=command_count,
+                last_seen=datetime.fromtimestamp(last_seen) if last_seen else None
+            )
+            for user_id, username, first_name, message_count, command_count, last_seen in rows
+        ]
+    
+    def close(self):
+        with self._io_lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+
+def migrate_analytics(backend: str = ANALYTICS_BACKEND) -> bool:
+    """Migración única de stats.json/stats.bin/log a SQLite antes de arrancar
+
+    Devuelve False si la migración falla: el bot no debe arrancar con las
+    estadísticas a cero.
+    """
+    if backend != 'sqlite':
+        return True
+    store = SQLiteAnalyticsStore()
+    try:
+        imported = store.import_json(JSONAnalyticsStore())
+    except Exception as e:
+        logger.error(f"Error migrando estadísticas JSON a SQLite ({STATS_DB_FILE}): {e}. "
+                     f"Revisa {STATS_FILE}, {STATS_BINARY_FILE} y {STATS_LOG_FILE} o usa ANALYTICS_BACKEND=json")
+        return False
+    finally:
+        store.close()
+    if imported:
+        logger.info(f"📦 {imported} usuarios migrados de {STATS_FILE} a {STATS_DB_FILE}")
+    return True
+
+
+def create_analytics_store(backend: str = ANALYTICS_BACKEND) -> AnalyticsStore:
+    """Crear el backend de analytics configurado (``json`` por defecto)"""
+    if backend == 'sqlite':
+        return SQLiteAnalyticsStore()
+    if backend != 'json':
+        logger.warning(f"Backend de analytics desconocido '{backend}', usando json")
+    return JSONAnalyticsStore()
+
+# ============================================================================
+# MIDDLEWARE DE ANALYTICS
+# ============================================================================
+
+class RollingCounter:
+    """Contador en anillo: ``size`` cubetas indexadas por número absoluto de cubeta
+
+    Cada ranura guarda a qué cubeta pertenece su cuenta; si al escribir la
+    ranura tiene una cubeta antigua se reinicia (invalidación perezosa), así
+    que no hace falta ningún barrido periódico.
+    """
+    
+    __slots__ = ('size', 'counts', 'buckets')
+    
+    def __init__(self, size: int):
+        self.size = size
+        self.counts = array('q', [0]) * size
+        self.buckets = array('q', [-1]) * size
+    
+    def add(self, bucket: int, n: int = 1):
+        slot = bucket % self.size
+        if self.buckets[slot] != bucket:
+            self.buckets[slot] = bucket
+            self.counts[slot] = 0
+        self.counts[slot] += n
+    
+    def get(self, bucket: int) -> int:
+        slot = bucket % self.size
+        return self.counts[slot] if self.buckets[slot] == bucket else 0
+    
+    def items(self):
+        """Pares (cubeta, cuenta) vigentes, en orden cronológico"""
+        return sorted(
+            (bucket, count) for bucket, count in zip(self.buckets, self.counts) if bucket >= 0
+        )
+
+class ActivityHistogram:
+    """Actividad por minuto, hora y día en anillos de tamaño fijo
+
+    ``record`` solo hace aritmética entera sobre el timestamp (hora local):
+    nada de formatear fechas en el camino caliente. Además lleva contadores
+    por comando y por tipo de handler, acotados a ``MAX_TRACKED_COMMANDS``
+    nombres distintos.
+    """
+    
+    def __init__(self, minutes: int = ACTIVITY_MINUTE_BUCKETS, hours: int = ACTIVITY_HOUR_BUCKETS,
+                 days: int = ACTIVITY_DAY_BUCKETS):
+        self.minutes = RollingCounter(minutes)
+        self.hours = RollingCounter(hours)
+        self.days = RollingCounter(days)
+        self.commands: Dict[str, int] = defaultdict(int)
+        self.handlers: Dict[str, int] = defaultdict(int)
+        self._utc_offset = 0
+        self._offset_hour = None
+    
+    def _local(self, timestamp: float) -> int:
+        """Segundos locales desde epoch; el offset UTC se recalcula una vez por hora"""
+        hour = int(timestamp) // 3600
+        if hour != self._offset_hour:
+            self._offset_hour = hour
+            self._utc_offset = time.localtime(timestamp).tm_gmtoff
+        return int(timestamp) + self._utc_offset
+    
+    def record(self, timestamp: float, n: int = 1):
+        """Registrar ``n`` interacciones en el instante ``timestamp``"""
+        local = self._local(timestamp)
+        self.minutes.add(local // 60, n)
+        self.hours.add(local // 3600, n)
+        self.days.add(local // 86400, n)
+    
+    def count_update(self, update: Update):
+        """Contar un update por tipo de handler y, si es un comando, por nombre"""
+        if update.callback_query:
+            self.handlers['callback_query'] += 1
+        elif update.inline_query:
+            self.handlers['inline_query'] += 1
+        elif update.message and update.message.text and update.message.text.startswith('/'):
+            self.handlers['command'] += 1
+            name = update.message.text.split(maxsplit=1)[0][1:].split('@', 1)[0].lower()
+            if name not in self.commands and len(self.commands) >= MAX_TRACKED_COMMANDS:
+                name = '_otros'
+            self.commands[name] += 1
+        elif update.message:
+            self.handlers['message'] += 1
+        else:
+            self.handlers['other'] += 1
+    
+    # ------------------------------------------------------------------
+    # Consultas
+    # ------------------------------------------------------------------
+    
+    def today(self) -> int:
+        return self.days.get(self._local(time.time()) // 86400)
+    
+    def rate_per_minute(self, window: int = 5) -> float:
+        """Media de interacciones por minuto en los últimos ``window`` minutos completos"""
+        window = min(window, self.minutes.size - 1)
+        current = self._local(time.time()) // 60
+        return sum(self.minutes.get(current - i) for i in range(1, window + 1)) / window
+    
+    def peak_hour(self, window: int = 24) -> Optional[Tuple[int, int]]:
+        """(hora del día, interacciones) de la hora con más actividad en las últimas ``window`` horas"""
+        current = self._local(time.time()) // 3600
+        window = min(window, self.hours.size)
+        best = max(((self.hours.get(current - i), current - i) for i in range(window)), default=(0, 0))
+        if not best[0]:
+            return None
+        return best[1] % 24, best[0]
+    
+    def daily(self) -> Dict[str, int]:
+        """Actividad por día como {'YYYY-MM-DD': n}, solo dentro de la retención"""
+        epoch = date(1970, 1, 1)
+        return {
+            (epoch + timedelta(days=day)).isoformat(): count
+            for day, count in self.days.items()
+        }
+    
+    def load_daily(self, daily_stats: Dict[str, int]):
+        """Cargar actividad diaria persistida (los días fuera de la retención se descartan)"""
+        epoch = date(1970, 1, 1)
+        current = self._local(time.time()) // 86400
+        for day, count in daily_stats.items():
+            try:
+                index = (date.fromisoformat(day) - epoch).days
+            except ValueError:
+                continue
+            if current - self.days.size < index <= current:
+                self.days.add(index, count)
+
+class TopUsersTracker:
+    """Ranking acotado de los K usuarios con más actividad
+
+    Los contadores solo crecen, así que un usuario fuera del ranking solo
+    puede entrar cuando su total supera al último del ranking: basta con
+    comparar contra ese mínimo en cada actualización (O(1) en el caso común,
+    O(K) cuando el ranking cambia) y el resultado es exacto.
+    """
+    
+    def __init__(self, capacity: int = TOP_USERS_CAPACITY):
+        self.capacity = capacity
+        self._members: Dict[int, int] = {}
+        self._min_user: Optional[int] = None
+        self._min_total = 0
+    
+    def rebuild(self, totals):
+        """Reconstruir a partir de pares (user_id, total)"""
+        self._members = dict(heapq.nlargest(self.capacity, totals, key=lambda item: item[1]))
+        self._refresh_min()
+    
+    def _refresh_min(self):
+        if len(self._members) < self.capacity:
+            self._min_user, self._min_total = None, 0
+        else:
+            self._min_user = min(self._members, key=self._members.__getitem__)
+            self._min_total = self._members[self._min_user]
+    
+    def update(self, user_id: int, total: int):
+        """Notificar el nuevo total de un usuario"""
+        if user_id in self._members:
+            self._members[user_id] = total
+            if user_id == self._min_user:
+                self._refresh_min()
+        elif len(self._members) < self.capacity:
+            self._members[user_id] = total
+            self._refresh_min()
+        elif total > self._min_total:
+            del self._members[self._min_user]
+            self._members[user_id] = total
+            self._refresh_min()
+    
+    def top(self, limit: int) -> List[int]:
+        """IDs de los ``limit`` usuarios más activos, de mayor a menor"""
+        return sorted(self._members, key=self._members.__getitem__, reverse=True)[:limit]
+
+
+class AnalyticsMiddleware:
+    """Middleware para tracking de uso
+
+    ``track_user`` solo actualiza memoria y agrupa los deltas de cada usuario
+    como pendientes; ``flush`` los entrega al backend de almacenamiento en un
+    único bloque (desde un job periódico, fuera del event loop) y, si el
+    backend lo pide, le pasa un snapshot completo para compactar.
+
+    Los totales y el ranking se mantienen de forma incremental, así que
+    ``get_totals`` es O(1) y ``get_top_users`` es O(K). Con ``shared`` (varios
+    procesos escribiendo en el mismo backend SQLite) ambos se leen del
+    backend, más los deltas de este proceso aún no volcados; desde el event
+    loop se usan las variantes ``*_async``, que hacen esa lectura en un hilo.
+
+    Con ``load=False`` arranca vacío y ``load_in_background`` lee el backend
+    en un hilo: mientras tanto se registra la actividad normalmente (las
+    cifras son provisionales) y no se vuelca nada; al terminar, lo
+    registrado se suma a lo cargado.
+    """
+    
+    def __init__(self, store: Optional[AnalyticsStore] = None, max_dirty: int = STATS_FLUSH_MAX_DIRTY,
+                 shared: bool = ANALYTICS_SHARED, load: bool = True):
+        self.user_stats = UserTable()
+        self.activity = ActivityHistogram()
+        self.store = store if store is not None else create_analytics_store()
+        self.max_dirty = max_dirty
+        self._seq = 0
+        self._pending: Dict[int, dict] = {}
+        # Sumas de los deltas de ``_pending`` (usuarios nuevos, mensajes, comandos) para totales en O(1)
+        self.pending_new_users = 0
+        self.pending_messages = 0
+        self.pending_commands = 0
+        self._flush_scheduled = False
+        self.total_messages = 0
+        self.total_commands = 0
+        self.top_tracker = TopUsersTracker()
+        self.shared = shared
+        # Se incrementa con cada cambio; invalida las vistas cacheadas de /stats
+        self.version = 0
+        # Hasta que termina la carga no se vuelca nada (``_seq`` aún no es válido)
+        self.loaded = False
+        self.load_progress = 0.0
+        self._load_task: Optional[asyncio.Task] = None
+        if load:
+            self.load_stats()
+    
+    def load_stats(self):
+        """Cargar estadísticas desde el backend (síncrono)"""
+        self._apply_loaded(*self._read_store())
+    
+    def start_loading(self):
+        """Lanzar ``load_in_background`` como tarea del event loop en curso"""
+        self._load_task = asyncio.get_running_loop().create_task(self.load_in_background())
+    
+    async def load_in_background(self):
+        """Cargar el backend en un hilo sin bloquear el event loop"""
+        try:
+            loaded = await asyncio.to_thread(self._read_store)
+        except Exception as e:
+            logger.error(f"Error cargando estadísticas: {e}")
+            loaded = (UserTable(), {}, 0, 0, 0, TopUsersTracker(self.top_tracker.capacity))
+        self._apply_loaded(*loaded)
+    
+    async def wait_loaded(self):
+        """Esperar a que termine la carga en segundo plano, si hay una en curso"""
+        if self._load_task is not None:
+            await self._load_task
+    
+    def _report_progress(self, fraction: float):
+        """Progreso de la carga (llamado desde el hilo que carga); se registra cada 25%"""
+        if int(fraction * 4) > int(self.load_progress * 4) and fraction < 1.0:
+            logger.info(f"Cargando estadísticas: {fraction:.0%}")
+        self.load_progress = fraction
+    
+    def _read_store(self):
+        """Leer el backend y construir tabla, totales y ranking (apto para otro hilo)"""
+        users, daily_stats, seq = self.store.load(progress=self._report_progress)
+        table = users if isinstance(users, UserTable) else UserTable.from_records(users.values())
+        del users
+        top_tracker = TopUsersTracker(self.top_tracker.capacity)
+        top_tracker.rebuild(zip(table.user_ids, map(int.__add__, table.message_counts, table.command_counts)))
+        return table, daily_stats, seq, sum(table.message_counts), sum(table.command_counts), top_tracker
+    
+    def _apply_loaded(self, table: UserTable, daily_stats: Dict[str, int], seq: int,
+                      total_messages: int, total_commands: int, top_tracker: 'TopUsersTracker'):
+        """Sustituir el estado provisional por el cargado, sumando la actividad registrada entretanto"""
+        provisional = self.user_stats
+        for row, user_id in enumerate(provisional.user_ids):
+            messages, commands = provisional.message_counts[row], provisional.command_counts[row]
+            loaded_row = table.row(user_id)
+            if loaded_row is None:
+                loaded_row = table.add(user_id, provisional.usernames[row], provisional.first_names[row])
+            table.message_counts[loaded_row] += messages
+            table.command_counts[loaded_row] += commands
+            table.last_seen[loaded_row] = max(table.last_seen[loaded_row], provisional.last_seen[row])
+            total_messages += messages
+            total_commands += commands
+            top_tracker.update(user_id, table.message_counts[loaded_row] + table.command_counts[loaded_row])
+        
+        self.user_stats = table
+        self.activity.load_daily(daily_stats)
+        self._seq = seq
+        self.total_messages = total_messages
+        self.total_commands = total_commands
+        self.top_tracker = top_tracker
+        self.loaded = True
+        self.version += 1
+        logger.info(f"Estadísticas cargadas: {len(self.user_stats)} usuarios")
+    
+    # ------------------------------------------------------------------
+    # Consultas
+    # ------------------------------------------------------------------
+    
+    @property
+    def daily_stats(self) -> Dict[str, int]:
+        """Actividad por día ('YYYY-MM-DD' → interacciones) dentro de la retención"""
+        return self.activity.daily()
+    
+    @property
+    def cache_version(self):
+        """Versión para las vistas cacheadas
+
+        En modo compartido otros procesos cambian el backend sin tocar
+        ``version``, así que cambia también en cada intervalo de volcado.
+        """
+        if self.shared:
+            return self.version, int(time.time() // STATS_FLUSH_INTERVAL)
+        return self.version
+    
+    def _with_pending(self, stored: Tuple[int, int, int]) -> Tuple[int, int, int]:
+        """Totales del backend más los deltas de este proceso que aún no están en él
+
+        Un usuario nuevo aquí puede haberlo escrito ya otro worker: hasta el
+        próximo volcado cuenta de más, y al volcarlo el backend no lo duplica
+        (el contador de usuarios solo sube cuando el upsert inserta la fila).
+        """
+        users, messages, commands = stored
+        return (users + self.pending_new_users, messages + self.pending_messages,
+                commands + self.pending_commands)
+    
+    def get_totals(self) -> Tuple[int, int, int]:
+        """(usuarios, mensajes, comandos) en O(1)"""
+        # Durante la carga el backend está ocupado: se devuelven las cifras provisionales
+        if self.shared and self.loaded:
+            stored = self.store.totals()
+            if stored is not None:
+                return self._with_pending(stored)
+        return len(self.user_stats), self.total_messages, self.total_commands
+    
+    async def get_totals_async(self) -> Tuple[int, int, int]:
+        """``get_totals`` sin bloquear el event loop (la lectura del backend compartido va a un hilo)"""
+        if self.shared and self.loaded:
+            stored = await asyncio.to_thread(self.store.totals)
+            if stored is not None:
+                return self._with_pending(stored)
+        return len(self.user_stats), self.total_messages, self.total_commands
+    
+    def get_top_users(self, limit: int = 5) -> List[UserStats]:
+        """Usuarios más activos en O(K)"""
+        if self.shared and self.loaded:
+            stored = self.store.top_users(limit)
+            if stored is not None:
+                return stored
+        return self._local_top_users(limit)
+    
+    async def get_top_users_async(self, limit: int = 5) -> List[UserStats]:
+        """``get_top_users`` sin bloquear el event loop"""
+        if self.shared and self.loaded:
+            stored = await asyncio.to_thread(self.store.top_users, limit)
+            if stored is not None:
+                return stored
+        return self._local_top_users(limit)
+    
+    def _local_top_users(self, limit: int) -> List[UserStats]:
+        if limit > self.top_tracker.capacity:
+            return sorted(
+                self.user_stats.values(),
+                key=lambda x: x.message_count + x.command_count,
+                reverse=True
+            )[:limit]
+        return [self.user_stats[user_id] for user_id in self.top_tracker.top(limit)]
+    
+    # ------------------------------------------------------------------
+    # Volcado a disco
+    # ------------------------------------------------------------------
+    
+    @property
+    def pending_users(self) -> int:
+        """Número de usuarios con cambios aún no escritos"""
+        return len(self._pending)
+    
+    def _take_pending(self) -> List[dict]:
+        """Extraer los deltas pendientes asignándoles número de secuencia (en el event loop)"""
+        pending, self._pending = self._pending, {}
+        self.pending_new_users = self.pending_messages = self.pending_commands = 0
+        events = list(pending.values())
+        for event in events:
+            self._seq += 1
+            event['s'] = self._seq
+        return events
+    
+    def _take_snapshot(self) -> dict:
+        """Capturar el estado en memoria de forma consistente con ``_seq``"""
+        return {
+            'users': self.user_stats.copy_columns(),
+            'daily_stats': self.activity.daily(),
+            'log_seq': self._seq,
+        }
+    
+    def flush(self):
+        """Volcar los cambios pendientes de forma síncrona (shutdown, señales)"""
+        if not self.loaded:
+            return
+        self.store.write_events(self._take_pending())
+        if self.store.needs_compaction():
+            self.store.compact(self._take_snapshot())
+    
+    async def flush_async(self):
+        """Volcar los cambios pendientes sin bloquear el event loop"""
+        self._flush_scheduled = False
+        if not self.loaded:
+            return
+        events = self._take_pending()
+        if events:
+            await asyncio.to_thread(self.store.write_events, events)
+        if self.store.needs_compaction():
+            await asyncio.to_thread(self.store.compact, self._take_snapshot())
+    
+    def save_stats(self):
+        """Volcar lo pendiente y compactar con un snapshot completo"""
+        if not self.loaded:
+            return
+        self.store.write_events(self._take_pending())
+        self.store.compact(self._take_snapshot())
+    
+    def close(self):
+        """Volcado final y cierre del backend"""
+        self.flush()
+        self.store.close()
+    
+    def _schedule_flush(self):
+        """Adelantar el volcado cuando hay demasiados usuarios pendientes"""
+        if self._flush_scheduled or not self.loaded:
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            self.flush()
+            return
+        self._flush_scheduled = True
+        loop.create_task(self.flush_async())
+    
+    def track_user(self, user, messages: int = 0, commands: int = 0):
+        """Registrar actividad de usuario"""
+        timestamp = time.time()
+        self.activity.record(timestamp)
+        
+        event = self._pending.get(user.id)
+        if event is None:
+            event = self._pending[user.id] = {'u': user.id}
+        else:
+            event['i'] = event.get('i', 1) + 1
+        
+        table = self.user_stats
+        row = table.row(user.id)
+        if row is None:
+            row = table.add(
+                user.id,
+                user.username or 'Sin username',
+                user.first_name or 'Sin nombre',
+            )
+            event['n'] = table.usernames[row]
+            event['f'] = table.first_names[row]
+            self.pending_new_users += 1
+        
+        table.last_seen[row] = timestamp
+        if messages or commands:
+            table.message_counts[row] += messages
+            table.command_counts[row] += commands
+            self.total_messages += messages
+            self.total_commands += commands
+            self.pending_messages += messages
+            self.pending_commands += commands
+            self.top_tracker.update(user.id, table.message_counts[row] + table.command_counts[row])
+        
+        if messages:
+            event['m'] = event.get('m', 0) + messages
+        if commands:
+            event['c'] = event.get('c', 0) + commands
+        event['t'] = timestamp
+        self.version += 1
+        
+        if len(self._pending) >= self.max_dirty:
+            self._schedule_flush()
+    
+    def track_message(self, user):
+        """Registrar mensaje de usuario"""
+        self.track_user(user, messages=1)
+    
+    def track_command(self, user):
+        """Registrar comando de usuario"""
+        self.track_user(user, commands=1)
+
+# ============================================================================
+# ALMACÉN DE FEEDBACK
+# ============================================================================
+
+class FeedbackStore:
+    """Almacén append-only de feedback (JSONL) con un único escritor
+
+    Los handlers encolan entradas con ``submit`` y esperan a que se escriban;
+    una sola tarea consume la cola, agrupa lo que haya pendiente y lo escribe
+    en un hilo, así que no hay carreras entre envíos simultáneos ni E/S en
+    el event loop. El fichero rota por tamaño (``feedback.jsonl.1`` es el
+    más reciente de los antiguos) e ``iter_feedback`` lo recorre en streaming.
+    """
+    
+    # Atributos ligados al event loop que no se copian al serializar
+    _transient = ('_queue', '_writer_task')
+    
+    def __init__(self, path: str = FEEDBACK_FILE, max_bytes: int = FEEDBACK_MAX_BYTES,
+                 backup_count: int = FEEDBACK_BACKUP_COUNT, legacy_path: str = FEEDBACK_LEGACY_FILE):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self.legacy_path = legacy_path
+        self._queue: Optional[asyncio.Queue] = None
+        self._writer_task: Optional[asyncio.Task] = None
+    
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        for key in self._transient:
+            state[key] = None
+        return state
+    
+    async def start(self):
+        """Migrar el feedback.json antiguo si existe y arrancar el escritor"""
+        if os.path.exists(self.legacy_path):
+            await asyncio.to_thread(self._migrate_legacy)
+        self._queue = asyncio.Queue()
+        self._writer_task = asyncio.create_task(self._writer())
+    
+    async def stop(self):
+        """Esperar a que se escriba todo lo encolado y parar el escritor"""
+        if self._writer_task is None:
+            return
+        await self._queue.put(None)
+        await self._writer_task
+        self._writer_task = None
+    
+    async def submit(self, entry: dict):
+        """Encolar una entrada y esperar a que quede escrita"""
+        if self._writer_task is None:
+            raise RuntimeError("FeedbackStore no iniciado")
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((entry, future))
+        await future
+    
+    async def _writer(self):
+        """Tarea única de escritura: agrupa lo pendiente en cada pasada"""
+        stopping = False
+        while not stopping:
+            batch = [await self._queue.get()]
+            while not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+            if None in batch:
+                stopping = True
+                batch = [item for item in batch if item is not None]
+            if not batch:
+                continue
+            
+            try:
+                await asyncio.to_thread(self._write_batch, [entry for entry, _ in batch])
+            except Exception as e:
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+            else:
+                for _, future in batch:
+                    if not future.done():
+                        future.set_result(None)
+    
+    def _write_batch(self, entries: List[dict]):
+        with open(self.path, 'a', encoding='utf-8') as f:
+            f.write(''.join(json.dumps(entry, ensure_ascii=False) + '\n' for entry in entries))
+            size = f.tell()
+        if size >= self.max_bytes:
+            self._rotate()
+    
+    def _rotate(self):
+        """Rotación por tamaño: feedback.jsonl → .1 → .2 ... hasta ``backup_count``"""
+        if self.backup_count <= 0:
+            return
+        for i in range(self.backup_count - 1, 0, -1):
+            src = f"{self.path}.{i}"
+            if os.path.exists(src):
+                os.replace(src, f"{self.path}.{i + 1}")
+        os.replace(self.path, f"{self.path}.1")
+        logger.info(f"Feedback rotado: {self.path}.1")
+    
+    def _migrate_legacy(self):
+        """Convertir el feedback.json (array completo) al formato JSONL"""
+        try:
+            with open(self.legacy_path, 'r', encoding='utf-8') as f:
+                entries = json.load(f)
+            existing = []
+            if os.path.exists(self.path):
+                with open(self.path, 'r', encoding='utf-8') as f:
+                    existing = f.readlines()
+            with open(self.path + '.tmp', 'w', encoding='utf-8') as f:
+                f.write(''.join(json.dumps(entry, ensure_ascii=False) + '\n' for entry in entries))
+                f.writelines(existing)
+            os.replace(self.path + '.tmp', self.path)
+            os.replace(self.legacy_path, self.legacy_path + '.migrated')
+            logger.info(f"Feedback migrado a {self.path}: {len(entries)} entradas")
+        except Exception as e:
+            logger.error(f"Error migrando {self.legacy_path}: {e}")
+    
+    def iter_feedback(self):
+        """Recorrer todo el feedback en orden cronológico sin cargarlo en memoria"""
+        paths = [f"{self.path}.{i}" for i in range(self.backup_count, 0, -1)] + [self.path]
+        for path in paths:
+            if not os.path.exists(path):
+                continue
+            with open(path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        yield json.loads(line)
+                    except ValueError:
+                        continue
+
+# ============================================================================
+# MOTOR DE PALABRAS CLAVE
+# ============================================================================
+
+# Respuestas automáticas por defecto, en orden de prioridad. Las plantillas
+# admiten {first_name}, {username}, {date} y {time}; solo se calculan los
+# valores que la plantilla usa.
+DEFAULT_KEYWORD_RULES = [
+    {'keywords': ['hola'], 'reply': "¡Hola {first_name}! ¿Cómo estás? 😊"},
+    {'keywords': ['adios'], 'reply': "¡Hasta luego! Espero verte pronto 👋"},
+    {'keywords': ['gracias'], 'reply': "¡De nada! Estoy aquí para ayudarte 🤖"},
+    {'keywords': ['bot'], 'reply': "¡Sí, soy un bot! Pero trato de ser útil 🤖"},
+    {'keywords': ['ayuda'], 'reply': "¿Necesitas ayuda? Usa /help para ver todos los comandos 📚"},
+    {'keywords': ['fecha'], 'reply': "Hoy es {date} 📅"},
+    {'keywords': ['hora'], 'reply': "Son las {time} 🕐"},
+]
+
+class ReplyContext(dict):
+    """Valores para las plantillas de respuesta, calculados solo si se usan"""
+    
+    # Campos que pueden aparecer en una respuesta: {first_name}, {username}, {date}, {time}
+    FIELDS = frozenset({'first_name', 'username', 'date', 'time'})
+    
+    def __init__(self, user):
+        super().__init__()
+        self.user = user
+    
+    def __missing__(self, key):
+        if key == 'first_name':
+            value = self.user.first_name
+        elif key == 'username':
+            value = self.user.username or ''
+        elif key == 'date':
+            value = datetime.now().strftime('%d/%m/%Y')
+        elif key == 'time':
+            value = datetime.now().strftime('%H:%M')
+        else:
+            raise KeyError(key)
+        self[key] = value
+        return value
+
+class KeywordMatcher:
+    """Detector de palabras clave con una única regex precompilada
+
+    Las palabras clave se compilan como un trie dentro de una regex
+    ``(?=(...))``: en cada posición del texto el motor recorre el trie en C
+    en lugar de probar cada palabra, así que el coste por mensaje apenas
+    depende del número de palabras clave. Se respeta la semántica original:
+    gana la regla de mayor prioridad presente en cualquier parte del texto,
+    aunque aparezca más tarde o solape con otra.
+    """
+    
+    def __init__(self, rules: List[dict]):
+        self.replies: List[str] = []
+        priorities: Dict[str, int] = {}
+        for rule in rules:
+            for keyword in rule['keywords']:
+                priorities.setdefault(keyword.lower(), len(self.replies))
+            self.replies.append(rule['reply'])
+        
+        # La regex devuelve la palabra más larga que empieza en cada posición;
+        # las palabras que son prefijo de ella también están presentes ahí
+        self._best: Dict[str, int] = {
+            keyword: min(p for other, p in priorities.items() if keyword.startswith(other))
+            for keyword in priorities
+        }
+        self._pattern = re.compile('(?=(' + self._trie_regex(priorities) + '))') if priorities else None
+    
+    @staticmethod
+    def _trie_regex(words) -> str:
+        trie: dict = {}
+        for word in words:
+            node = trie
+            for char in word:
+                node = node.setdefault(char, {})
+            node[''] = True
+        
+        def build(node) -> str:
+            branches = [re.escape(char) + build(child) for char, child in sorted(node.items()) if char]
+            if not branches:
+                return ''
+            alternation = branches[0] if len(branches) == 1 else '(?:' + '|'.join(branches) + ')'
+            return f'(?:{alternation})?' if '' in node else alternation
+        
+        return build(trie)
+    
+    @staticmethod
+    def validate_rules(rules) -> List[dict]:
+        """Comprobar la forma de las reglas; ValueError con la primera que no sirve"""
+        if not isinstance(rules, list):
+            raise ValueError("se esperaba una lista de reglas")
+        for number, rule in enumerate(rules, 1):
+            if not isinstance(rule, dict):
+                raise ValueError(f"regla {number}: se esperaba un objeto")
+            keywords, reply = rule.get('keywords'), rule.get('reply')
+            if not isinstance(keywords, list) or not keywords or \
+                    not all(isinstance(keyword, str) and keyword for keyword in keywords):
+                raise ValueError(f"regla {number}: 'keywords' debe ser una lista de textos no vacíos")
+            if not isinstance(reply, str):
+                raise ValueError(f"regla {number}: 'reply' debe ser un texto")
+            try:
+                # Llaves desparejadas harían fallar cada respuesta con esta regla
+                fields = list(string.Formatter().parse(reply))
+            except ValueError as e:
+                raise ValueError(f"regla {number}: 'reply' no es una plantilla válida ({e})") from None
+            for _, field, spec, _ in fields:
+                # Un campo desconocido ({nombre}, {0}, {first_name.x}) fallaría en cada mensaje
+                if field is not None and field not in ReplyContext.FIELDS:
+                    raise ValueError(f"regla {number}: campo desconocido {{{field}}} en 'reply' "
+                                     f"(disponibles: {', '.join(sorted(ReplyContext.FIELDS))})")
+            try:
+                # Formatos o conversiones no válidos ({time:zz}, {date!x}) también fallarían siempre
+                reply.format_map(dict.fromkeys(ReplyContext.FIELDS, ''))
+            except (ValueError, KeyError, IndexError) as e:
+                raise ValueError(f"regla {number}: 'reply' no es una plantilla válida ({e})") from None
+        return rules
+    
+    @classmethod
+    def from_file(cls, path: str = KEYWORDS_FILE) -> 'KeywordMatcher':
+        """Cargar reglas desde JSON (lista de {"keywords": [...], "reply": "..."}) o usar las de por defecto"""
+        if os.path.exists(path):
+            try:
+                with open(path, 'r', encoding='utf-8') as f:
+                    matcher = cls(cls.validate_rules(json.load(f)))
+                logger.info(f"Palabras clave cargadas de {path}: {len(matcher.replies)} reglas")
+                return matcher
+            except Exception as e:
+                logger.error(f"Error cargando {path}, usando reglas por defecto: {e}")
+        return cls(DEFAULT_KEYWORD_RULES)
+    
+    def match(self, text: str) -> Optional[int]:
+        """Índice de la regla de mayor prioridad presente en ``text`` (ya en minúsculas)"""
+        if self._pattern is None:
+            return None
+        best = None
+        for found in self._pattern.finditer(text):
+            priority = self._best[found.group(1)]
+            if best is None or priority < best:
+                best = priority
+                if best == 0:
+                    break
+        return best
+    
+    def reply_for(self, text: str, user) -> Optional[str]:
+        """Respuesta renderizada para ``text``, o None si no hay palabra clave"""
+        index = self.match(text.lower())
+        if index is None:
+            return None
+        return self.replies[index].format_map(ReplyContext(user))
+
+# ============================================================================
+# CACHÉ DE RENDERIZADO
+# ============================================================================
+
+class RenderCache:
+    """Memoización de textos renderizados con invalidación por versión o TTL
+
+    Una entrada se reutiliza mientras su ``version`` coincida con la pedida
+    o mientras tenga menos de ``ttl`` segundos; si no, se reconstruye con
+    ``builder``. Los textos y teclados totalmente estáticos son constantes
+    del módulo y no pasan por aquí. Como algunas claves dependen de lo que
+    pide el usuario (la ciudad de /time), se guardan como mucho
+    ``max_entries`` y se descarta la menos usada.
+    """
+    
+    def __init__(self, max_entries: int = RENDER_CACHE_SIZE):
+        self.max_entries = max_entries
+        self._entries: OrderedDict = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+    
+    _MISS = object()
+    
+    def _lookup(self, key: str, version, ttl: float):
+        entry = self._entries.get(key)
+        if entry is not None:
+            entry_version, built_at, value = entry
+            if (version is not None and entry_version == version) or time.monotonic() - built_at < ttl:
+                self.hits += 1
+                self._entries.move_to_end(key)
+                return value
+        self.misses += 1
+        return self._MISS
+    
+    def _store(self, key: str, version, value):
+        self._entries[key] = (version, time.monotonic(), value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+    
+    def get(self, key: str, builder, version=None, ttl: float = 0.0):
+        value = self._lookup(key, version, ttl)
+        if value is self._MISS:
+            value = builder()
+            self._store(key, version, value)
+        return value
+    
+    async def get_async(self, key: str, builder, version=None, ttl: float = 0.0):
+        """``get`` con un ``builder`` asíncrono: solo se espera si la entrada no vale"""
+        value = self._lookup(key, version, ttl)
+        if value is self._MISS:
+            value = await builder()
+            self._store(key, version, value)
+        return value
+    
+    def invalidate(self, key: Optional[str] = None):
+        if key is None:
+            self._entries.clear()
+        else:
+            self._entries.pop(key, None)
+    
+    def metrics(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            'entries': len(self._entries),
+            'evictions': self.evictions,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_ratio': round(self.hits / total, 3) if total else 0.0,
+        }
+
+
+WELCOME_TEXT = """
+✨ *¡Hola {first_name}!* ✨
+
+🤖 Soy un bot avanzado de Telegram con muchas funcionalidades.
+
+📍 *Comandos principales:*
+/start - Iniciar el bot
+/help - Ayuda completa
+/info - Información del bot
+/stats - Ver estadísticas
+/ask - Hacerme una pregunta
+/settings - Configuraciones
+
+💡 *Tip:* También puedes enviarme cualquier mensaje y te responderé.
+
+⚡ *Versión:* 2.0.0
+📊 *Usuarios activos:* {active_users}
+"""
+
+HELP_TEXT = """
+📚 *AYUDA COMPLETA DEL BOT*
+
+📍 *COMANDOS PRINCIPALES:*
+/start - Iniciar el bot
+/help - Ver esta ayuda
+/info - Información técnica
+/stats - Estadísticas de uso
+/ask - Hacer una pregunta
+/feedback - Enviar feedback
+/settings - Configuración
+
+🛠 *COMANDOS AVANZADOS:*
+/time [ciudad] - Hora actual
+/timezone [ciudad] - Tu zona horaria
+/echo [texto] - Repetir texto
+/calc [expresión] - Calculadora (admite rangos: sin(x) for x in 0..100)
+/weather [ciudad] - Clima actual
+
+📱 *INTERACCIÓN:*
+- Responde a mensajes de texto
+- Modo inline: @bot hora, stats, ayuda o cualquier texto
+- Soporta Markdown
+- Teclados inline
+- Conversaciones interactivas
+
+🔐 *SEGURIDAD:*
+- Logging detallado
+- Manejo de errores
+- Protección contra spam
+- Stats anónimas
+
+📧 *SOPORTE:*
+Para reportar problemas o sugerencias:
+/feedback [tu mensaje]
+"""
+
+INFO_TEXT = """
+🤖 *INFORMACIÓN DEL BOT*
+
+⚙️ *Tecnología:*
+- Python {python_version}
+- python-telegram-bot v20.7
+- Arquitectura async/await
+
+📈 *Estadísticas:*
+- Bot ID: {bot_id}
+- Username: @{bot_username}
+- Desarrollado con ❤️
+
+🔧 *Características:*
+- Logging avanzado
+- Persistencia de datos
+- Analytics
+- Manejo de errores
+- Middleware personalizado
+
+🚀 *Despliegue:*
+- Docker compatible
+- GitHub Actions
+- Variables de entorno
+- Configuración modular
+
+📄 *Licencia:* MIT
+📧 *Soporte:* Usa /feedback
+"""
+
+# callback_data versionado: "<versión>:<acción>[:<argumento>...]". Al cambiar
+# el significado de una acción se sube la versión; los botones de mensajes
+# antiguos caen en el manejador de botones caducados en lugar de hacer otra cosa.
+CALLBACK_VERSION = '1'
+
+
+def encode_callback(action: str, *args: str) -> str:
+    """callback_data compacto para un botón (Telegram admite hasta 64 bytes)"""
+    data = ':'.join((CALLBACK_VERSION, action) + args)
+    if len(data.encode('utf-8')) > 64:
+        raise ValueError(f"callback_data demasiado largo: {data!r}")
+    return data
+
+
+# Los InlineKeyboardMarkup son inmutables: se comparten entre todas las respuestas
+START_KEYBOARD = InlineKeyboardMarkup([
+    [
+        InlineKeyboardButton("📋 Comandos", callback_data=encode_callback('v', 'help')),
+        InlineKeyboardButton("ℹ️ Info", callback_data=encode_callback('v', 'info')),
+    ],
+    [
+        InlineKeyboardButton("📊 Estadísticas", callback_data=encode_callback('v', 'stats')),
+        InlineKeyboardButton("⚙️ Settings", callback_data=encode_callback('v', 'settings')),
+    ]
+])
+
+QUICK_REPLY_KEYBOARD = InlineKeyboardMarkup([
+    [InlineKeyboardButton("📋 Ayuda", callback_data=encode_callback('v', 'help')),
+     InlineKeyboardButton("ℹ️ Info", callback_data=encode_callback('v', 'info'))],
+    [InlineKeyboardButton("🕐 Hora", callback_data=encode_callback('v', 'time')),
+     InlineKeyboardButton("📊 Stats", callback_data=encode_callback('v', 'stats'))]
+])
+
+DEFAULT_RESPONSES = (
+    "Interesante, {first_name}. ¿En qué más puedo ayudarte?",
+    "¡Gracias por tu mensaje, {first_name}!",
+    "Lo tengo en cuenta, {first_name}. ¿Algo más?",
+    "¿Necesitas que haga algo específico, {first_name}?",
+)
+
+
+def render_info(application: Application) -> str:
+    bot = application.bot
+    return INFO_TEXT.format(
+        python_version=application.__version__ if hasattr(application, '__version__') else '3.11+',
+        bot_id=bot.id if bot else 'N/A',
+        bot_username=bot.username if bot else 'N/A',
+    )
+
+
+async def render_leaderboard(analytics: AnalyticsMiddleware) -> Optional[str]:
+    """Totales y top 5 de /stats (None sin usuarios); solo cambian cuando cambia analytics.version"""
+    active_users, total_messages, total_commands = await analytics.get_totals_async()
+    if not active_users:
+        return None
+    
+    stats_text = f"""
+📊 *ESTADÍSTICAS DEL BOT*
+
+👥 *Usuarios:*
+- Total usuarios: {active_users}
+- Mensajes totales: {total_messages}
+- Comandos totales: {total_commands}
+
+🏆 *Top 5 usuarios:*
+"""
+    
+    # Top 5 usuarios más activos
+    for i, user in enumerate(await analytics.get_top_users_async(5), 1):
+        last_seen = user.last_seen.strftime('%Y-%m-%d %H:%M') if user.last_seen else 'Nunca'
+        stats_text += f"{i}. {user.first_name} (@{user.username})\n"
+        stats_text += f"   📨 Msgs: {user.message_count} | ⚡ Cmds: {user.command_count}\n"
+        stats_text += f"   👀 Visto: {last_seen}\n"
+    return stats_text
+
+# ============================================================================
+# CALCULADORA
+# ============================================================================
+
+# Límites de recursos por proceso (no disponible en Windows: solo queda el timeout)
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+class CalcError(Exception):
+    """Expresión rechazada o cálculo fallido; el mensaje se muestra al usuario"""
+
+
+# Funciones admitidas (nombre en /calc -> nombre en numpy) y constantes
+CALC_FUNCTIONS = {
+    'sin': 'sin', 'cos': 'cos', 'tan': 'tan', 'asin': 'arcsin', 'acos': 'arccos', 'atan': 'arctan',
+    'sinh': 'sinh', 'cosh': 'cosh', 'tanh': 'tanh', 'exp': 'exp', 'log': 'log', 'log10': 'log10',
+    'log2': 'log2', 'sqrt': 'sqrt', 'abs': 'abs', 'floor': 'floor', 'ceil': 'ceil', 'round': 'round',
+}
+CALC_CONSTANTS = {'pi': math.pi, 'e': math.e, 'tau': math.tau}
+# Funciones con segundo argumento opcional: log(x, base) y round(x, decimales)
+CALC_TWO_ARGUMENT_FUNCTIONS = {'log', 'round'}
+
+_CALC_BINARY_OPS = (ast.Add, ast.Sub, ast.Mult, ast.Div, ast.FloorDiv, ast.Mod, ast.Pow)
+
+# "<expresión> for x in <inicio>..<fin> [step <paso>]" (extremos incluidos)
+_CALC_NUMBER = r'[-+]?\d+(?:\.\d+)?'
+CALC_RANGE_PATTERN = re.compile(
+    rf'^(?P<expr>.+?)\s+for\s+x\s+in\s+(?P<start>{_CALC_NUMBER})\s*\.\.\s*(?P<stop>{_CALC_NUMBER})'
+    rf'(?:\s+step\s+(?P<step>{_CALC_NUMBER}))?$'
+)
+
+
+@dataclass(frozen=True)
+class CompiledExpression:
+    code: object
+    uses_pow: bool
+    uses_x: bool
+
+
+class _CalcCompiler(ast.NodeTransformer):
+    """Lista blanca de nodos del AST
+
+    Cualquier nodo sin ``visit_*`` propio se rechaza. Las potencias se
+    reescriben como llamadas a ``_pow`` para limitar el tamaño del resultado.
+    """
+    
+    def __init__(self):
+        self.nodes = 0
+        self.uses_pow = False
+        self.uses_x = False
+    
+    def visit(self, node):
+        self.nodes += 1
+        if self.nodes > CALC_MAX_NODES:
+            raise CalcError("Expresión demasiado compleja")
+        return super().visit(node)
+    
+    def generic_visit(self, node):
+        raise CalcError("Operación no permitida")
+    
+    def visit_Expression(self, node):
+        node.body = self.visit(node.body)
+        return node
+    
+    def visit_Constant(self, node):
+        if type(node.value) not in (int, float):
+            raise CalcError("Solo se admiten números")
+        return node
+    
+    def visit_Name(self, node):
+        if node.id == 'x':
+            self.uses_x = True
+        elif node.id not in CALC_CONSTANTS:
+            raise CalcError(f"Nombre desconocido: {node.id}")
+        return node
+    
+    def visit_UnaryOp(self, node):
+        if not isinstance(node.op, (ast.UAdd, ast.USub)):
+            raise CalcError("Operación no permitida")
+        node.operand = self.visit(node.operand)
+        return node
+    
+    def visit_BinOp(self, node):
+        if not isinstance(node.op, _CALC_BINARY_OPS):
+            raise CalcError("Operación no permitida")
+        node.left = self.visit(node.left)
+        node.right = self.visit(node.right)
+        if isinstance(node.op, ast.Pow):
+            self.uses_pow = True
+            call = ast.Call(func=ast.Name(id='_pow', ctx=ast.Load()), args=[node.left, node.right], keywords=[])
+            return ast.copy_location(call, node)
+        return node
+    
+    def visit_Call(self, node):
+        if not isinstance(node.func, ast.Name) or node.func.id not in CALC_FUNCTIONS:
+            raise CalcError("Función no permitida")
+        max_args = 2 if node.func.id in CALC_TWO_ARGUMENT_FUNCTIONS else 1
+        if node.keywords or not 1 <= len(node.args) <= max_args:
+            raise CalcError(f"Argumentos no válidos para {node.func.id}")
+        node.args = [self.visit(arg) for arg in node.args]
+        return node
+
+
+@lru_cache(maxsize=CALC_CACHE_SIZE)
+def compile_expression(source: str) -> CompiledExpression:
+    """Validar y compilar una expresión (memoizado: la misma expresión no se vuelve a analizar)"""
+    if len(source) > CALC_MAX_LENGTH:
+        raise CalcError(f"Expresión demasiado larga (máximo {CALC_MAX_LENGTH} caracteres)")
+    try:
+        tree = ast.parse(source.replace('^', '**'), mode='eval')
+    except (SyntaxError, ValueError, RecursionError, MemoryError):
+        raise CalcError("Expresión no válida") from None
+    compiler = _CalcCompiler()
+    tree = ast.fix_missing_locations(compiler.visit(tree))
+    return CompiledExpression(compile(tree, '<calc>', 'eval'), compiler.uses_pow, compiler.uses_x)
+
+
+def _calc_pow(base, exponent):
+    """Potencia que rechaza enteros de más de CALC_MAX_BITS antes de calcularlos"""
+    if (isinstance(base, int) and isinstance(exponent, int) and exponent > 0 and abs(base) > 1
+            and exponent * base.bit_length() > CALC_MAX_BITS):
+        raise CalcError("Resultado demasiado grande")
+    return base ** exponent
+
+
+def _calc_ndigits(ndigits):
+    """Comprobar los decimales de round antes de calcular 10**ndigits"""
+    if isinstance(ndigits, (int, float)) and abs(ndigits) > CALC_MAX_ROUND_DIGITS:
+        raise CalcError(f"Demasiados decimales para round (máximo {CALC_MAX_ROUND_DIGITS})")
+    return ndigits
+
+
+def _calc_round(value, ndigits=None):
+    """round que rechaza ``ndigits`` fuera de ±CALC_MAX_ROUND_DIGITS"""
+    if ndigits is None:
+        return round(value)
+    return round(value, _calc_ndigits(ndigits))
+
+
+_CALC_NAMESPACE = {
+    '__builtins__': {}, '_pow': _calc_pow, **CALC_CONSTANTS,
+    **{name: getattr(math, name, None) for name in CALC_FUNCTIONS}, 'abs': abs, 'round': _calc_round,
+}
+
+
+def _calc_eval(code, namespace):
+    try:
+        return eval(code, namespace)
+    except CalcError:
+        raise
+    except ZeroDivisionError:
+        raise CalcError("División por cero") from None
+    except OverflowError:
+        raise CalcError("Desbordamiento: resultado demasiado grande") from None
+    except ValueError:
+        raise CalcError("Valor fuera del dominio de la función") from None
+    except TypeError:
+        raise CalcError("Número de argumentos incorrecto") from None
+    except MemoryError:
+        raise CalcError("Memoria agotada") from None
+
+
+def calc_scalar(source: str):
+    """Evaluar una expresión sin x (en el event loop o en un proceso de cálculo)"""
+    compiled = compile_expression(source)
+    if compiled.uses_x:
+        raise CalcError("x solo se puede usar con un rango: sin(x) for x in 0..10")
+    return _calc_eval(compiled.code, _CALC_NAMESPACE)
+
+
+# numpy es opcional: sin él (o con CALC_USE_NUMPY=false) los rangos se evalúan elemento a elemento
+_numpy = None if CALC_USE_NUMPY else False
+
+
+def _load_numpy():
+    global _numpy
+    if _numpy is None:
+        try:
+            import numpy
+            _numpy = numpy
+        except ImportError:
+            _numpy = False
+    return _numpy or None
+
+
+def _calc_numpy_functions(numpy) -> dict:
+    functions = {name: getattr(numpy, numpy_name) for name, numpy_name in CALC_FUNCTIONS.items()}
+    # numpy.log tomaría la base como argumento ``out``: misma semántica que math.log(x, base)
+    functions['log'] = lambda value, base=None: \
+        numpy.log(value) if base is None else numpy.log(value) / numpy.log(base)
+    functions['round'] = lambda value, ndigits=0: numpy.round(value, _calc_ndigits(ndigits))
+    return functions
+
+
+def calc_range(source: str, start: float, step: float, count: int, preview: int = 5) -> dict:
+    """Evaluar una expresión en ``count`` puntos x = start + i*step y resumir el resultado
+
+    Con numpy se evalúa una sola vez sobre el array de x; los puntos fuera
+    del dominio quedan como NaN en ambos casos. Solo vuelve el resumen, no
+    los valores.
+    """
+    compiled = compile_expression(source)
+    numpy = _load_numpy()
+    if numpy is not None:
+        xs = start + step * numpy.arange(count, dtype=float)
+        namespace = dict(_CALC_NAMESPACE, x=xs)
+        namespace.update(_calc_numpy_functions(numpy))
+        with numpy.errstate(all='ignore'):
+            values = _calc_eval(compiled.code, namespace)
+            try:
+                values = numpy.broadcast_to(numpy.asarray(values, dtype=float), xs.shape)
+            except (TypeError, ValueError, OverflowError):
+                raise CalcError("Resultado no numérico") from None
+        finite = values[numpy.isfinite(values)]
+        stats = (float(finite.min()), float(finite.max()), float(finite.mean())) if finite.size else None
+        head = [(float(x), float(y)) for x, y in zip(xs[:preview], values[:preview])]
+        finite_count = int(finite.size)
+    else:
+        values = []
+        namespace = dict(_CALC_NAMESPACE)
+        for i in range(count):
+            namespace['x'] = start + i * step
+            try:
+                value = _calc_eval(compiled.code, namespace)
+                values.append(float(value) if not isinstance(value, complex) else math.nan)
+            except (CalcError, OverflowError):
+                values.append(math.nan)
+        finite = [value for value in values if math.isfinite(value)]
+        stats = (min(finite), max(finite), math.fsum(finite) / len(finite)) if finite else None
+        head = [(start + i * step, values[i]) for i in range(min(preview, count))]
+        finite_count = len(finite)
+    return {'count': count, 'finite': finite_count, 'stats': stats, 'head': head,
+            'vectorized': numpy is not None}
+
+
+def format_calc_number(value) -> str:
+    """Número legible: enteros enormes en notación científica, floats con 12 cifras"""
+    if isinstance(value, complex):
+        sign = '-' if value.imag < 0 else '+'
+        return f"{format_calc_number(value.real)} {sign} {format_calc_number(abs(value.imag))}i"
+    if isinstance(value, int):
+        if abs(value) < 10 ** 15:
+            return str(value)
+        # str() de enteros de más de 4300 cifras falla: mantisa y exponente
+        exponent = int(math.log10(abs(value)))
+        mantissa = value / 10 ** exponent
+        if abs(mantissa) >= 10:
+            mantissa /= 10
+            exponent += 1
+        return f"{mantissa:.10g}e{exponent:+d}"
+    if isinstance(value, float) and value.is_integer() and abs(value) < 1e15:
+        return str(int(value))
+    return f"{value:.12g}"
+
+
+def _calc_worker_init(memory_limit: int):
+    """Preparar un proceso de cálculo: numpy precargado y límite de memoria"""
+    import signal
+    # Ctrl+C lo gestiona el proceso principal
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    # numpy se importa antes del límite: sus hilos BLAS reservan mucha memoria virtual
+    os.environ.setdefault('OPENBLAS_NUM_THREADS', '1')
+    os.environ.setdefault('OMP_NUM_THREADS', '1')
+    _load_numpy()
+    if resource is None:
+        return
+    # Un proceso muerto por SIGXCPU no debe dejar ficheros core
+    resource.setrlimit(resource.RLIMIT_CORE, (0, 0))
+    if memory_limit:
+        try:
+            with open('/proc/self/statm') as f:
+                size = int(f.read().split()[0]) * resource.getpagesize()
+        except OSError:
+            return
+        soft, hard = resource.getrlimit(resource.RLIMIT_AS)
+        limit = size + memory_limit if hard == resource.RLIM_INFINITY else min(size + memory_limit, hard)
+        resource.setrlimit(resource.RLIMIT_AS, (limit, hard))
+
+
+def _calc_task(cpu_seconds: int, function, *args):
+    """Ejecutar un cálculo con un límite de CPU propio (el límite del proceso es acumulado)"""
+    if resource is not None:
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        soft, hard = resource.getrlimit(resource.RLIMIT_CPU)
+        limit = int(usage.ru_utime + usage.ru_stime) + 1 + cpu_seconds
+        if hard != resource.RLIM_INFINITY:
+            limit = min(limit, hard)
+        resource.setrlimit(resource.RLIMIT_CPU, (limit, hard))
+    return function(*args)
+
+
+class Calculator:
+    """Motor de /calc: evaluación directa o en procesos aislados según el coste
+
+    La aritmética sin potencias cuesta microsegundos y se evalúa en el event
+    loop. Potencias y rangos van a un ProcessPoolExecutor de ``workers``
+    procesos (creado con la primera expresión costosa) con límites de
+    memoria y de CPU por cálculo: si uno supera ``timeout`` se matan los
+    procesos del pool, los demás cálculos en curso se reintentan una vez en
+    un pool nuevo. Así una expresión hostil no bloquea el loop que atiende
+    al resto de usuarios.
+    """
+    
+    def __init__(self, workers: int = CALC_WORKERS, timeout: float = CALC_TIMEOUT,
+                 memory_limit: int = CALC_MEMORY_LIMIT):
+        self.workers = workers
+        self.timeout = timeout
+        self.memory_limit = memory_limit
+        self._pool: Optional[ProcessPoolExecutor] = None
+        self.inline = 0
+        self.offloaded = 0
+        self.timeouts = 0
+        self.crashes = 0
+    
+    def _get_pool(self) -> ProcessPoolExecutor:
+        # spawn: un fork del bot heredaría hilos y locks en estado arbitrario
+        if self._pool is None:
+            self._pool = ProcessPoolExecutor(
+                self.workers, mp_context=multiprocessing.get_context('spawn'),
+                initializer=_calc_worker_init, initargs=(self.memory_limit,),
+            )
+        return self._pool
+    
+    def _discard_pool(self, pool: ProcessPoolExecutor):
+        """Matar los procesos del pool: un cálculo en curso no se puede cancelar de otro modo"""
+        if self._pool is pool:
+            self._pool = None
+        # ProcessPoolExecutor no expone sus procesos (hasta 3.14, terminate_workers)
+        processes = list((pool._processes or {}).values())
+        pool.shutdown(wait=False, cancel_futures=True)
+        for process in processes:
+            process.kill()
+    
+    async def _offload(self, function, *args):
+        loop = asyncio.get_running_loop()
+        self.offloaded += 1
+        for attempt in range(2):
+            pool = self._get_pool()
+            try:
+                return await asyncio.wait_for(
+                    loop.run_in_executor(pool, _calc_task, math.ceil(self.timeout), function, *args),
+                    self.timeout,
+                )
+            except asyncio.TimeoutError:
+                self.timeouts += 1
+                metrics_registry.count_error('calc_timeout')
+                self._discard_pool(pool)
+                # Arrancar ya los procesos nuevos (spawn + import tardan ~0.5 s),
+                # para que ese tiempo no cuente en el timeout del siguiente cálculo
+                self._get_pool().submit(os.getpid)
+                raise CalcError(f"Tiempo de cálculo agotado ({self.timeout:g} s)") from None
+            except BrokenProcessPool:
+                # Un proceso murió (límite de CPU o memoria) o el pool se descartó
+                # por el timeout de otro cálculo
+                self.crashes += 1
+                if self._pool is pool:
+                    self._pool = None
+        metrics_registry.count_error('calc_crash')
+        raise CalcError("El cálculo superó los límites de recursos")
+    
+    async def evaluate(self, text: str) -> str:
+        """Evaluar ``text`` y devolver la respuesta (Markdown); CalcError si no es válida"""
+        text = ' '.join(text.split())
+        match = CALC_RANGE_PATTERN.match(text)
+        if match:
+            return await self._evaluate_range(match)
+        compiled = compile_expression(text)
+        if compiled.uses_x:
+            raise CalcError("x solo se puede usar con un rango: sin(x) for x in 0..10")
+        if compiled.uses_pow:
+            value = await self._offload(calc_scalar, text)
+        else:
+            self.inline += 1
+            value = calc_scalar(text)
+        return f"🧮 `{text}`\n= *{format_calc_number(value)}*"
+    
+    async def _evaluate_range(self, match) -> str:
+        expression = match['expr']
+        start, stop = float(match['start']), float(match['stop'])
+        step = float(match['step'] or 1)
+        if step <= 0 or stop < start:
+            raise CalcError("Rango vacío")
+        count = int((stop - start) / step + 1e-9) + 1
+        if count > CALC_RANGE_MAX_POINTS:
+            raise CalcError(f"Demasiados puntos (máximo {CALC_RANGE_MAX_POINTS})")
+        # La validación es inmediata: las expresiones no válidas no llegan al pool
+        compile_expression(expression)
+        summary = await self._offload(calc_range, expression, start, step, count)
+        
+        text = (f"🧮 `{expression}` para x en [{format_calc_number(start)}, {format_calc_number(stop)}]\n"
+                f"{summary['count']} puntos{' (numpy)' if summary['vectorized'] else ''}")
+        if summary['finite'] < summary['count']:
+            text += f", {summary['count'] - summary['finite']} fuera del dominio"
+        if summary['stats']:
+            low, high, mean = summary['stats']
+            text += (f"\n\nmín: *{format_calc_number(low)}* · máx: *{format_calc_number(high)}*"
+                     f" · media: *{format_calc_number(mean)}*")
+        text += "\n\n" + "\n".join(f"x = {format_calc_number(x)} → {format_calc_number(y)}"
+                                   for x, y in summary['head'])
+        if summary['count'] > len(summary['head']):
+            text += "\n…"
+        return text
+    
+    def metrics(self) -> dict:
+        cache = compile_expression.cache_info()
+        return {'inline': self.inline, 'offloaded': self.offloaded, 'timeouts': self.timeouts,
+                'crashes': self.crashes, 'cache_hits': cache.hits, 'cache_misses': cache.misses}
+    
+    def shutdown(self):
+        if self._pool is not None:
+            self._discard_pool(self._pool)
+
+# ============================================================================
+# CLIMA
+# ============================================================================
+
+class WeatherError(Exception):
+    """Fallo al obtener el clima; el mensaje se muestra al usuario"""
+
+
+class CityNotFound(WeatherError):
+    pass
+
+
+class CircuitBreaker:
+    """Circuit breaker por proveedor: cerrado, abierto o semiabierto
+
+    Tras ``failures`` fallos consecutivos se abre y rechaza las llamadas sin
+    intentarlas durante ``reset_timeout`` segundos; después deja pasar una
+    sola llamada de prueba, que lo cierra si sale bien o lo reabre si falla
+    (si la prueba no termina, otra pasados ``reset_timeout`` segundos).
+    
+    Con ``slow_call``, las llamadas en vuelo que llevan más de esos
+    segundos sin respuesta cuentan como fallos al decidir si admitir otra:
+    si el proveedor se cuelga, el circuito se abre antes de que venza el
+    primer timeout, en lugar de dejar pasar todo lo que llega mientras
+    tanto. Debe quedar por debajo del timeout de la llamada pero lejos de la
+    latencia normal, o un proveedor lento pero sano abriría el circuito.
+    """
+    
+    def __init__(self, failures: int = WEATHER_BREAKER_FAILURES, reset_timeout: float = WEATHER_BREAKER_RESET,
+                 slow_call: Optional[float] = None):
+        self.failures = failures
+        self.reset_timeout = reset_timeout
+        self.slow_call = slow_call
+        self.consecutive_failures = 0
+        self.opened_at: Optional[float] = None
+        self._trial_started: Optional[float] = None
+        # Inicio de cada llamada en vuelo, en orden de inicio
+        self._in_flight: Dict[int, float] = {}
+        self._next_call = 0
+        self.rejected = 0
+    
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return 'closed'
+        if time.monotonic() - self.opened_at < self.reset_timeout:
+            return 'open'
+        return 'half-open'
+    
+    def _slow_calls(self, now: float) -> int:
+        if self.slow_call is None:
+            return 0
+        count = 0
+        for started in self._in_flight.values():
+            if now - started < self.slow_call:
+                break
+            count += 1
+        return count
+    
+    def allow(self) -> bool:
+        state = self.state
+        now = time.monotonic()
+        if state == 'closed':
+            if self.consecutive_failures + self._slow_calls(now) < self.failures:
+                return True
+            self.opened_at = now
+            state = 'open'
+        if state == 'half-open' and (self._trial_started is None or now - self._trial_started >= self.reset_timeout):
+            self._trial_started = now
+            return True
+        self.rejected += 1
+        return False
+    
+    def started(self) -> int:
+        """Registrar una llamada en vuelo; devuelve el identificador para ``finished``"""
+        self._next_call += 1
+        self._in_flight[self._next_call] = time.monotonic()
+        return self._next_call
+    
+    def finished(self, call: int):
+        self._in_flight.pop(call, None)
+    
+    def record_success(self):
+        self.consecutive_failures = 0
+        self.opened_at = None
+        self._trial_started = None
+    
+    def record_failure(self):
+        self.consecutive_failures += 1
+        self._trial_started = None
+        if self.opened_at is not None or self.consecutive_failures >= self.failures:
+            self.opened_at = time.monotonic()
+
+
+class WeatherEndpoint:
+    """Un proveedor HTTP con JSON: URL, timeout y circuit breaker propios
+
+    Por defecto una llamada cuenta como lenta para el breaker al pasar
+    ``WEATHER_BREAKER_SLOW_CALL_RATIO`` de su propio timeout.
+    """
+    
+    def __init__(self, name: str, url: str, timeout: float, breaker: Optional[CircuitBreaker] = None,
+                 slow_call: Optional[float] = None):
+        self.name = name
+        self.url = url
+        self.timeout = timeout
+        if slow_call is None:
+            slow_call = timeout * WEATHER_BREAKER_SLOW_CALL_RATIO
+        self.breaker = breaker or CircuitBreaker(slow_call=slow_call)
+        self.calls = 0
+        self.failures = 0
+    
+    async def get(self, session, params: dict) -> dict:
+        import aiohttp
+        if not self.breaker.allow():
+            raise WeatherError("El servicio del clima no está disponible ahora mismo. Inténtalo en unos segundos")
+        self.calls += 1
+        call = self.breaker.started()
+        start = time.perf_counter()
+        try:
+            timeout = aiohttp.ClientTimeout(total=self.timeout, connect=WEATHER_CONNECT_TIMEOUT)
+            async with session.get(self.url, params=params, timeout=timeout) as response:
+                if response.status == 429 or response.status >= 500:
+                    raise WeatherError(f"El servicio del clima respondió {response.status}")
+                if response.status != 200:
+                    # Petición rechazada: no es un fallo del proveedor
+                    self.breaker.record_success()
+                    raise CityNotFound("No encontré esa ciudad")
+                data = await response.json(content_type=None)
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError, WeatherError) as e:
+            if isinstance(e, CityNotFound):
+                raise
+            self.failures += 1
+            self.breaker.record_failure()
+            logger.warning(f"Proveedor del clima {self.name}: {e!r}")
+            if isinstance(e, WeatherError):
+                raise
+            raise WeatherError("El servicio del clima no responde. Inténtalo más tarde") from None
+        finally:
+            self.breaker.finished(call)
+            metrics_registry.observe_upstream(self.name, time.perf_counter() - start)
+        self.breaker.record_success()
+        return data
+
+
+@dataclass(frozen=True)
+class WeatherReport:
+    city: str
+    country: str
+    temperature: float
+    apparent_temperature: Optional[float]
+    humidity: Optional[float]
+    wind_speed: Optional[float]
+    weather_code: Optional[int]
+    observed_at: str
+
+
+# Códigos WMO de Open-Meteo: (primer código del grupo, emoji, descripción)
+WEATHER_CODES = [
+    (0, '☀️', 'Despejado'), (1, '🌤', 'Poco nuboso'), (2, '⛅', 'Parcialmente nuboso'), (3, '☁️', 'Cubierto'),
+    (45, '🌫', 'Niebla'), (51, '🌦', 'Llovizna'), (61, '🌧', 'Lluvia'), (71, '🌨', 'Nieve'),
+    (80, '🌦', 'Chubascos'), (85, '🌨', 'Chubascos de nieve'), (95, '⛈', 'Tormenta'),
+]
+
+
+def describe_weather_code(code: Optional[int]) -> Tuple[str, str]:
+    if code is None:
+        return '🌡', 'Sin datos'
+    index = bisect.bisect_right([first for first, _, _ in WEATHER_CODES], code) - 1
+    _, emoji, description = WEATHER_CODES[max(index, 0)]
+    return emoji, description
+
+
+def normalize_city(city: str) -> str:
+    """Clave de caché: sin tildes, mayúsculas ni espacios repetidos ("  MÁLAGA " == "malaga")"""
+    decomposed = unicodedata.normalize('NFKD', city)
+    return ' '.join(''.join(c for c in decomposed if not unicodedata.combining(c)).casefold().split())
+
+
+def render_weather(report: WeatherReport, age: Optional[float] = None) -> str:
+    emoji, description = describe_weather_code(report.weather_code)
+    place = escape_markdown(f"{report.city}, {report.country}" if report.country else report.city)
+    text = f"{emoji} *Clima en {place}*\n\n"
+    text += f"🌡 Temperatura: *{report.temperature:.1f} °C*"
+    if report.apparent_temperature is not None:
+        text += f" (sensación {report.apparent_temperature:.1f} °C)"
+    text += f"\n{description}"
+    if report.humidity is not None:
+        text += f"\n💧 Humedad: {report.humidity:.0f}%"
+    if report.wind_speed is not None:
+        text += f"\n💨 Viento: {report.wind_speed:.0f} km/h"
+    text += f"\n\n🕐 Observación: {escape_markdown(report.observed_at.replace('T', ' '))}"
+    if age is not None:
+        text += f"\n⚠️ _Datos de hace {age / 60:.0f} min: el servicio del clima no responde_"
+    return text
+
+
+class WeatherService:
+    """Clima por ciudad con una sesión HTTP compartida, caché y coalescencia
+
+    * Una sola ``aiohttp.ClientSession`` (pool de ``WEATHER_POOL_SIZE``
+      conexiones keep-alive) para todas las peticiones.
+    * Caché LRU por ciudad normalizada: ``WEATHER_CACHE_TTL`` para el
+      clima y ``WEATHER_NOT_FOUND_TTL`` para las ciudades inexistentes. Si
+      el proveedor falla se sirve el último dato si no supera ``WEATHER_STALE_TTL``.
+    * Coalescencia: las peticiones simultáneas de la misma ciudad esperan a
+      una única consulta al proveedor, que sigue aunque quien la inició se cancele.
+    * Geocodificación y previsión son proveedores separados, cada uno con su
+      timeout y su circuit breaker.
+    """
+    
+    def __init__(self, geocoding_url: str = WEATHER_GEOCODING_URL, forecast_url: str = WEATHER_FORECAST_URL,
+                 cache_size: int = WEATHER_CACHE_SIZE, ttl: float = WEATHER_CACHE_TTL):
+        self.geocoding = WeatherEndpoint('weather_geocoding', geocoding_url, WEATHER_GEOCODING_TIMEOUT)
+        self.forecast = WeatherEndpoint('weather_forecast', forecast_url, WEATHER_FORECAST_TIMEOUT)
+        self.cache_size = cache_size
+        self.ttl = ttl
+        # clave -> (instante, WeatherReport o None si la ciudad no existe)
+        self._cache: OrderedDict = OrderedDict()
+        self._inflight: Dict[str, asyncio.Task] = {}
+        self._session = None
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.stale_served = 0
+    
+    def _get_session(self):
+        import aiohttp
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(limit=WEATHER_POOL_SIZE, ttl_dns_cache=300)
+            self._session = aiohttp.ClientSession(connector=connector)
+        return self._session
+    
+    def _cached(self, key: str, max_age: float):
+        entry = self._cache.get(key)
+        if entry is None:
+            return None
+        stored_at, report = entry
+        if time.monotonic() - stored_at >= (max_age if report is not None else WEATHER_NOT_FOUND_TTL):
+            return None
+        self._cache.move_to_end(key)
+        return entry
+    
+    def _store(self, key: str, report: Optional[WeatherReport]):
+        self._cache[key] = (time.monotonic(), report)
+        self._cache.move_to_end(key)
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+    
+    async def get(self, city: str) -> Tuple[WeatherReport, Optional[float]]:
+        """Clima de ``city`` y, si es un dato caducado servido por un fallo, su antigüedad (s)"""
+        key = normalize_city(city)
+        if not key:
+            raise CityNotFound("Indica una ciudad")
+        entry = self._cached(key, self.ttl)
+        if entry is not None:
+            self.hits += 1
+            if entry[1] is None:
+                raise CityNotFound("No encontré esa ciudad")
+            return entry[1], None
+        
+        task = self._inflight.get(key)
+        if task is None:
+            self.misses += 1
+            task = asyncio.get_running_loop().create_task(self._fetch(key, ' '.join(city.split())))
+            self._inflight[key] = task
+            task.add_done_callback(partial(self._fetch_done, key))
+        else:
+            self.coalesced += 1
+        try:
+            return await asyncio.shield(task), None
+        except CityNotFound:
+            raise
+        except WeatherError:
+            stale = self._cached(key, WEATHER_STALE_TTL)
+            if stale is None or stale[1] is None:
+                raise
+            self.stale_served += 1
+            return stale[1], time.monotonic() - stale[0]
+    
+    def _fetch_done(self, key: str, task: asyncio.Task):
+        self._inflight.pop(key, None)
+        # Si todos los que esperaban se cancelaron, nadie más recoge la excepción
+        if not task.cancelled():
+            task.exception()
+    
+    async def _fetch(self, key: str, city: str) -> WeatherReport:
+        session = self._get_session()
+        places = await self.geocoding.get(session, {'name': city, 'count': 1, 'language': 'es', 'format': 'json'})
+        results = places.get('results') or []
+        if not results:
+            self._store(key, None)
+            raise CityNotFound("No encontré esa ciudad")
+        place = results[0]
+        data = await self.forecast.get(session, {
+            'latitude': place['latitude'],
+            'longitude': place['longitude'],
+            'current': 'temperature_2m,apparent_temperature,relative_humidity_2m,weather_code,wind_speed_10m',
+            'timezone': 'auto',
+        })
+        current = data.get('current') or {}
+        if current.get('temperature_2m') is None:
+            raise WeatherError("El servicio del clima devolvió una respuesta incompleta")
+        report = WeatherReport(
+            city=place.get('name', city),
+            country=place.get('country', ''),
+            temperature=current['temperature_2m'],
+            apparent_temperature=current.get('apparent_temperature'),
+            humidity=current.get('relative_humidity_2m'),
+            wind_speed=current.get('wind_speed_10m'),
+            weather_code=current.get('weather_code'),
+            observed_at=str(current.get('time', '')),
+        )
+        self._store(key, report)
+        return report
+    
+    def metrics(self) -> dict:
+        return {
+            'cache_entries': len(self._cache),
+            'hits': self.hits,
+            'misses': self.misses,
+            'coalesced': self.coalesced,
+            'stale_served': self.stale_served,
+            'upstream_calls': self.geocoding.calls + self.forecast.calls,
+            'breakers': {self.geocoding.name: self.geocoding.breaker.state,
+                         self.forecast.name: self.forecast.breaker.state},
+        }
+    
+    async def close(self):
+        for task in list(self._inflight.values()):
+            task.cancel()
+        if self._session is not None:
+            await self._session.close()
+
+# ============================================================================
+# ZONAS HORARIAS
+# ============================================================================
+
+try:
+    import zoneinfo
+except ImportError:
+    zoneinfo = None
+
+# Etiquetas de las zonas por defecto; el resto usan el nombre de su ciudad
+TIME_ZONE_LABELS = {
+    'Europe/Madrid': '🌍 Madrid',
+    'America/New_York': '🇺🇸 NY',
+    'Asia/Tokyo': '🇯🇵 Tokyo',
+    'Australia/Sydney': '🇦🇺 Sydney',
+}
+
+# Nombres habituales que no coinciden con la ciudad de ninguna zona IANA
+TIME_ZONE_ALIASES = {
+    'nueva york': 'America/New_York', 'ny': 'America/New_York', 'tokio': 'Asia/Tokyo',
+    'londres': 'Europe/London', 'paris': 'Europe/Paris', 'roma': 'Europe/Rome', 'berlin': 'Europe/Berlin',
+    'moscu': 'Europe/Moscow', 'lisboa': 'Europe/Lisbon', 'atenas': 'Europe/Athens', 'estambul': 'Europe/Istanbul',
+    'barcelona': 'Europe/Madrid', 'sevilla': 'Europe/Madrid', 'valencia': 'Europe/Madrid', 'espana': 'Europe/Madrid',
+    'canarias': 'Atlantic/Canary', 'ciudad de mexico': 'America/Mexico_City', 'mexico': 'America/Mexico_City',
+    'los angeles': 'America/Los_Angeles', 'san francisco': 'America/Los_Angeles', 'el cairo': 'Africa/Cairo',
+    'pekin': 'Asia/Shanghai', 'beijing': 'Asia/Shanghai', 'seul': 'Asia/Seoul', 'sidney': 'Australia/Sydney',
+    'delhi': 'Asia/Kolkata', 'nueva delhi': 'Asia/Kolkata', 'bombay': 'Asia/Kolkata',
+}
+
+
+def _load_zone(name: str):
+    """tzinfo de una zona IANA: zoneinfo y, si el sistema no tiene la base de zonas, pytz"""
+    if zoneinfo is not None:
+        try:
+            return zoneinfo.ZoneInfo(name)
+        except (zoneinfo.ZoneInfoNotFoundError, ValueError):
+            pass
+    try:
+        import pytz
+    except ImportError:
+        return None
+    try:
+        return pytz.timezone(name)
+    except pytz.UnknownTimeZoneError:
+        return None
+
+
+def _available_zones() -> set:
+    names = zoneinfo.available_timezones() if zoneinfo is not None else set()
+    if not names:
+        try:
+            import pytz
+            names = set(pytz.all_timezones)
+        except ImportError:
+            pass
+    return names
+
+
+class TimeZoneService:
+    """Zonas horarias de /time: objetos precargados, búsqueda por ciudad y hora por segundo
+
+    Cada zona se carga una sola vez y se reutiliza; las de ``default_zones``
+    al crear el servicio. El índice ciudad -> zona se construye con la
+    primera búsqueda a partir de todas las zonas IANA y de
+    TIME_ZONE_ALIASES: ``lookup`` prueba la coincidencia exacta, después por
+    prefijo y por último aproximada. La hora formateada de cada zona se
+    reutiliza durante el segundo en curso, así que una ráfaga de /time y del
+    botón de hora comparte el mismo texto.
+    """
+    
+    def __init__(self, default_zones: List[str] = TIME_ZONES):
+        self._zones: Dict[str, object] = {}
+        self.default_zones = [name for name in default_zones if self.zone(name) is not None]
+        self._index: Optional[Dict[str, str]] = None
+        self._keys: List[str] = []
+        self._keys_by_length: Dict[int, List[str]] = defaultdict(list)
+        self._formatted: Dict[str, Tuple[int, str]] = {}
+    
+    def zone(self, name: str):
+        if name not in self._zones:
+            self._zones[name] = _load_zone(name)
+            if self._zones[name] is None:
+                logger.warning(f"Zona horaria desconocida: {name}")
+        return self._zones[name]
+    
+    def _build_index(self):
+        index = {}
+        for name in sorted(_available_zones()):
+            index.setdefault(normalize_city(name), name)
+            if not name.startswith('Etc/'):
+                index.setdefault(normalize_city(name.rsplit('/', 1)[-1].replace('_', ' ')), name)
+        for alias, name in TIME_ZONE_ALIASES.items():
+            index[alias] = name
+        self._index = index
+        self._keys = sorted(index)
+        for key in self._keys:
+            self._keys_by_length[len(key)].append(key)
+    
+    def lookup(self, query: str) -> Optional[str]:
+        """Zona IANA para una ciudad o nombre de zona, con tolerancia a erratas"""
+        key = normalize_city(query)
+        if not key:
+            return None
+        if self._index is None:
+            self._build_index()
+        name = self._index.get(key)
+        if name is not None:
+            return name
+        position = bisect.bisect_left(self._keys, key)
+        if len(key) >= 3 and position < len(self._keys) and self._keys[position].startswith(key):
+            return self._index[self._keys[position]]
+        # Con cutoff 0.8 solo pueden coincidir claves de longitud entre 2/3 y 3/2 de la buscada
+        candidates = [candidate for length in range(math.ceil(len(key) * 2 / 3), len(key) * 3 // 2 + 1)
+                      for candidate in self._keys_by_length.get(length, ())]
+        matches = difflib.get_close_matches(key, candidates, n=1, cutoff=0.8)
+        return self._index[matches[0]] if matches else None
+    
+    def local_time(self, name: str) -> str:
+        """'AAAA-MM-DD HH:MM:SS' en la zona ``name``, calculado una vez por segundo"""
+        second = int(time.time())
+        entry = self._formatted.get(name)
+        if entry is not None and entry[0] == second:
+            return entry[1]
+        text = datetime.fromtimestamp(second, self.zone(name)).strftime('%Y-%m-%d %H:%M:%S')
+        self._formatted[name] = (second, text)
+        return text
+    
+    def label(self, name: str) -> str:
+        return TIME_ZONE_LABELS.get(name) or '🌐 ' + name.rsplit('/', 1)[-1].replace('_', ' ')
+    
+    def city(self, name: str) -> str:
+        """Etiqueta sin el emoji"""
+        return self.label(name).split(' ', 1)[-1]
+    
+    def zones_for(self, preferred: Optional[str]) -> List[str]:
+        """Zonas de /time: la del usuario (si la tiene) seguida de las de por defecto"""
+        if preferred is None or self.zone(preferred) is None:
+            return self.default_zones
+        return [preferred] + [name for name in self.default_zones if name != preferred]
+
+
+def render_time(service: TimeZoneService, zones: List[str], preferred: Optional[str] = None,
+                seconds: bool = True) -> str:
+    time_text = "🕐 *HORA ACTUAL*\n\n"
+    for name in zones:
+        label = f"📍 {service.city(name)}" if name == preferred else service.label(name)
+        local_time = service.local_time(name)
+        time_text += f"{label}: `{local_time if seconds else local_time[:16]}`\n"
+    return time_text
+
+# ============================================================================
+# VISTAS
+# ============================================================================
+
+@dataclass(frozen=True)
+class View:
+    """Contenido de una respuesta, independiente de cómo se entrega
+
+    Un comando la envía como mensaje nuevo (``reply_view``); un botón edita
+    el mensaje que lo contiene (``show_view``) o, si ``toast`` es True, la
+    muestra como notificación de la callback query sin tocar el chat.
+    """
+    text: str
+    parse_mode: Optional[str] = 'Markdown'
+    toast: bool = False
+
+
+def view_help(context: ContextTypes.DEFAULT_TYPE) -> View:
+    return View(HELP_TEXT)
+
+
+def view_info(context: ContextTypes.DEFAULT_TYPE) -> View:
+    # Bot ID y username no cambian tras la inicialización: se renderiza una vez
+    cache = context.bot_data['render_cache']
+    info_text = cache.get('info', lambda: render_info(context.application), version=0)
+    return View(info_text + metrics_registry.summary())
+
+
+async def view_stats(context: ContextTypes.DEFAULT_TYPE) -> View:
+    analytics = context.bot_data.get('analytics')
+    if not analytics:
+        return View("📊 *Estadísticas no disponibles aún*")
+    
+    # El ranking se reutiliza mientras analytics no cambie (o durante
+    # STATS_VIEW_TTL con tráfico), así que el backend solo se consulta al
+    # reconstruirlo; la actividad depende de la hora y se calcula siempre
+    cache = context.bot_data['render_cache']
+    stats_text = await cache.get_async(
+        'stats', lambda: render_leaderboard(analytics), version=analytics.cache_version, ttl=STATS_VIEW_TTL
+    )
+    if stats_text is None:
+        return View("📊 *Estadísticas no disponibles aún*")
+    
+    if not analytics.loaded:
+        stats_text += f"\n⏳ _Cargando el histórico ({analytics.load_progress:.0%}): cifras provisionales_\n"
+    
+    activity = analytics.activity
+    stats_text += f"\n📅 *Actividad hoy:* {activity.today()} interacciones"
+    stats_text += f"\n⚡ *Ritmo:* {activity.rate_per_minute():.1f} interacciones/min (últimos 5 min)"
+    peak = activity.peak_hour()
+    if peak:
+        stats_text += f"\n🔥 *Hora pico (24h):* {peak[0]:02d}:00 ({peak[1]} interacciones)"
+    return View(stats_text)
+
+
+def _preferred_zone(context: ContextTypes.DEFAULT_TYPE) -> Optional[str]:
+    return context.user_data.get('timezone') if context.user_data is not None else None
+
+
+def view_time(context: ContextTypes.DEFAULT_TYPE, zones: Optional[List[str]] = None) -> View:
+    service = context.bot_data['timezones']
+    preferred = _preferred_zone(context)
+    zones = zones or service.zones_for(preferred)
+    # Mismo texto para todas las peticiones con las mismas zonas en el mismo segundo
+    cache = context.bot_data['render_cache']
+    text = cache.get(f"time:{preferred}:{','.join(zones)}", lambda: render_time(service, zones, preferred),
+                     version=int(time.time()))
+    return View(text)
+
+
+def view_clock(context: ContextTypes.DEFAULT_TYPE) -> View:
+    service = context.bot_data['timezones']
+    zone = service.zones_for(_preferred_zone(context))[0]
+    clock = service.local_time(zone)[11:]
+    return View(f"🕐 {service.city(zone)}: {clock}", parse_mode=None, toast=True)
+
+
+def view_settings(context: ContextTypes.DEFAULT_TYPE) -> View:
+    return View("⚙️ Configuración: próximamente", parse_mode=None, toast=True)
+
+
+# Vistas accesibles desde botones ("1:v:<nombre>")
+BUTTON_VIEWS = {
+    'help': view_help,
+    'info': view_info,
+    'stats': view_stats,
+    'time': view_clock,
+    'settings': view_settings,
+}
+
+
+async def reply_view(message, view: View):
+    """Enviar una vista como mensaje nuevo (comandos)"""
+    await message.reply_text(view.text, parse_mode=view.parse_mode)
+
+
+async def show_view(query, view: View):
+    """Mostrar una vista en respuesta a un botón
+
+    Las notificaciones cortas van en la propia respuesta a la callback
+    query (una llamada). El resto edita el mensaje del botón, conservando su
+    teclado, en paralelo con la respuesta que quita el indicador de carga.
+    """
+    if view.toast:
+        await query.answer(view.text)
+        return
+    await asyncio.gather(query.answer(), _edit_with_view(query, view))
+
+
+async def _edit_with_view(query, view: View):
+    message = query.message
+    try:
+        await query.edit_message_text(view.text, parse_mode=view.parse_mode, reply_markup=message.reply_markup)
+    except BadRequest as e:
+        # Pulsar el botón de la vista ya mostrada no cambia nada
+        if 'not modified' in str(e).lower():
+            return
+        # Mensajes que no se pueden editar (p. ej. sin texto): mensaje nuevo
+        await message.reply_text(view.text, parse_mode=view.parse_mode)
+
+# ============================================================================
+# MODO INLINE
+# ============================================================================
+
+@dataclass(frozen=True)
+class InlineAnswer:
+    results: tuple
+    expires_at: float
+    personal: bool
+    # Qué texto repetir al final: None, 'argument' (echo <texto>) o 'query' (texto libre)
+    echo: Optional[str] = None
+
+
+def build_help_cards() -> List[Tuple[Tuple[str, ...], InlineQueryResultArticle]]:
+    """Un resultado inline por comando de HELP_TEXT, con las palabras por las que se encuentra"""
+    cards = []
+    seen = set()
+    for line in HELP_TEXT.splitlines():
+        usage, _, description = line.partition(' - ')
+        command = usage.split()[0][1:] if usage.startswith('/') else ''
+        if not command or not description or command in seen:
+            continue
+        seen.add(command)
+        words = tuple(dict.fromkeys(re.findall(r'\w+', normalize_city(line))))
+        cards.append((words, InlineQueryResultArticle(
+            id=f"help:{command}",
+            title=usage,
+            description=description,
+            input_message_content=InputTextMessageContent(line),
+        )))
+    return cards
+
+
+class InlineQueryEngine:
+    """Respuestas a las consultas inline (@bot ...) con caché en el servidor
+
+    * Los resultados de ayuda (uno por comando) se construyen una sola vez.
+    * Su filtrado es incremental por prefijo: cada carácter que se escribe
+      solo puede descartar resultados, así que "cal" se filtra a partir de
+      lo que ya dio "ca" en lugar de recorrer todos.
+    * Las respuestas completas se guardan en un LRU por (zona del usuario,
+      consulta normalizada) hasta que cambia lo que muestran: la hora al
+      cambiar de minuto, las estadísticas a los INLINE_STATS_CACHE_TIME
+      segundos y el resto a los INLINE_STATIC_CACHE_TIME. El tiempo que
+      queda se envía como ``cache_time`` para que Telegram atienda las
+      repeticiones, con ``is_personal`` solo si la respuesta depende de la
+      zona horaria del usuario.
+    * El resultado de repetir se construye en cada consulta a partir del
+      texto tal cual: la clave normalizada pliega mayúsculas y acentos, y
+      no debe devolver a un usuario lo que escribió otro.
+    """
+    
+    def __init__(self, capacity: int = INLINE_CACHE_SIZE):
+        self.capacity = capacity
+        self._answers: OrderedDict = OrderedDict()
+        self._filtered: OrderedDict = OrderedDict()
+        self._cards = build_help_cards()
+        self._help = InlineQueryResultArticle(
+            id='help', title='📚 Ayuda', description='Todos los comandos del bot',
+            input_message_content=InputTextMessageContent(HELP_TEXT, parse_mode='Markdown'),
+        )
+        # Resultado de estadísticas compartido por todas las consultas y su caducidad
+        self._stats: Optional[Tuple[float, Optional[InlineQueryResultArticle]]] = None
+        self.hits = 0
+        self.misses = 0
+    
+    def _remember(self, cache: OrderedDict, key, value):
+        cache[key] = value
+        cache.move_to_end(key)
+        while len(cache) > self.capacity:
+            cache.popitem(last=False)
+    
+    def filter_cards(self, text: str) -> list:
+        """Resultados de ayuda en los que cada término de ``text`` empieza alguna palabra"""
+        cards = self._filtered.get(text)
+        if cards is not None:
+            self._filtered.move_to_end(text)
+            return cards
+        base = self._cards
+        for end in range(len(text) - 1, -1, -1):
+            prefix = self._filtered.get(text[:end])
+            if prefix is not None:
+                base = prefix
+                break
+        terms = text.split()
+        cards = [card for card in base if all(any(word.startswith(term) for word in card[0]) for term in terms)]
+        self._remember(self._filtered, text, cards)
+        return cards
+    
+    async def answer(self, context: ContextTypes.DEFAULT_TYPE, query: str) -> Tuple[list, int, bool]:
+        """Resultados, ``cache_time`` e ``is_personal`` para una consulta inline"""
+        now = time.time()
+        preferred = _preferred_zone(context)
+        text = normalize_city(query)
+        key = (preferred, text)
+        entry = self._answers.get(key)
+        if entry is not None and entry.expires_at > now:
+            self.hits += 1
+            self._answers.move_to_end(key)
+            return self._with_echo(list(entry.results), entry.echo, query), int(entry.expires_at - now), \
+                entry.personal
+        
+        self.misses += 1
+        results, ttl, personal, echo = await self._build(context, text, preferred, now)
+        self._remember(self._answers, key, InlineAnswer(tuple(results), now + ttl, personal, echo))
+        return self._with_echo(results, echo, query), ttl, personal
+    
+    def _with_echo(self, results: list, echo: Optional[str], query: str) -> list:
+        """Añadir el resultado de repetir, construido con el texto original de ``query``"""
+        if echo == 'argument':
+            results.append(self._echo_result(query.split(None, 1)[1].strip()))
+        elif echo == 'query':
+            results.append(self._echo_result(query.strip()))
+        return results
+    
+    async def _build(self, context, text: str, preferred: Optional[str], now: float):
+        """Resultados cacheables de ``text`` normalizado; el de repetir lo añade ``answer``"""
+        first, _, argument = text.partition(' ')
+        
+        def wants(*keywords):
+            return any(keyword.startswith(first) for keyword in keywords)
+        
+        results = []
+        ttl = INLINE_STATIC_CACHE_TIME
+        personal = False
+        echo = None
+        if wants('hora', 'time'):
+            service = context.bot_data['timezones']
+            if argument:
+                zone = service.lookup(argument)
+                zones = [zone] if zone else []
+            else:
+                zones = service.zones_for(preferred)
+                personal = preferred is not None
+            if zones:
+                results.append(self._time_result(service, zones, preferred if not argument else None))
+                # Hasta el próximo cambio de minuto, lo que se muestra
+                ttl = min(ttl, 60 - int(now) % 60)
+        if wants('stats', 'estadisticas') and not argument:
+            expires_at, result = await self._stats_result(context, now)
+            if result is not None:
+                results.append(result)
+                ttl = min(ttl, max(0, int(expires_at - now)))
+        if wants('ayuda', 'help'):
+            results.append(self._help)
+            results.extend(card for _, card in self.filter_cards(argument))
+        if wants('echo', 'repetir') and argument:
+            echo = 'argument'
+        if not results and not echo and text:
+            # Texto libre: comandos que coinciden y repetir el texto tal cual
+            results.extend(card for _, card in self.filter_cards(text))
+            echo = 'query'
+        return results, ttl, personal, echo
+    
+    @staticmethod
+    def _time_result(service: TimeZoneService, zones: List[str], preferred: Optional[str]):
+        title = f"🕐 Hora en {service.city(zones[0])}" if len(zones) == 1 else "🕐 Hora actual"
+        description = ' · '.join(f"{service.city(name)} {service.local_time(name)[11:16]}" for name in zones)
+        return InlineQueryResultArticle(
+            id='time', title=title, description=description,
+            input_message_content=InputTextMessageContent(
+                render_time(service, zones, preferred, seconds=False), parse_mode='Markdown'),
+        )
+    
+    async def _stats_result(self, context, now: float):
+        """(caducidad, resultado): los totales se leen como mucho una vez cada INLINE_STATS_CACHE_TIME"""
+        if self._stats is None or self._stats[0] <= now:
+            self._stats = (now + INLINE_STATS_CACHE_TIME, await self._build_stats_result(context))
+        return self._stats
+    
+    @staticmethod
+    async def _build_stats_result(context):
+        analytics = context.bot_data.get('analytics')
+        if not analytics:
+            return None
+        # Solo totales: el ranking con nombres no debe salir a otros chats
+        users, messages, commands = await analytics.get_totals_async()
+        text = (f"📊 *Estadísticas del bot*\n\n"
+                f"👥 Usuarios: {users}\n📨 Mensajes: {messages}\n⚡ Comandos: {commands}")
+        if not analytics.loaded:
+            text += "\n\n_Cifras provisionales_"
+        return InlineQueryResultArticle(
+            id='stats', title='📊 Estadísticas', description=f"{users} usuarios · {messages} mensajes",
+            input_message_content=InputTextMessageContent(text, parse_mode='Markdown'),
+        )
+    
+    @staticmethod
+    def _echo_result(text: str):
+        return InlineQueryResultArticle(
+            id='echo', title='📢 Repetir', description=text[:100],
+            input_message_content=InputTextMessageContent(f"📢 {text}"),
+        )
+    
+    def metrics(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            'entries': len(self._answers),
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_ratio': round(self.hits / total, 3) if total else 0.0,
+        }
+
+# ============================================================================
+# MANEJADORES DE COMANDOS MEJORADOS
+# ============================================================================
+
+async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Manejador mejorado para /start"""
+    user = update.effective_user
+    analytics = context.bot_data.get('analytics')
+    
+    if analytics:
+        analytics.track_command(user)
+    
+    # Mensaje de bienvenida personalizado
+    welcome_text = WELCOME_TEXT.format(
+        first_name=user.first_name,
+        active_users=len(analytics.user_stats) if analytics else 'N/A',
+    )
+    
+    await update.message.reply_text(
+        welcome_text,
+        parse_mode='Markdown',
+        reply_markup=START_KEYBOARD
+    )
+    
+    # Registrar en log
+    logger.info("Nuevo usuario: %s - %s", user.id, user.username)
+
+async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Manejador mejorado para /help"""
+    await reply_view(update.message, view_help(context))
+
+async def info(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Manejador mejorado para /info"""
+    await reply_view(update.message, view_info(context))
+
+async def stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Mostrar estadísticas de uso"""
+    await reply_view(update.message, await view_stats(context))
+
+async def time_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Mostrar hora actual en diferentes zonas, o en la ciudad indicada"""
+    zones = None
+    if context.args:
+        zone = context.bot_data['timezones'].lookup(' '.join(context.args))
+        if zone is None:
+            await update.message.reply_text("❌ No encontré esa ciudad o zona horaria")
+            return
+        zones = [zone]
+    await reply_view(update.message, view_time(context, zones))
+
+async def timezone_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Consultar o guardar la zona horaria del usuario"""
+    service = context.bot_data['timezones']
+    if not context.args:
+        current = _preferred_zone(context)
+        text = f"📍 Tu zona horaria: `{current}`" if current else "📍 No tienes zona horaria configurada"
+        text += ("\n\nUso: /timezone [ciudad o zona]\n"
+                 "Ejemplos: /timezone Buenos Aires, /timezone Europe/Paris")
+        await update.message.reply_text(text, parse_mode='Markdown')
+        return
+    
+    zone = service.lookup(' '.join(context.args))
+    if zone is None:
+        await update.message.reply_text("❌ No encontré esa ciudad o zona horaria")
+        return
+    # user_data se guarda con la persistencia: /time la usa en adelante
+    context.user_data['timezone'] = zone
+    await update.message.reply_text(
+        f"✅ Zona horaria guardada: `{zone}` (ahora son las {service.local_time(zone)[11:]})",
+        parse_mode='Markdown'
+    )
+
+async def echo_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Comando /echo para repetir texto"""
+    if not context.args:
+        await update.message.reply_text("⚠️ Uso: /echo [texto]")
+        return
+    
+    text = ' '.join(context.args)
+    await update.message.reply_text(f"📢 {text}")
+
+async def calc_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Calculadora: /calc 2*(3+4), /calc sqrt(2)^10, /calc sin(x) for x in 0..1000"""
+    if not context.args:
+        await update.message.reply_text(
+            "🧮 *Calculadora*\n\n"
+            "Uso: /calc [expresión]\n\n"
+            "Ejemplos:\n"
+            "/calc 2*(3+4)\n"
+            "/calc sqrt(2)^10\n"
+            "/calc sin(x) for x in 0..1000",
+            parse_mode='Markdown'
+        )
+        return
+    
+    try:
+        text = await context.bot_data['calculator'].evaluate(' '.join(context.args))
+    except CalcError as e:
+        await update.message.reply_text(f"❌ {e}")
+        return
+    await update.message.reply_text(text, parse_mode='Markdown')
+
+async def weather_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Clima actual de una ciudad"""
+    if not context.args:
+        await update.message.reply_text(
+            "🌤 *Clima*\n\n"
+            "Uso: /weather [ciudad]\n\n"
+            "Ejemplo: /weather Madrid",
+            parse_mode='Markdown'
+        )
+        return
+    
+    try:
+        report, age = await context.bot_data['weather'].get(' '.join(context.args))
+    except WeatherError as e:
+        await update.message.reply_text(f"❌ {e}")
+        return
+    await update.message.reply_text(render_weather(report, age), parse_mode='Markdown')
+
+async def feedback_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Enviar feedback"""
+    if not context.args:
+        await update.message.reply_text(
+            "📝 *Enviar Feedback*\n\n"
+            "Uso: /feedback [tu mensaje]\n\n"
+            "Ejemplo: /feedback Me encanta el bot, pero...",
+            parse_mode='Markdown'
+        )
+        return
+    
+    feedback = ' '.join(context.args)
+    user = update.effective_user
+    
+    # Guardar feedback en archivo
+    feedback_entry = {
+        'user_id': user.id,
+        'username': user.username,
+        'first_name': user.first_name,
+        'feedback': feedback,
+        'timestamp': datetime.now().isoformat()
+    }
+    
+    try:
+        # Encolar en el almacén append-only (un único escritor)
+        await context.bot_data['feedback'].submit(feedback_entry)
+        
+        await update.message.reply_text(
+            "✅ *Feedback enviado*\n\n"
+            "¡Gracias por tu opinión! La tomaremos en cuenta para mejorar el bot.",
+            parse_mode='Markdown'
+        )
+        
+        logger.info("Feedback recibido de %s: %.50s...", user.id, feedback)
+        
+    except Exception as e:
+        logger.error(f"Error guardando feedback: {e}")
+        await update.message.reply_text("❌ Error al guardar el feedback")
+
+# ============================================================================
+# MANEJADORES DE MENSAJES MEJORADOS
+# ============================================================================
+
+async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Manejador mejorado de mensajes"""
+    user = update.effective_user
+    message = update.message.text
+    analytics = context.bot_data.get('analytics')
+    
+    if analytics:
+        analytics.track_message(user)
+    
+    # Log detallado, muestreado (1 de cada LOG_MESSAGE_SAMPLE_EVERY mensajes)
+    if sample_message_log():
+        logger.info("Mensaje de %s (@%s): %.100s...", user.id, user.username, message)
+    
+    # Respuestas inteligentes basadas en contenido
+    matcher = context.bot_data.get('keywords')
+    response = matcher.reply_for(message, user) if matcher else None
+    if response:
+        await update.message.reply_text(response)
+        return
+    
+    # Respuesta por defecto mejorada
+    import random
+    response = random.choice(DEFAULT_RESPONSES).format(first_name=user.first_name)
+    
+    # Añadir teclado rápido
+    await update.message.reply_text(response, reply_markup=QUICK_REPLY_KEYBOARD)
+
+# ============================================================================
+# MANEJADOR DE CALLBACK QUERIES
+# ============================================================================
+
+# "1:v:<vista>" y, para mensajes enviados antes del versionado, "<vista>" a secas
+VIEW_CALLBACK_PATTERN = re.compile(rf'^(?:{CALLBACK_VERSION}:v:)?({"|".join(BUTTON_VIEWS)})$')
+
+async def view_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Botón de navegación: mostrar la vista indicada en el propio mensaje"""
+    query = update.callback_query
+    view = BUTTON_VIEWS[context.match.group(1)](context)
+    if asyncio.iscoroutine(view):
+        # Vistas que leen de un backend (estadísticas)
+        view = await view
+    await show_view(query, view)
+
+async def stale_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Botón de otra versión o desconocido: avisar sin tocar el chat"""
+    await update.callback_query.answer("⚠️ Este botón ya no está disponible. Usa /start")
+
+def add_callback_handlers(application: Application, timed: Callable = lambda name, callback: callback):
+    """Registrar el enrutado de callback queries por patrón"""
+    application.add_handler(CallbackQueryHandler(timed("view_callback", view_callback),
+                                                 pattern=VIEW_CALLBACK_PATTERN))
+    # Cualquier otro callback_data (versiones antiguas, datos manipulados)
+    application.add_handler(CallbackQueryHandler(timed("stale_callback", stale_callback)))
+
+# ============================================================================
+# MANEJADOR DE CONSULTAS INLINE
+# ============================================================================
+
+async def inline_query(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Consultas inline desde cualquier chat: hora, estadísticas, ayuda y eco"""
+    results, cache_time, personal = await context.bot_data['inline'].answer(context, update.inline_query.query)
+    await update.inline_query.answer(results, cache_time=cache_time, is_personal=personal)
+
+# ============================================================================
+# MIDDLEWARE DE UPDATES
+# ============================================================================
+
+class AntiSpamThrottle:
+    """Limitador de entrada por usuario y por chat (ventana deslizante aproximada)
+
+    Cada clave guarda solo la cuenta de la ventana actual y la anterior; la
+    estimación ``anterior * fracción_restante + actual`` aproxima una
+    ventana deslizante con memoria O(1) por clave. Las tablas son LRU
+    acotadas a ``max_keys`` entradas. Los updates que superan el límite se
+    descartan antes de llegar a los handlers, a analytics o a disco; el
+    usuario recibe un único aviso por ventana.
+
+    Las consultas inline y los botones no gastan el cupo de mensajes: Telegram
+    manda una consulta inline por cada pulsación, así que llevan su propia
+    tabla por usuario con ``interaction_limit``. A un botón descartado se le
+    responde igualmente para que el cliente quite el indicador de carga.
+    """
+    
+    def __init__(self, user_limit: int = THROTTLE_USER_LIMIT, chat_limit: int = THROTTLE_CHAT_LIMIT,
+                 window: float = THROTTLE_WINDOW, max_keys: int = THROTTLE_MAX_KEYS,
+                 interaction_limit: int = THROTTLE_INTERACTION_LIMIT):
+        self.user_limit = user_limit
+        self.chat_limit = chat_limit
+        self.interaction_limit = interaction_limit
+        self.window = window
+        self.max_keys = max_keys
+        self._users: OrderedDict = OrderedDict()
+        self._chats: OrderedDict = OrderedDict()
+        self._interactions: OrderedDict = OrderedDict()
+        self.allowed = 0
+        self.dropped = 0
+    
+    def _hit(self, table: OrderedDict, key: int, limit: int, now: float) -> Tuple[bool, bool]:
+        """Registrar un intento; devuelve (permitido, primer bloqueo de la ventana)"""
+        position = now / self.window
+        index = int(position)
+        entry = table.get(key)
+        if entry is None:
+            if len(table) >= self.max_keys:
+                table.popitem(last=False)
+            # [ventana, cuenta actual, cuenta anterior, avisado]
+            entry = table[key] = [index, 0, 0, False]
+        else:
+            table.move_to_end(key)
+            if entry[0] != index:
+                entry[2] = entry[1] if entry[0] == index - 1 else 0
+                entry[1] = 0
+                entry[0] = index
+                entry[3] = False
+        
+        if entry[2] * (1 - (position - index)) + entry[1] >= limit:
+            first_block = not entry[3]
+            entry[3] = True
+            return False, first_block
+        entry[1] += 1
+        return True, False
+    
+    def check(self, user_id: Optional[int], chat_id: Optional[int], now: Optional[float] = None) -> Tuple[bool, bool]:
+        """(permitido, avisar al usuario)"""
+        now = time.monotonic() if now is None else now
+        if user_id is not None:
+            allowed, warn = self._hit(self._users, user_id, self.user_limit, now)
+            if not allowed:
+                self.dropped += 1
+                return False, warn
+        if chat_id is not None and chat_id != user_id:
+            allowed, warn = self._hit(self._chats, chat_id, self.chat_limit, now)
+            if not allowed:
+                self.dropped += 1
+                return False, warn
+        self.allowed += 1
+        return True, False
+    
+    def check_interaction(self, user_id: Optional[int], now: Optional[float] = None) -> Tuple[bool, bool]:
+        """(permitido, avisar al usuario) para consultas inline y botones"""
+        if user_id is None:
+            self.allowed += 1
+            return True, False
+        now = time.monotonic() if now is None else now
+        allowed, warn = self._hit(self._interactions, user_id, self.interaction_limit, now)
+        if allowed:
+            self.allowed += 1
+        else:
+            self.dropped += 1
+        return allowed, warn
+    
+    async def handle_update(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """TypeHandler previo a todos los demás: corta el procesamiento si hay flood"""
+        user = update.effective_user
+        chat = update.effective_chat
+        if update.inline_query or update.callback_query:
+            allowed, warn = self.check_interaction(user.id if user else None)
+        else:
+            allowed, warn = self.check(user.id if user else None, chat.id if chat else None)
+        if allowed:
+            return
+        if warn:
+            logger.warning("Flood de entrada: usuario %s en chat %s", user.id if user else '?', chat.id if chat else '?')
+        if warn or update.callback_query:
+            context.application.create_task(self._warn(update, warn), update=update)
+        raise ApplicationHandlerStop
+    
+    @staticmethod
+    async def _warn(update: Update, warn: bool = True):
+        text = "⏳ Vas demasiado rápido. Espera unos segundos antes de seguir."
+        try:
+            if update.callback_query:
+                # Sin respuesta el cliente deja el botón cargando
+                await update.callback_query.answer(text if warn else None)
+            elif update.effective_message:
+                await update.effective_message.reply_text(text)
+        except Exception as e:
+            logger.error(f"Error enviando aviso de flood: {e}")
+    
+    def metrics(self) -> dict:
+        return {
+            'allowed': self.allowed,
+            'dropped': self.dropped,
+            'tracked_users': len(self._users),
+            'tracked_chats': len(self._chats),
+            'tracked_interactions': len(self._interactions),
+        }
+
+async def track_activity(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Contar cada update por comando y tipo de handler (grupo -1, antes de los handlers)"""
+    analytics = context.bot_data.get('analytics')
+    if analytics:
+        analytics.activity.count_update(update)
+
+# ============================================================================
+# PROCESADOR DE UPDATES
+# ============================================================================
+
+class ChatOrderedUpdateProcessor(BaseUpdateProcessor):
+    """Procesa en serie los updates de un mismo chat y en paralelo los de chats distintos
+
+    - Orden: cada chat tiene su propio lock (FIFO), así que los mensajes de
+      un usuario se procesan en el orden en que llegaron.
+    - Concurrencia: como mucho ``max_running`` handlers ejecutándose a la vez;
+      el límite se aplica después del lock del chat, de modo que un chat
+      saturado no ocupa plazas que podrían usar otros chats.
+    - Backpressure: ``wait_for_capacity`` bloquea mientras haya
+      ``max_pending`` updates admitidos sin terminar (lo usan
+      BackpressureUpdateQueue en polling y webhook, y el webhook para
+      retrasar su respuesta a Telegram).
+    """
+    
+    def __init__(self, max_running: int = UPDATE_MAX_RUNNING, max_pending: int = UPDATE_MAX_PENDING):
+        # El semáforo de la clase base no limita nada: los límites se aplican
+        # en do_process_update para no bloquear chats distintos entre sí
+        super().__init__(max_concurrent_updates=sys.maxsize)
+        self.max_running = max_running
+        self.max_pending = max_pending
+        self._running_semaphore: Optional[asyncio.Semaphore] = None
+        self._chat_locks: Dict[object, asyncio.Lock] = {}
+        self._chat_depth: Dict[object, int] = defaultdict(int)
+        self._capacity: Optional[asyncio.Event] = None
+        self.pending = 0
+        self.running = 0
+        self.processed = 0
+        self.peak_pending = 0
+    
+    @staticmethod
+    def chat_key(update: object):
+        """Clave de serialización: chat del update, o usuario si no hay chat"""
+        if isinstance(update, Update):
+            if update.effective_chat:
+                return update.effective_chat.id
+            if update.effective_user:
+                return update.effective_user.id
+        return None
+    
+    async def initialize(self):
+        self._running_semaphore = asyncio.Semaphore(self.max_running)
+        self._capacity = asyncio.Event()
+        self._capacity.set()
+    
+    async def shutdown(self):
+        self._chat_locks.clear()
+        self._chat_depth.clear()
+    
+    async def wait_for_capacity(self):
+        """Esperar a que haya hueco para admitir más updates"""
+        if self._capacity is not None:
+            await self._capacity.wait()
+    
+    def _update_capacity(self):
+        if self.pending >= self.max_pending:
+            self._capacity.clear()
+        else:
+            self._capacity.set()
+    
+    async def do_process_update(self, update: object, coroutine):
+        key = self.chat_key(update)
+        self.pending += 1
+        self.peak_pending = max(self.peak_pending, self.pending)
+        self._update_capacity()
+        try:
+            if key is None:
+                async with self._running_semaphore:
+                    await self._run(coroutine)
+                return
+            
+            lock = self._chat_locks.get(key)
+            if lock is None:
+                lock = self._chat_locks[key] = asyncio.Lock()
+            self._chat_depth[key] += 1
+            try:
+                async with lock:
+                    async with self._running_semaphore:
+                        await self._run(coroutine)
+            finally:
+                self._chat_depth[key] -= 1
+                if not self._chat_depth[key]:
+                    # Sin updates pendientes: liberar el estado del chat
+                    del self._chat_depth[key]
+                    del self._chat_locks[key]
+        finally:
+            self.pending -= 1
+            self.processed += 1
+            self._update_capacity()
+    
+    async def _run(self, coroutine):
+        self.running += 1
+        try:
+            await coroutine
+        finally:
+            self.running -= 1
+    
+    def metrics(self) -> dict:
+        """Profundidad de colas y contadores para /health y métricas"""
+        return {
+            'pending': self.pending,
+            'running': self.running,
+            'waiting': self.pending - self.running,
+            'active_chats': len(self._chat_depth),
+            'max_chat_depth': max(self._chat_depth.values(), default=0),
+            'processed': self.processed,
+            'peak_pending': self.peak_pending,
+            'max_running': self.max_running,
+            'max_pending': self.max_pending,
+        }
+
+
+class BackpressureUpdateQueue(asyncio.Queue):
+    """Cola de updates de la aplicación que espera al procesador al encolar
+
+    El fetcher de PTB crea una tarea por update sin esperar a que termine,
+    así que la cola siempre está vacía y el Updater seguiría pidiendo
+    updates a Telegram sin límite. Aquí ``put`` espera a que el procesador
+    tenga hueco: en polling el Updater deja de llamar a getUpdates mientras
+    esté saturado. El exceso sobre ``max_pending`` es como mucho un lote de
+    getUpdates, que se encola de una vez antes de que arranquen sus tareas.
+    """
+    
+    def __init__(self, processor: ChatOrderedUpdateProcessor):
+        super().__init__()
+        self.processor = processor
+    
+    async def put(self, item):
+        # Las señales internas de PTB (parada) no esperan
+        if isinstance(item, Update):
+            await self.processor.wait_for_capacity()
+        await super().put(item)
+
+# ============================================================================
+# LIMITADOR DE ENVÍOS
+# ============================================================================
+
+class TokenBucket:
+    """Cubeta de tokens: ``rate`` tokens/s con ráfagas de hasta ``capacity``"""
+    
+    __slots__ = ('rate', 'capacity', 'tokens', 'updated', 'paused_until')
+    
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+    
+    def delay(self, now: float) -> float:
+        """Segundos hasta que haya un token disponible (0 si ya lo hay)"""
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.paused_until > now:
+            return self.paused_until - now
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+    
+    def consume(self):
+        self.tokens -= 1
+    
+    def pause(self, seconds: float):
+        """Bloquear la cubeta (p. ej. tras un 429 con retry_after)"""
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+        self.tokens = 0
+
+class TokenBucketRateLimiter(BaseRateLimiter):
+    """Limitador de llamadas salientes a la Bot API
+
+    Solo se limitan las llamadas con ``chat_id`` (envíos y ediciones):
+
+    1. Cubeta por chat: 1 msg/s en privados y 20 msg/min en grupos. Cada
+       petición espera a su propio chat, sin bloquear al resto. Un lock
+       FIFO por chat, que se mantiene hasta que termina la llamada (y sus
+       reintentos), hace que los envíos a un chat salgan en el orden en que
+       se pidieron.
+    2. Cubeta global (30 msg/s, ráfagas de 5) repartida por una cola de prioridad: las
+       respuestas a botones y las ediciones pasan antes que los mensajes
+       nuevos, y estos antes que los avisos de error. Las ráfagas quedan
+       en la cola y salen al ritmo de la cubeta.
+
+    Ante un 429 (RetryAfter) se bloquea la cubeta del chat (o la global)
+    durante ``retry_after`` segundos y se reintenta hasta ``max_retries``.
+    ``metrics`` da percentiles de latencia de envío y de espera en cola; si
+    se pasa ``registry``, la duración de cada llamada se exporta por endpoint.
+    """
+    
+    ENDPOINT_PRIORITIES = {
+        'answerCallbackQuery': 0,
+        'answerInlineQuery': 0,
+        'editMessageText': 1,
+        'editMessageReplyMarkup': 1,
+        'sendMessage': 2,
+    }
+    DEFAULT_PRIORITY = 3
+    
+    def __init__(self, global_rate: float = OUTBOUND_GLOBAL_RATE, global_burst: float = OUTBOUND_GLOBAL_BURST,
+                 chat_rate: float = OUTBOUND_CHAT_RATE, chat_burst: float = OUTBOUND_CHAT_BURST,
+                 group_rate: float = OUTBOUND_GROUP_RATE, max_retries: int = OUTBOUND_MAX_RETRIES,
+                 samples: int = 1000, registry: Optional['MetricsRegistry'] = None,
+                 max_in_flight: int = OUTBOUND_POOL_SIZE):
+        self.global_rate = global_rate
+        self.global_burst = global_burst
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.group_rate = group_rate
+        self.max_retries = max_retries
+        self.registry = registry
+        # Peticiones en vuelo limitadas al tamaño del pool HTTP: la espera
+        # ocurre aquí y no en la cola del pool de httpcore, cuyo reparto de
+        # conexiones es O(peticiones en espera) y que falla con PoolTimeout
+        self._in_flight = asyncio.Semaphore(max_in_flight)
+        self._global: Optional[TokenBucket] = None
+        self._chats: Dict[object, TokenBucket] = {}
+        self._chat_locks: Dict[object, asyncio.Lock] = {}
+        self._chat_depth: Dict[object, int] = defaultdict(int)
+        self._waiters: List[tuple] = []
+        self._waiter_seq = 0
+        self._dispatcher: Optional[asyncio.Task] = None
+        self._latencies = deque(maxlen=samples)
+        self._waits = deque(maxlen=samples)
+        self.sent = 0
+        self.retries = 0
+        self.failed = 0
+    
+    async def initialize(self):
+        self._global = TokenBucket(self.global_rate, self.global_burst)
+    
+    async def shutdown(self):
+        if self._dispatcher is not None:
+            self._dispatcher.cancel()
+            self._dispatcher = None
+    
+    # ------------------------------------------------------------------
+    # Cubetas
+    # ------------------------------------------------------------------
+    
+    def _chat_bucket(self, chat_id) -> TokenBucket:
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            if len(self._chats) >= OUTBOUND_MAX_CHAT_BUCKETS:
+                self._prune_chats()
+            is_group = isinstance(chat_id, str) or chat_id < 0
+            bucket = TokenBucket(self.group_rate, 1) if is_group else TokenBucket(self.chat_rate, self.chat_burst)
+            self._chats[chat_id] = bucket
+        return bucket
+    
+    def _prune_chats(self):
+        """Descartar cubetas llenas: equivalen a una cubeta nueva"""
+        now = time.monotonic()
+        for chat_id in [c for c, b in self._chats.items() if b.delay(now) == 0 and b.tokens >= b.capacity]:
+            del self._chats[chat_id]
+    
+    async def _acquire_chat(self, chat_id):
+        bucket = self._chat_bucket(chat_id)
+        while True:
+            delay = bucket.delay(time.monotonic())
+            if delay <= 0:
+                bucket.consume()
+                return
+            await asyncio.sleep(delay)
+    
+    async def _acquire_global(self, priority: int):
+        if not self._waiters and self._global.delay(time.monotonic()) <= 0:
+            self._global.consume()
+            return
+        future = asyncio.get_running_loop().create_future()
+        self._waiter_seq += 1
+        heapq.heappush(self._waiters, (priority, self._waiter_seq, future))
+        if self._dispatcher is None or self._dispatcher.done():
+            self._dispatcher = asyncio.create_task(self._dispatch())
+        await future
+    
+    async def _dispatch(self):
+        """Repartir tokens globales por orden de prioridad"""
+        while self._waiters:
+            delay = self._global.delay(time.monotonic())
+            if delay > 0:
+                await asyncio.sleep(delay)
+                continue
+            _, _, future = heapq.heappop(self._waiters)
+            if not future.done():
+                self._global.consume()
+                future.set_result(None)
+    
+    # ------------------------------------------------------------------
+    # Peticiones
+    # ------------------------------------------------------------------
+    
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        chat_id = data.get('chat_id')
+        if isinstance(chat_id, str) and chat_id.lstrip('-').isdigit():
+            chat_id = int(chat_id)
+        priority = rate_limit_args if rate_limit_args is not None else \
+            self.ENDPOINT_PRIORITIES.get(endpoint, self.DEFAULT_PRIORITY)
+        
+        start = time.monotonic()
+        if chat_id is None:
+            return await self._send(callback, args, kwargs, endpoint, None, priority, start)
+        
+        lock = self._chat_locks.get(chat_id)
+        if lock is None:
+            lock = self._chat_locks[chat_id] = asyncio.Lock()
+        self._chat_depth[chat_id] += 1
+        try:
+            async with lock:
+                return await self._send(callback, args, kwargs, endpoint, chat_id, priority, start)
+        finally:
+            self._chat_depth[chat_id] -= 1
+            if not self._chat_depth[chat_id]:
+                # Sin envíos pendientes al chat: liberar su lock
+                del self._chat_depth[chat_id]
+                del self._chat_locks[chat_id]
+    
+    async def _send(self, callback, args, kwargs, endpoint, chat_id, priority: int, start: float):
+        attempt = 0
+        while True:
+            if chat_id is not None:
+                await self._acquire_chat(chat_id)
+                await self._acquire_global(priority)
+            try:
+                async with self._in_flight:
+                    sent_at = time.monotonic()
+                    result = await callback(*args, **kwargs)
+            except RetryAfter as e:
+                self.retries += 1
+                if attempt >= self.max_retries:
+                    self.failed += 1
+                    raise
+                attempt += 1
+                bucket = self._chat_bucket(chat_id) if chat_id is not None else self._global
+                bucket.pause(float(e.retry_after))
+                logger.warning("Flood control en %s (chat %s): reintento en %ss", endpoint, chat_id, e.retry_after)
+                if chat_id is None:
+                    await asyncio.sleep(float(e.retry_after))
+                continue
+            
+            now = time.monotonic()
+            self.sent += 1
+            self._waits.append(sent_at - start)
+            self._latencies.append(now - start)
+            if self.registry is not None:
+                self.registry.observe_outbound(endpoint, now - sent_at)
+            return result
+    
+    @staticmethod
+    def _percentiles(samples) -> Dict[str, float]:
+        if not samples:
+            return {'p50': 0.0, 'p95': 0.0, 'p99': 0.0}
+        ordered = sorted(samples)
+        last = len(ordered) - 1
+        return {
+            name: round(ordered[min(last, int(len(ordered) * pct))] * 1000, 2)
+            for name, pct in (('p50', 0.50), ('p95', 0.95), ('p99', 0.99))
+        }
+    
+    def metrics(self) -> dict:
+        """Contadores y percentiles (ms) de las últimas peticiones"""
+        return {
+            'sent': self.sent,
+            'retries': self.retries,
+            'failed': self.failed,
+            'queued': len(self._waiters),
+            'chat_buckets': len(self._chats),
+            'active_chats': len(self._chat_locks),
+            'latency_ms': self._percentiles(self._latencies),
+            'queue_wait_ms': self._percentiles(self._waits),
+        }
+
+# ============================================================================
+# MÉTRICAS
+# ============================================================================
+
+class Histogram:
+    """Histograma de buckets fijos al estilo Prometheus (segundos)
+
+    ``observe`` es una búsqueda binaria y tres sumas; los cuantiles se
+    aproximan interpolando dentro del bucket, como ``histogram_quantile``.
+    """
     
-    stats_text += f"\n📅 *Actividad hoy:* {analytics.daily_stats.get(datetime.now().strftime('%Y-%m-%d'), 0)} interacciones"
+    BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
     
-    await update.message.reply_text(stats_text, parse_mode='Markdown')
-
-async def time_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Mostrar hora actual en diferentes zonas"""
-    from datetime import datetime
-    import pytz
-    
-    zones = {
-        '🌍 Madrid': 'Europe/Madrid',
-        '🇺🇸 NY': 'America/New_York',
-        '🇯🇵 Tokyo': 'Asia/Tokyo',
-        '🇦🇺 Sydney': 'Australia/Sydney'
-    }
+    __slots__ = ('buckets', 'counts', 'sum', 'count')
     
-    time_text = "🕐 *HORA ACTUAL*\n\n"
+    def __init__(self, buckets: Tuple[float, ...] = BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
     
-    for name, tz in zones.items():
-        try:
-            tz_obj = pytz.timezone(tz)
-            current_time = datetime.now(tz_obj).strftime('%Y-%m-%d %H:%M:%S')
-            time_text += f"{name}: `{current_time}`\n"
-        except:
-            time_text += f"{name}: Error\n"
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
     
-    await update.message.reply_text(time_text, parse_mode='Markdown')
-
-async def echo_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Comando /echo para repetir texto"""
-    if not context.args:
-        await update.message.reply_text("⚠️ Uso: /echo [texto]")
-        return
+    def merge(self, other: 'Histogram'):
+        self.counts = [a + b for a, b in zip(self.counts, other.counts)]
+        self.sum += other.sum
+        self.count += other.count
     
-    text = ' '.join(context.args)
-    await update.message.reply_text(f"📢 {text}")
-
-async def feedback_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Enviar feedback"""
-    if not context.args:
-        await update.message.reply_text(
-            "📝 *Enviar Feedback*\n\n"
-            "Uso: /feedback [tu mensaje]\n\n"
-            "Ejemplo: /feedback Me encanta el bot, pero...",
-            parse_mode='Markdown'
-        )
-        return
+    def quantile(self, q: float) -> float:
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        cumulative = 0
+        for i, count in enumerate(self.counts):
+            if cumulative + count >= rank and count:
+                if i == len(self.buckets):
+                    return self.buckets[-1]
+                lower = self.buckets[i - 1] if i else 0.0
+                return lower + (self.buckets[i] - lower) * (rank - cumulative) / count
+            cumulative += count
+        return self.buckets[-1]
     
-    feedback = ' '.join(context.args)
-    user = update.effective_user
+    def render(self, name: str, labels: str = '') -> List[str]:
+        prefix = f'{labels},' if labels else ''
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            lines.append(f'{name}_bucket{{{prefix}le="{bound}"}} {cumulative}')
+        lines.append(f'{name}_bucket{{{prefix}le="+Inf"}} {self.count}')
+        suffix = f'{{{labels}}}' if labels else ''
+        lines.append(f'{name}_sum{suffix} {self.sum:.6f}')
+        lines.append(f'{name}_count{suffix} {self.count}')
+        return lines
+
+
+class MetricsRegistry:
+    """Métricas del bot: latencia por handler, errores, lag del loop y API saliente
+
+    Todo se actualiza desde el event loop, sin locks. ``render`` produce el
+    formato de texto de Prometheus para ``/metrics`` y ``summary`` el
+    resumen que se muestra en /info.
+    """
     
-    # Guardar feedback en archivo
-    feedback_entry = {
-        'user_id': user.id,
-        'username': user.username,
-        'first_name': user.first_name,
-        'feedback': feedback,
-        'timestamp': datetime.now().isoformat()
-    }
+    def __init__(self):
+        self.handler_latency: Dict[str, Histogram] = defaultdict(Histogram)
+        self.errors: Dict[str, int] = defaultdict(int)
+        self.outbound_latency: Dict[str, Histogram] = defaultdict(Histogram)
+        self.upstream_latency: Dict[str, Histogram] = defaultdict(Histogram)
+        self.loop_lag = Histogram()
+        self._monitor: Optional[asyncio.Task] = None
     
-    try:
-        # Cargar feedback existente
-        feedbacks = []
-        if os.path.exists('feedback.json'):
-            with open('feedback.json', 'r', encoding='utf-8') as f:
-                feedbacks = json.load(f)
-        
-        # Añadir nuevo feedback
-        feedbacks.append(feedback_entry)
-        
-        # Guardar - CORREGIDO: ensure_ascii=False solo una vez
-        with open('feedback.json', 'w', encoding='utf-8') as f:
-            json.dump(feedbacks, f, indent=2, ensure_ascii=False)  # <-- CORRECCIÓN AQUÍ
-        
-        await update.message.reply_text(
-            "✅ *Feedback enviado*\n\n"
-            "¡Gracias por tu opinión! La tomaremos en cuenta para mejorar el bot.",
-            parse_mode='Markdown'
-        )
+    def instrument(self, name: str, callback):
+        """Envolver un handler para medir su duración"""
+        histogram = self.handler_latency[name]
         
-        logger.info(f"Feedback recibido de {user.id}: {feedback[:50]}...")
+        @wraps(callback)
+        async def timed(update, context):
+            start = time.perf_counter()
+            try:
+                return await callback(update, context)
+            finally:
+                histogram.observe(time.perf_counter() - start)
         
-    except Exception as e:
-        logger.error(f"Error guardando feedback: {e}")
-        await update.message.reply_text("❌ Error al guardar el feedback")
-
-# ============================================================================
-# MANEJADORES DE MENSAJES MEJORADOS
-# ============================================================================
-
-async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Manejador mejorado de mensajes"""
-    user = update.effective_user
-    message = update.message.text
-    analytics = context.bot_data.get('analytics')
+        return timed
     
-    if analytics:
-        analytics.track_message(user)
+    def observe_outbound(self, endpoint: str, seconds: float):
+        self.outbound_latency[endpoint].observe(seconds)
     
-    # Log detallado
-    logger.info(f"Mensaje de {user.id} (@{user.username}): {message[:100]}...")
+    def observe_upstream(self, provider: str, seconds: float):
+        """Llamadas a servicios externos distintos de la Bot API (clima)"""
+        self.upstream_latency[provider].observe(seconds)
     
-    # Respuestas inteligentes basadas en contenido
-    message_lower = message.lower()
-    
-    responses = {
-        'hola': f"¡Hola {user.first_name}! ¿Cómo estás? 😊",
-        'adios': "¡Hasta luego! Espero verte pronto 👋",
-        'gracias': "¡De nada! Estoy aquí para ayudarte 🤖",
-        'bot': "¡Sí, soy un bot! Pero trato de ser útil 🤖",
-        'ayuda': "¿Necesitas ayuda? Usa /help para ver todos los comandos 📚",
-        'fecha': f"Hoy es {datetime.now().strftime('%d/%m/%Y')} 📅",
-        'hora': f"Son las {datetime.now().strftime('%H:%M')} 🕐",
-    }
+    def count_error(self, category: str):
+        self.errors[category] += 1
     
-    # Buscar respuesta predefinida
-    for keyword, response in responses.items():
-        if keyword in message_lower:
-            await update.message.reply_text(response)
-            return
+    # ------------------------------------------------------------------
+    # Lag del event loop
+    # ------------------------------------------------------------------
     
-    # Respuesta por defecto mejorada
-    default_responses = [
-        f"Interesante, {user.first_name}. ¿En qué más puedo ayudarte?",
-        f"¡Gracias por tu mensaje, {user.first_name}!",
-        f"Lo tengo en cuenta, {user.first_name}. ¿Algo más?",
-        f"¿Necesitas que haga algo específico, {user.first_name}?",
-    ]
+    async def _monitor_loop(self, interval: float):
+        """Medir cuánto se retrasa un sleep: tiempo que el loop estuvo ocupado"""
+        loop = asyncio.get_running_loop()
+        while True:
+            expected = loop.time() + interval
+            await asyncio.sleep(interval)
+            self.loop_lag.observe(max(0.0, loop.time() - expected))
     
-    import random
-    response = random.choice(default_responses)
+    def start_loop_monitor(self, interval: float = LOOP_LAG_INTERVAL):
+        if self._monitor is None or self._monitor.done():
+            self._monitor = asyncio.get_running_loop().create_task(self._monitor_loop(interval))
     
-    # Añadir teclado rápido
-    keyboard = [
-        [InlineKeyboardButton("📋 Ayuda", callback_data="help"),
-         InlineKeyboardButton("ℹ️ Info", callback_data="info")],
-        [InlineKeyboardButton("🕐 Hora", callback_data="time"),
-         InlineKeyboardButton("📊 Stats", callback_data="stats")]
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    def stop_loop_monitor(self):
+        if self._monitor is not None:
+            self._monitor.cancel()
+            self._monitor = None
+    
+    # ------------------------------------------------------------------
+    # Exportación
+    # ------------------------------------------------------------------
     
-    await update.message.reply_text(response, reply_markup=reply_markup)
+    def render(self) -> str:
+        lines = [
+            '# HELP bot_handler_latency_seconds Duración de cada handler',
+            '# TYPE bot_handler_latency_seconds histogram',
+        ]
+        for name, histogram in sorted(self.handler_latency.items()):
+            lines.extend(histogram.render('bot_handler_latency_seconds', f'handler="{name}"'))
+        lines += [
+            '# HELP bot_errors_total Errores por categoría de error_handler',
+            '# TYPE bot_errors_total counter',
+        ]
+        lines.extend(f'bot_errors_total{{category="{category}"}} {count}'
+                     for category, count in sorted(self.errors.items()))
+        lines += [
+            '# HELP bot_event_loop_lag_seconds Retraso del event loop',
+            '# TYPE bot_event_loop_lag_seconds histogram',
+        ]
+        lines.extend(self.loop_lag.render('bot_event_loop_lag_seconds'))
+        lines += [
+            '# HELP bot_outbound_latency_seconds Duración de las llamadas a la Bot API',
+            '# TYPE bot_outbound_latency_seconds histogram',
+        ]
+        for endpoint, histogram in sorted(self.outbound_latency.items()):
+            lines.extend(histogram.render('bot_outbound_latency_seconds', f'endpoint="{endpoint}"'))
+        lines += [
+            '# HELP bot_upstream_latency_seconds Duración de las llamadas a servicios externos',
+            '# TYPE bot_upstream_latency_seconds histogram',
+        ]
+        for provider, histogram in sorted(self.upstream_latency.items()):
+            lines.extend(histogram.render('bot_upstream_latency_seconds', f'provider="{provider}"'))
+        return '\n'.join(lines) + '\n'
+    
+    def summary(self) -> str:
+        """Resumen en Markdown para /info"""
+        handled = sum(h.count for h in self.handler_latency.values())
+        slowest = sorted(
+            ((h.quantile(0.99), name) for name, h in self.handler_latency.items() if h.count),
+            reverse=True
+        )[:3]
+        outbound = Histogram()
+        for histogram in self.outbound_latency.values():
+            outbound.merge(histogram)
+        
+        text = "\n📉 *Rendimiento:*\n"
+        text += f"- Updates atendidos: {handled}\n"
+        for p99, name in slowest:
+            text += f"- {name}: p99 {p99 * 1000:.1f} ms\n"
+        text += f"- Errores: {sum(self.errors.values())}\n"
+        text += f"- Lag del event loop p99: {self.loop_lag.quantile(0.99) * 1000:.1f} ms\n"
+        text += (f"- API de Telegram p50/p99: {outbound.quantile(0.5) * 1000:.1f} / "
+                 f"{outbound.quantile(0.99) * 1000:.1f} ms\n")
+        return text
 
-# ============================================================================
-# MANEJADOR DE CALLBACK QUERIES
-# ============================================================================
 
-async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Manejador de botones inline"""
-    query = update.callback_query
-    await query.answer()
+metrics_registry = MetricsRegistry()
+
+
+class MetricsServer:
+    """Servidor aiohttp mínimo con ``GET /metrics`` en ``METRICS_LISTEN`` (polling y webhook)"""
     
-    data = query.data
+    def __init__(self, registry: MetricsRegistry, listen: str = METRICS_LISTEN, port: int = METRICS_PORT):
+        self.registry = registry
+        self.listen = listen
+        self.port = port
+        self._runner = None
     
-    handlers = {
-        'help': help_command,
-        'info': info,
-        'stats': stats_command,
-        'settings': lambda u, c: u.callback_query.message.reply_text("⚙️ *Configuración*\n\nPróximamente...", parse_mode='Markdown'),
-        'time': lambda u, c: u.callback_query.message.reply_text(f"🕐 Hora actual: {datetime.now().strftime('%H:%M:%S')}"),
-    }
+    async def handle_metrics(self, request):
+        from aiohttp import web
+        return web.Response(text=self.registry.render(), content_type='text/plain', charset='utf-8')
     
-    if data in handlers:
-        # Crear un update simulado para el handler
-        fake_update = Update(
-            update_id=update.update_id,
-            message=query.message,
-            callback_query=query
-        )
-        await handlers[data](fake_update, context)
-    else:
-        await query.message.reply_text(f"Acción: {data}")
+    async def start(self):
+        from aiohttp import web
+        app = web.Application()
+        app.router.add_get('/metrics', self.handle_metrics)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, self.listen, self.port).start()
+        logger.info(f"📈 Métricas en http://{self.listen}:{self.port}/metrics")
+    
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
 
 # ============================================================================
 # MANEJO DE ERRORES MEJORADO
@@ -541,7 +4418,7 @@ async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE):
     error = context.error
     
     # Log del error
-    logger.error(f"Exception while handling an update: {error}", exc_info=error)
+    logger.error("Exception while handling an update: %s", error, exc_info=error)
     
     # Clasificación de errores
     error_messages = {
@@ -556,10 +4433,13 @@ async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE):
     error_str = str(error)
     user_message = "❌ Ocurrió un error inesperado. Por favor, intenta nuevamente."
     
+    category = 'other'
     for key, message in error_messages.items():
         if key in error_str:
             user_message = message
+            category = key.lower().replace(' ', '_')
             break
+    metrics_registry.count_error(category)
     
     # Enviar mensaje al usuario si es posible
     try:
@@ -568,6 +4448,302 @@ async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE):
     except Exception as e:
         logger.error(f"Error enviando mensaje de error: {e}")
 
+# ============================================================================
+# PERSISTENCIA
+# ============================================================================
+
+# Objetos de runtime guardados en bot_data: no se copian ni se persisten
+RUNTIME_BOT_DATA_KEYS = frozenset({'analytics', 'feedback', 'keywords', 'render_cache', 'metrics_server',
+                                   'calculator', 'weather', 'timezones', 'inline'})
+
+
+class BotData(dict):
+    """bot_data que deja fuera de las copias los objetos de runtime
+
+    La Application hace ``deepcopy(bot_data)`` en cada volcado de
+    persistencia; con este tipo la copia solo contiene datos serializables.
+    """
+    
+    def persistable(self) -> dict:
+        return {key: value for key, value in self.items() if key not in RUNTIME_BOT_DATA_KEYS}
+    
+    def __deepcopy__(self, memo):
+        return copy.deepcopy(self.persistable(), memo)
+
+
+class SQLitePersistence(BasePersistence):
+    """Persistencia incremental en SQLite: una fila por usuario, chat o clave
+
+    A diferencia de PicklePersistence, que reescribe el fichero completo en
+    cada volcado, aquí solo se escriben las filas cuyo pickle cambió desde
+    la última escritura (se compara su hash), en una transacción por lote.
+    user_data y chat_data no se cargan al arrancar: ``refresh_*_data`` lee
+    la fila de cada usuario o chat la primera vez que aparece.
+    """
+    
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS user_data (id INTEGER PRIMARY KEY, data BLOB NOT NULL);
+        CREATE TABLE IF NOT EXISTS chat_data (id INTEGER PRIMARY KEY, data BLOB NOT NULL);
+        CREATE TABLE IF NOT EXISTS bot_data (id BLOB PRIMARY KEY, data BLOB NOT NULL);
+        CREATE TABLE IF NOT EXISTS callback_data (id INTEGER PRIMARY KEY, data BLOB NOT NULL);
+        CREATE TABLE IF NOT EXISTS conversations (
+            name TEXT NOT NULL,
+            id TEXT NOT NULL,
+            data BLOB NOT NULL,
+            PRIMARY KEY (name, id)
+        );
+    """
+    
+    TABLES = ('user_data', 'chat_data', 'bot_data', 'callback_data')
+    
+    def __init__(self, path: str = PERSISTENCE_FILE, update_interval: float = PERSISTENCE_UPDATE_INTERVAL):
+        super().__init__(update_interval=update_interval)
+        self.path = path
+        self._conn = None
+        self._io_lock = threading.RLock()
+        # Hash del último pickle escrito por (tabla, id): evita reescribir filas iguales
+        self._digests: Dict[tuple, int] = {}
+        self._loaded = {'user_data': set(), 'chat_data': set()}
+        # Lecturas en curso por (tabla, id): los updates concurrentes del mismo id esperan a la primera
+        self._loading: Dict[tuple, asyncio.Event] = {}
+        # Cambios pendientes de escribir; None significa borrar la fila
+        self._pending: Dict[tuple, Optional[bytes]] = {}
+        self._commit_task: Optional[asyncio.Task] = None
+        self.rows_written = 0
+    
+    def _connection(self):
+        if self._conn is None:
+            import sqlite3
+            # Las escrituras se hacen desde hilos del pool de asyncio
+            self._conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.executescript(self.SCHEMA)
+            if os.path.exists(PERSISTENCE_LEGACY_FILE) and self._is_empty():
+                self._migrate_legacy()
+        return self._conn
+    
+    def _is_empty(self) -> bool:
+        return not any(
+            self._conn.execute(f"SELECT 1 FROM {table} LIMIT 1").fetchone()
+            for table in self.TABLES + ('conversations',)
+        )
+    
+    def _migrate_legacy(self):
+        """Importar el bot_data.pickle de PicklePersistence"""
+        try:
+            with open(PERSISTENCE_LEGACY_FILE, 'rb') as f:
+                unpickler = pickle.Unpickler(f)
+                # PicklePersistence guarda las referencias al Bot como ids persistentes
+                unpickler.persistent_load = lambda pid: None
+                legacy = unpickler.load()
+            rows = {}
+            for table in ('user_data', 'chat_data'):
+                for key, data in (legacy.get(table) or {}).items():
+                    rows[(table, key)] = pickle.dumps(data, pickle.HIGHEST_PROTOCOL)
+            for key, value in (legacy.get('bot_data') or {}).items():
+                if key not in RUNTIME_BOT_DATA_KEYS:
+                    rows[('bot_data', pickle.dumps(key))] = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+            if legacy.get('callback_data') is not None:
+                rows[('callback_data', 0)] = pickle.dumps(legacy['callback_data'], pickle.HIGHEST_PROTOCOL)
+            for name, states in (legacy.get('conversations') or {}).items():
+                for key, state in states.items():
+                    rows[(name, json.dumps(list(key)))] = pickle.dumps(state, pickle.HIGHEST_PROTOCOL)
+            self._write(rows)
+            os.replace(PERSISTENCE_LEGACY_FILE, PERSISTENCE_LEGACY_FILE + '.migrated')
+            logger.info(f"Persistencia migrada a {self.path}: {len(rows)} filas")
+        except Exception as e:
+            logger.error(f"Error migrando {PERSISTENCE_LEGACY_FILE}: {e}")
+    
+    def _read(self, table: str, key) -> Optional[bytes]:
+        with self._io_lock:
+            row = self._connection().execute(f"SELECT data FROM {table} WHERE id = ?", (key,)).fetchone()
+        return row[0] if row else None
+    
+    def _read_all(self, table: str) -> List[tuple]:
+        with self._io_lock:
+            return self._connection().execute(f"SELECT id, data FROM {table}").fetchall()
+    
+    def _write(self, rows: Dict[tuple, Optional[bytes]]):
+        """Aplicar un lote de filas en una única transacción"""
+        with self._io_lock:
+            conn = self._connection()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                for (table, key), blob in rows.items():
+                    if table in self.TABLES:
+                        if blob is None:
+                            conn.execute(f"DELETE FROM {table} WHERE id = ?", (key,))
+                        else:
+                            conn.execute(f"INSERT OR REPLACE INTO {table} (id, data) VALUES (?, ?)", (key, blob))
+                    elif blob is None:
+                        conn.execute("DELETE FROM conversations WHERE name = ? AND id = ?", (table, key))
+                    else:
+                        conn.execute(
+                            "INSERT OR REPLACE INTO conversations (name, id, data) VALUES (?, ?, ?)",
+                            (table, key, blob)
+                        )
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+            self.rows_written += len(rows)
+    
+    # --- Escrituras diferidas ---------------------------------------------
+    
+    def _stage(self, table: str, key, data):
+        blob = pickle.dumps(data, pickle.HIGHEST_PROTOCOL)
+        digest = hash(blob)
+        if self._digests.get((table, key)) == digest:
+            return
+        self._digests[(table, key)] = digest
+        self._pending[(table, key)] = blob
+        self._schedule_commit()
+    
+    def _stage_delete(self, table: str, key):
+        self._digests.pop((table, key), None)
+        self._pending[(table, key)] = None
+        self._schedule_commit()
+    
+    def _schedule_commit(self):
+        # La Application lanza todos los update_* de un volcado a la vez; la
+        # tarea arranca después de todos ellos y los escribe en un solo lote
+        if self._commit_task is None or self._commit_task.done():
+            self._commit_task = asyncio.get_running_loop().create_task(self._commit())
+    
+    async def _commit(self):
+        while self._pending:
+            rows, self._pending = self._pending, {}
+            try:
+                await asyncio.to_thread(self._write, rows)
+            except Exception as e:
+                logger.error(f"Error escribiendo persistencia: {e}")
+                # Olvidar los hashes para reintentar en el próximo volcado
+                for key in rows:
+                    self._digests.pop(key, None)
+                return
+    
+    # --- Lectura ------------------------------------------------------------
+    
+    async def get_user_data(self) -> Dict[int, dict]:
+        # Carga bajo demanda en refresh_user_data
+        return {}
+    
+    async def get_chat_data(self) -> Dict[int, dict]:
+        # Carga bajo demanda en refresh_chat_data
+        return {}
+    
+    async def get_bot_data(self) -> BotData:
+        bot_data = BotData()
+        for key, blob in await asyncio.to_thread(self._read_all, 'bot_data'):
+            self._digests[('bot_data', key)] = hash(blob)
+            bot_data[pickle.loads(key)] = pickle.loads(blob)
+        return bot_data
+    
+    async def get_callback_data(self):
+        blob = await asyncio.to_thread(self._read, 'callback_data', 0)
+        return pickle.loads(blob) if blob is not None else None
+    
+    async def get_conversations(self, name: str) -> dict:
+        def read():
+            with self._io_lock:
+                return self._connection().execute(
+                    "SELECT id, data FROM conversations WHERE name = ?", (name,)
+                ).fetchall()
+        return {tuple(json.loads(key)): pickle.loads(blob) for key, blob in await asyncio.to_thread(read)}
+    
+    async def _load_into(self, table: str, key: int, target: dict):
+        """Cargar la fila de ``key`` la primera vez que se usa
+
+        Solo se marca como cargada cuando los datos ya están en ``target``;
+        mientras tanto, otros updates del mismo id (p. ej. el usuario en otro
+        chat) esperan a esa lectura en lugar de ver un diccionario vacío.
+        """
+        loaded = self._loaded[table]
+        while key not in loaded:
+            reading = self._loading.get((table, key))
+            if reading is not None:
+                # Si la lectura falla, se vuelve a intentar aquí
+                await reading.wait()
+                continue
+            reading = self._loading[(table, key)] = asyncio.Event()
+            try:
+                blob = await asyncio.to_thread(self._read, table, key)
+                if blob is not None:
+                    self._digests[(table, key)] = hash(blob)
+                    for name, value in pickle.loads(blob).items():
+                        target.setdefault(name, value)
+                loaded.add(key)
+            finally:
+                del self._loading[(table, key)]
+                reading.set()
+    
+    async def refresh_user_data(self, user_id: int, user_data: dict) -> None:
+        await self._load_into('user_data', user_id, user_data)
+    
+    async def refresh_chat_data(self, chat_id: int, chat_data: dict) -> None:
+        await self._load_into('chat_data', chat_id, chat_data)
+    
+    async def refresh_bot_data(self, bot_data: BotData) -> None:
+        pass
+    
+    # --- Escritura ----------------------------------------------------------
+    
+    def _update(self, table: str, key: int, data: dict):
+        # Un id que nunca se cargó y sigue vacío, o cuya fila se está leyendo,
+        # no debe pisar la fila guardada
+        if (key not in self._loaded[table] and not data) or (table, key) in self._loading:
+            return
+        self._loaded[table].add(key)
+        self._stage(table, key, data)
+    
+    async def update_user_data(self, user_id: int, data: dict) -> None:
+        self._update('user_data', user_id, data)
+    
+    async def update_chat_data(self, chat_id: int, data: dict) -> None:
+        self._update('chat_data', chat_id, data)
+    
+    async def update_bot_data(self, data: dict) -> None:
+        keys = set()
+        for name, value in data.items():
+            if name in RUNTIME_BOT_DATA_KEYS:
+                continue
+            key = pickle.dumps(name)
+            keys.add(key)
+            self._stage('bot_data', key, value)
+        for table, key in list(self._digests):
+            if table == 'bot_data' and key not in keys:
+                self._stage_delete('bot_data', key)
+    
+    async def update_callback_data(self, data) -> None:
+        self._stage('callback_data', 0, data)
+    
+    async def update_conversation(self, name: str, key, new_state) -> None:
+        row_key = json.dumps(list(key))
+        if new_state is None:
+            self._stage_delete(name, row_key)
+        else:
+            self._stage(name, row_key, new_state)
+    
+    async def drop_user_data(self, user_id: int) -> None:
+        self._loaded['user_data'].discard(user_id)
+        self._stage_delete('user_data', user_id)
+    
+    async def drop_chat_data(self, chat_id: int) -> None:
+        self._loaded['chat_data'].discard(chat_id)
+        self._stage_delete('chat_data', chat_id)
+    
+    async def flush(self) -> None:
+        """Escribir lo pendiente y cerrar la conexión (al apagar)"""
+        if self._commit_task is not None:
+            await self._commit_task
+        await self._commit()
+        with self._io_lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+
 # ============================================================================
 # FUNCIONES UTILITARIAS
 # ============================================================================
@@ -575,43 +4751,650 @@ async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE):
 def setup_persistence():
     """Configurar persistencia de datos"""
     try:
-        persistence = PicklePersistence(filepath='bot_data.pickle')
+        persistence = SQLitePersistence()
         logger.info("Persistencia configurada correctamente")
         return persistence
     except Exception as e:
         logger.error(f"Error configurando persistencia: {e}")
         return None
 
+async def flush_stats_job(context: ContextTypes.DEFAULT_TYPE):
+    """Job periódico: volcar estadísticas pendientes fuera del event loop"""
+    analytics = context.bot_data.get('analytics')
+    if analytics:
+        await analytics.flush_async()
+
+# Referencia global para el volcado final desde el manejador de señales
+analytics_middleware: Optional[AnalyticsMiddleware] = None
+# Tareas lanzadas desde post_init (el event loop solo guarda referencias débiles)
+_startup_tasks: set = set()
+
 async def post_init(application: Application):
     """Tareas posteriores a la inicialización"""
+    global analytics_middleware
     logger.info("Bot inicializado correctamente")
     
-    # Inicializar analytics
-    application.bot_data['analytics'] = AnalyticsMiddleware()
+    # Inicializar analytics: el histórico se carga en segundo plano y el bot
+    # atiende updates desde ya con cifras provisionales
+    analytics_middleware = AnalyticsMiddleware(load=False)
+    analytics_middleware.start_loading()
+    application.bot_data['analytics'] = analytics_middleware
+    
+    # Volcado periódico de estadísticas
+    if application.job_queue:
+        application.job_queue.run_repeating(
+            flush_stats_job,
+            interval=STATS_FLUSH_INTERVAL,
+            first=STATS_FLUSH_INTERVAL,
+            name='flush_stats'
+        )
+    else:
+        logger.warning("JobQueue no disponible: las estadísticas se guardarán al cerrar")
+    
+    # Lag del event loop y endpoint /metrics
+    metrics_registry.start_loop_monitor()
+    if METRICS_PORT:
+        metrics_server = MetricsServer(metrics_registry)
+        try:
+            await metrics_server.start()
+            application.bot_data['metrics_server'] = metrics_server
+        except Exception as e:
+            logger.error(f"Error iniciando servidor de métricas: {e}")
+    
+    # Caché de vistas renderizadas (/info, ranking de /stats)
+    application.bot_data['render_cache'] = RenderCache()
+    
+    # Calculadora: los procesos de cálculo se crean con la primera expresión costosa
+    application.bot_data['calculator'] = Calculator()
+    
+    # Zonas horarias de /time, cargadas una sola vez
+    application.bot_data['timezones'] = TimeZoneService()
+    
+    # Modo inline: resultados de ayuda precalculados y respuestas en caché
+    application.bot_data['inline'] = InlineQueryEngine()
+    
+    # Clima: la sesión HTTP compartida se abre con la primera consulta
+    application.bot_data['weather'] = WeatherService()
+    
+    # Motor de respuestas automáticas, compilado una sola vez
+    application.bot_data['keywords'] = KeywordMatcher.from_file()
+    
+    # Almacén de feedback con escritor único
+    feedback_store = FeedbackStore()
+    await feedback_store.start()
+    application.bot_data['feedback'] = feedback_store
     
-    # Configurar comandos del bot en Telegram
+    # Configurar comandos del bot en Telegram, sin retrasar el arranque
+    # (en modo sharded lo hace solo el frontal)
+    if not SHARD_INDEX:
+        task = asyncio.get_running_loop().create_task(set_bot_commands(application.bot))
+        _startup_tasks.add(task)
+        task.add_done_callback(_startup_tasks.discard)
+
+async def set_bot_commands(bot):
+    """Publicar la lista de comandos en Telegram"""
     commands = [
         ('start', 'Iniciar el bot'),
         ('help', 'Ayuda completa'),
         ('info', 'Información del bot'),
         ('stats', 'Estadísticas de uso'),
         ('time', 'Hora actual'),
+        ('timezone', 'Tu zona horaria'),
         ('echo', 'Repetir texto'),
+        ('calc', 'Calculadora'),
+        ('weather', 'Clima actual'),
         ('feedback', 'Enviar feedback'),
     ]
     
     try:
-        await application.bot.set_my_commands(commands)
+        await bot.set_my_commands(commands)
         logger.info("Comandos configurados en Telegram")
     except Exception as e:
         logger.error(f"Error configurando comandos: {e}")
 
+async def post_shutdown(application: Application):
+    """Volcado final de estadísticas y feedback al detener el bot"""
+    metrics_registry.stop_loop_monitor()
+    metrics_server = application.bot_data.get('metrics_server')
+    if metrics_server:
+        await metrics_server.stop()
+    
+    feedback_store = application.bot_data.get('feedback')
+    if feedback_store:
+        await feedback_store.stop()
+    
+    calculator = application.bot_data.get('calculator')
+    if calculator:
+        calculator.shutdown()
+    
+    weather = application.bot_data.get('weather')
+    if weather:
+        await weather.close()
+    
+    analytics = application.bot_data.get('analytics')
+    if analytics:
+        await analytics.wait_loaded()
+        analytics.close()
+        logger.info("💾 Estadísticas guardadas")
+
+# ============================================================================
+# MODO WEBHOOK
+# ============================================================================
+
+class WebhookServer:
+    """Servidor aiohttp que recibe updates de Telegram por webhook
+
+    - ``POST {path}``: valida ``X-Telegram-Bot-Api-Secret-Token`` y encola el
+      update en ``application.update_queue``. También acepta una lista de
+      updates (lotes del proceso frontal del modo sharded), que se encolan en orden.
+    - ``GET /health``: estado y updates pendientes.
+
+    ``/metrics`` no se sirve aquí (el listener suele ser público): lo sirve
+    MetricsServer en ``METRICS_LISTEN``.
+
+    Al parar deja de aceptar updates (responde 503, Telegram los reintenta)
+    y espera a que se procesen los ya encolados antes de devolver el control.
+    """
+    
+    def __init__(self, application: Application, listen: str = WEBHOOK_LISTEN, port: int = WEBHOOK_PORT,
+                 path: str = WEBHOOK_PATH, secret_token: Optional[str] = WEBHOOK_SECRET_TOKEN):
+        self.application = application
+        self.listen = listen
+        self.port = port
+        self.path = path
+        self.secret_token = secret_token
+        self.received = 0
+        self.rejected = 0
+        self._draining = False
+        self._runner = None
+        self._started_at = None
+    
+    def build_app(self):
+        from aiohttp import web
+        app = web.Application()
+        app.router.add_post(self.path, self.handle_update)
+        app.router.add_get('/health', self.handle_health)
+        return app
+    
+    async def handle_update(self, request):
+        from aiohttp import web
+        if self.secret_token:
+            received = request.headers.get('X-Telegram-Bot-Api-Secret-Token', '')
+            if not hmac.compare_digest(received, self.secret_token):
+                self.rejected += 1
+                return web.Response(status=403)
+        if self._draining:
+            return web.Response(status=503)
+        
+        # Backpressure: retrasar la respuesta mientras el procesador esté saturado
+        processor = self.application.update_processor
+        if isinstance(processor, ChatOrderedUpdateProcessor):
+            await processor.wait_for_capacity()
+        
+        try:
+            data = await request.json()
+            updates = [Update.de_json(item, self.application.bot)
+                       for item in (data if isinstance(data, list) else [data])]
+        except Exception as e:
+            logger.warning(f"Update de webhook inválido: {e}")
+            return web.Response(status=400)
+        
+        for update in updates:
+            await self.application.update_queue.put(update)
+        self.received += len(updates)
+        return web.Response()
+    
+    async def handle_health(self, request):
+        from aiohttp import web
+        health = {
+            'status': 'draining' if self._draining else 'ok',
+            'pending_updates': self.application.update_queue.qsize(),
+            'received': self.received,
+            'rejected': self.rejected,
+            'uptime': round(time.monotonic() - self._started_at, 1) if self._started_at else 0,
+        }
+        processor = self.application.update_processor
+        if isinstance(processor, ChatOrderedUpdateProcessor):
+            health['processor'] = processor.metrics()
+        rate_limiter = getattr(self.application.bot, 'rate_limiter', None)
+        if isinstance(rate_limiter, TokenBucketRateLimiter):
+            health['outbound'] = rate_limiter.metrics()
+        render_cache = self.application.bot_data.get('render_cache')
+        if render_cache is not None:
+            health['render_cache'] = render_cache.metrics()
+        return web.json_response(health)
+    
+    async def start(self):
+        from aiohttp import web
+        self._runner = web.AppRunner(self.build_app(), access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, self.listen, self.port)
+        await site.start()
+        self._started_at = time.monotonic()
+        logger.info(f"🌐 Webhook escuchando en {self.listen}:{self.port}{self.path}")
+    
+    async def drain(self, timeout: float = WEBHOOK_DRAIN_TIMEOUT):
+        """Rechazar updates nuevos y esperar a que se procesen los encolados"""
+        self._draining = True
+        try:
+            await asyncio.wait_for(self.application.update_queue.join(), timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f"Drenado incompleto: {self.application.update_queue.qsize()} updates pendientes")
+    
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+async def run_webhook(application: Application):
+    """Ciclo de vida completo en modo webhook (equivalente a run_polling)"""
+    import signal
+    
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop_event.set)
+    
+    server = WebhookServer(application)
+    await application.initialize()
+    try:
+        # run_polling/run_webhook llaman a estos hooks; aquí hay que hacerlo a mano
+        if application.post_init:
+            await application.post_init(application)
+        await application.start()
+        await server.start()
+        
+        if WEBHOOK_URL:
+            await application.bot.set_webhook(
+                url=WEBHOOK_URL.rstrip('/') + WEBHOOK_PATH,
+                secret_token=WEBHOOK_SECRET_TOKEN,
+                allowed_updates=Update.ALL_TYPES,
+                drop_pending_updates=DROP_PENDING_UPDATES,
+            )
+            logger.info(f"Webhook registrado en Telegram: {WEBHOOK_URL}")
+        
+        await stop_event.wait()
+        logger.info("🔴 Deteniendo webhook, procesando updates pendientes...")
+        await server.drain()
+    finally:
+        await server.stop()
+        if application.running:
+            await application.stop()
+            if application.post_stop:
+                await application.post_stop(application)
+        await application.shutdown()
+        if application.post_shutdown:
+            await application.post_shutdown(application)
+
+# ============================================================================
+# MODO SHARDED (MULTIPROCESO)
+# ============================================================================
+
+class ShardWorker:
+    """Un worker del modo sharded: ``bot.py`` en modo webhook en un puerto local
+
+    Los updates asignados esperan en ``pending`` hasta que el worker
+    confirma su recepción, así que sobreviven a reinicios del proceso.
+    """
+    
+    def __init__(self, index: int, port: int, secret: str):
+        self.index = index
+        self.port = port
+        self.secret = secret
+        self.url = f"http://127.0.0.1:{port}{WEBHOOK_PATH}"
+        self.pending: deque = deque()
+        self.wakeup = asyncio.Event()
+        self.process = None
+        self.forwarded = 0
+        self.restarts = 0
+        self.planned_restart = False
+    
+    def environment(self) -> dict:
+        """Entorno del worker: webhook local, analytics compartido y ficheros propios"""
+        feedback_root, feedback_ext = os.path.splitext(FEEDBACK_FILE)
+        log_root, log_ext = os.path.splitext(LOG_FILE)
+        persistence_root, persistence_ext = os.path.splitext(PERSISTENCE_FILE)
+        return dict(
+            os.environ,
+            SHARD_INDEX=str(self.index),
+            BOT_MODE='webhook',
+            WEBHOOK_URL='',
+            WEBHOOK_LISTEN='127.0.0.1',
+            WEBHOOK_PORT=str(self.port),
+            WEBHOOK_SECRET_TOKEN=self.secret,
+            METRICS_PORT='0',
+            ANALYTICS_BACKEND='sqlite',
+            ANALYTICS_SHARED='true',
+            # FeedbackStore, el log rotativo y SQLitePersistence (que guarda resúmenes
+            # de lo escrito y borra lo que no tiene en memoria) suponen un único escritor
+            FEEDBACK_FILE=f"{feedback_root}.worker{self.index}{feedback_ext}",
+            LOG_FILE=f"{log_root}.worker{self.index}{log_ext}",
+            PERSISTENCE_FILE=f"{persistence_root}.worker{self.index}{persistence_ext}",
+        )
+    
+    async def spawn(self):
+        # Sesión propia: un Ctrl+C en la terminal solo llega al proceso frontal
+        self.process = await asyncio.create_subprocess_exec(
+            sys.executable, os.path.abspath(__file__), env=self.environment(), start_new_session=True
+        )
+        logger.info(f"Worker {self.index} arrancado (pid {self.process.pid}, puerto {self.port})")
+    
+    async def wait_ready(self, session, timeout: float = 60):
+        import aiohttp
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            try:
+                async with session.get(f"http://127.0.0.1:{self.port}/health") as response:
+                    if response.status == 200:
+                        return True
+            except aiohttp.ClientError:
+                pass
+            await asyncio.sleep(0.2)
+        logger.error(f"Worker {self.index} no respondió en /health")
+        return False
+    
+    async def terminate(self, timeout: float = WEBHOOK_DRAIN_TIMEOUT):
+        """SIGTERM (el worker drena su cola) y, si no sale a tiempo, SIGKILL"""
+        if self.process is None or self.process.returncode is not None:
+            return
+        self.process.terminate()
+        try:
+            await asyncio.wait_for(self.process.wait(), timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f"Worker {self.index} no terminó a tiempo, forzando salida")
+            self.process.kill()
+            await self.process.wait()
+    
+    def metrics(self) -> dict:
+        return {
+            'pid': self.process.pid if self.process else None,
+            'port': self.port,
+            'pending': len(self.pending),
+            'forwarded': self.forwarded,
+            'restarts': self.restarts,
+        }
+
+
+class ShardedFront:
+    """Proceso frontal: recibe el webhook de Telegram y reparte por chat_id
+
+    Cada update va al worker ``chat_id % N``, así que todos los updates de un
+    chat los procesa el mismo worker y en orden. Los workers son procesos
+    ``bot.py`` en modo webhook que comparten el backend SQLite de analytics
+    (modo WAL); la persistencia de user_data/chat_data es un fichero por
+    worker, así que los datos de un usuario se guardan en el worker del chat
+    donde los fijó. El frontal publica la lista de comandos y responde a
+    Telegram en cuanto el update está en la cola del worker y la reenvía en
+    lotes; un update solo sale de la cola cuando el worker responde 200, de
+    modo que reiniciar un worker (SIGHUP reinicia todos uno a uno) no pierde
+    updates.
+    """
+    
+    def __init__(self, workers: int = SHARD_WORKERS, listen: str = WEBHOOK_LISTEN, port: int = WEBHOOK_PORT,
+                 path: str = WEBHOOK_PATH, secret_token: Optional[str] = WEBHOOK_SECRET_TOKEN):
+        internal_secret = secrets.token_hex(16)
+        self.workers = [ShardWorker(i, SHARD_BASE_PORT + i, internal_secret) for i in range(max(1, workers))]
+        self.listen = listen
+        self.port = port
+        self.path = path
+        self.secret_token = secret_token
+        self.received = 0
+        self.rejected = 0
+        self._stopping = False
+        self._session = None
+        self._runner = None
+        self._tasks: List[asyncio.Task] = []
+    
+    @staticmethod
+    def chat_key(data: dict) -> int:
+        """chat_id del update (o id del usuario si no hay chat) sin deserializarlo"""
+        for value in data.values():
+            if isinstance(value, dict):
+                chat = value.get('chat') or (value.get('message') or {}).get('chat') \
+                    or value.get('from') or value.get('user')
+                if chat and 'id' in chat:
+                    return chat['id']
+        return 0
+    
+    def shard_for(self, data: dict) -> ShardWorker:
+        return self.workers[self.chat_key(data) % len(self.workers)]
+    
+    # ------------------------------------------------------------------
+    # HTTP
+    # ------------------------------------------------------------------
+    
+    async def handle_update(self, request):
+        from aiohttp import web
+        if self.secret_token:
+            received = request.headers.get('X-Telegram-Bot-Api-Secret-Token', '')
+            if not hmac.compare_digest(received, self.secret_token):
+                return web.Response(status=403)
+        if self._stopping:
+            return web.Response(status=503)
+        try:
+            data = await request.json()
+        except Exception as e:
+            logger.warning(f"Update de webhook inválido: {e}")
+            return web.Response(status=400)
+        
+        worker = self.shard_for(data)
+        if len(worker.pending) >= SHARD_MAX_PENDING:
+            # Telegram reintenta la entrega más tarde
+            self.rejected += 1
+            return web.Response(status=503)
+        worker.pending.append(data)
+        worker.wakeup.set()
+        self.received += 1
+        return web.Response()
+    
+    async def handle_health(self, request):
+        from aiohttp import web
+        return web.json_response({
+            'status': 'draining' if self._stopping else 'ok',
+            'received': self.received,
+            'rejected': self.rejected,
+            'workers': [worker.metrics() for worker in self.workers],
+        })
+    
+    # ------------------------------------------------------------------
+    # Reenvío y supervisión
+    # ------------------------------------------------------------------
+    
+    async def _forward(self, worker: ShardWorker):
+        """Reenviar la cola del worker en lotes, en orden, hasta que la confirme"""
+        import aiohttp
+        headers = {'X-Telegram-Bot-Api-Secret-Token': worker.secret}
+        backoff = 0.1
+        while True:
+            if not worker.pending:
+                worker.wakeup.clear()
+                await worker.wakeup.wait()
+                continue
+            batch = list(itertools.islice(worker.pending, SHARD_BATCH_SIZE))
+            try:
+                async with self._session.post(worker.url, json=batch, headers=headers) as response:
+                    delivered = response.status == 200
+            except (aiohttp.ClientError, OSError):
+                delivered = False
+            if delivered:
+                for _ in batch:
+                    worker.pending.popleft()
+                worker.forwarded += len(batch)
+                backoff = 0.1
+            else:
+                # Worker reiniciándose o drenando (503): reintentar el mismo lote
+                await asyncio.sleep(backoff)
+                backoff = min(backoff * 2, 2.0)
+    
+    async def _supervise(self, worker: ShardWorker):
+        """Volver a arrancar el worker cada vez que su proceso termina"""
+        while True:
+            process = worker.process
+            code = await process.wait()
+            if self._stopping:
+                return
+            if worker.planned_restart:
+                worker.planned_restart = False
+            else:
+                logger.warning(f"Worker {worker.index} terminó inesperadamente (código {code})")
+            worker.restarts += 1
+            await worker.spawn()
+    
+    async def restart_workers(self):
+        """Reinicio escalonado: un worker cada vez, esperando a que el nuevo esté listo"""
+        logger.info("🔄 Reiniciando workers")
+        for worker in self.workers:
+            process = worker.process
+            worker.planned_restart = True
+            await worker.terminate()
+            while worker.process is process and not self._stopping:
+                await asyncio.sleep(0.05)
+            if self._stopping:
+                return
+            await worker.wait_ready(self._session)
+        logger.info("✅ Workers reiniciados")
+    
+    # ------------------------------------------------------------------
+    # Ciclo de vida
+    # ------------------------------------------------------------------
+    
+    async def start(self):
+        import aiohttp
+        from aiohttp import web
+        self._session = aiohttp.ClientSession()
+        for worker in self.workers:
+            await worker.spawn()
+        await asyncio.gather(*(worker.wait_ready(self._session) for worker in self.workers))
+        for worker in self.workers:
+            self._tasks.append(asyncio.create_task(self._forward(worker)))
+            self._tasks.append(asyncio.create_task(self._supervise(worker)))
+        
+        app = web.Application()
+        app.router.add_post(self.path, self.handle_update)
+        app.router.add_get('/health', self.handle_health)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, self.listen, self.port).start()
+        logger.info(f"🌐 Frontal escuchando en {self.listen}:{self.port}{self.path} "
+                    f"con {len(self.workers)} workers")
+    
+    async def stop(self, timeout: float = WEBHOOK_DRAIN_TIMEOUT):
+        """Dejar de aceptar updates, vaciar las colas en los workers y pararlos"""
+        self._stopping = True
+        deadline = time.monotonic() + timeout
+        while any(worker.pending for worker in self.workers) and time.monotonic() < deadline:
+            await asyncio.sleep(0.1)
+        lost = sum(len(worker.pending) for worker in self.workers)
+        if lost:
+            logger.warning(f"Drenado incompleto: {lost} updates sin entregar a los workers")
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*(worker.terminate() for worker in self.workers))
+        if self._runner is not None:
+            await self._runner.cleanup()
+        if self._session is not None:
+            await self._session.close()
+
+
+async def run_sharded():
+    """Ciclo de vida del modo sharded (SIGHUP reinicia los workers uno a uno)"""
+    import signal
+    
+    front = ShardedFront()
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop_event.set)
+    loop.add_signal_handler(signal.SIGHUP, lambda: asyncio.create_task(front.restart_workers()))
+    
+    try:
+        await front.start()
+        from telegram import Bot
+        bot_kwargs = {'base_url': TELEGRAM_API_BASE_URL} if TELEGRAM_API_BASE_URL else {}
+        async with Bot(TOKEN, **bot_kwargs) as bot:
+            if WEBHOOK_URL:
+                await bot.set_webhook(
+                    url=WEBHOOK_URL.rstrip('/') + WEBHOOK_PATH,
+                    secret_token=WEBHOOK_SECRET_TOKEN,
+                    allowed_updates=Update.ALL_TYPES,
+                    drop_pending_updates=DROP_PENDING_UPDATES,
+                )
+                logger.info(f"Webhook registrado en Telegram: {WEBHOOK_URL}")
+            # Los workers no publican los comandos: una sola llamada para todo el bot
+            await set_bot_commands(bot)
+        await stop_event.wait()
+        logger.info("🔴 Deteniendo frontal, entregando updates pendientes...")
+    finally:
+        await front.stop()
+
 # ============================================================================
 # FUNCIÓN PRINCIPAL
 # ============================================================================
 
+def build_application() -> Application:
+    """Crear la aplicación con todos los handlers registrados"""
+    # Configurar persistencia
+    persistence = setup_persistence()
+    
+    # Crear aplicación con configuración mejorada (la cola de updates aplica
+    # el backpressure del procesador también en polling)
+    processor = ChatOrderedUpdateProcessor()
+    builder = Application.builder() \
+        .token(TOKEN) \
+        .persistence(persistence) \
+        .context_types(ContextTypes(bot_data=BotData)) \
+        .post_init(post_init) \
+        .post_shutdown(post_shutdown) \
+        .concurrent_updates(processor) \
+        .update_queue(BackpressureUpdateQueue(processor)) \
+        .rate_limiter(TokenBucketRateLimiter(registry=metrics_registry)) \
+        .connection_pool_size(OUTBOUND_POOL_SIZE)
+    if TELEGRAM_API_BASE_URL:
+        builder = builder.base_url(TELEGRAM_API_BASE_URL)
+    application = builder.build()
+    
+    # Anti-spam antes de cualquier otro handler (un solo handler por grupo,
+    # por eso va en un grupo anterior al de los contadores de actividad)
+    throttle = AntiSpamThrottle()
+    application.add_handler(TypeHandler(Update, throttle.handle_update), group=-2)
+    
+    # Contadores de actividad antes de cualquier handler
+    application.add_handler(TypeHandler(Update, track_activity), group=-1)
+    
+    # Todos los handlers se registran cronometrados (histograma por nombre)
+    timed = metrics_registry.instrument
+    
+    # Añadir handlers de comandos
+    application.add_handler(CommandHandler("start", timed("start", start)))
+    application.add_handler(CommandHandler("help", timed("help", help_command)))
+    application.add_handler(CommandHandler("info", timed("info", info)))
+    application.add_handler(CommandHandler("stats", timed("stats", stats_command)))
+    application.add_handler(CommandHandler("time", timed("time", time_command)))
+    application.add_handler(CommandHandler("timezone", timed("timezone", timezone_command)))
+    application.add_handler(CommandHandler("echo", timed("echo", echo_command)))
+    application.add_handler(CommandHandler("calc", timed("calc", calc_command)))
+    application.add_handler(CommandHandler("weather", timed("weather", weather_command)))
+    application.add_handler(CommandHandler("feedback", timed("feedback", feedback_command)))
+    
+    # Callback queries (botones), enrutadas por patrón de callback_data
+    add_callback_handlers(application, timed)
+    
+    # Consultas inline (@bot ...)
+    application.add_handler(InlineQueryHandler(timed("inline_query", inline_query)))
+    
+    # Añadir handler de mensajes
+    application.add_handler(
+        MessageHandler(filters.TEXT & ~filters.COMMAND, timed("handle_message", handle_message))
+    )
+    
+    # Añadir handler de errores
+    application.add_error_handler(error_handler)
+    
+    return application
+
 def main():
     """Función principal del bot"""
+    configure_logging()
     
     # Verificar token
     if not TOKEN:
@@ -628,40 +5411,22 @@ def main():
     logger.info(f"📱 Token: {TOKEN[:10]}...")
     
     try:
-        # Configurar persistencia
-        persistence = setup_persistence()
-        
-        # Crear aplicación con configuración mejorada
-        application = Application.builder() \
-            .token(TOKEN) \
-            .persistence(persistence) \
-            .post_init(post_init) \
-            .concurrent_updates(True) \
-            .build()
-        
-        # Añadir handlers de comandos
-        application.add_handler(CommandHandler("start", start))
-        application.add_handler(CommandHandler("help", help_command))
-        application.add_handler(CommandHandler("info", info))
-        application.add_handler(CommandHandler("stats", stats_command))
-        application.add_handler(CommandHandler("time", time_command))
-        application.add_handler(CommandHandler("echo", echo_command))
-        application.add_handler(CommandHandler("feedback", feedback_command))
-        
-        # Añadir handler de callback queries (botones)
-        application.add_handler(CallbackQueryHandler(button_callback))
-        
-        # Añadir handler de mensajes
-        application.add_handler(
-            MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message)
-        )
+        if BOT_MODE == 'sharded':
+            # El frontal no ejecuta handlers: cada worker crea su propia aplicación.
+            # Los workers comparten SQLite; el frontal importa antes el histórico JSON
+            logger.info(f"📡 Modo de recepción: sharded ({SHARD_WORKERS} workers)")
+            if not migrate_analytics('sqlite'):
+                return
+            asyncio.run(run_sharded())
+            return
         
-        # Añadir handler de errores
-        application.add_error_handler(error_handler)
+        if not SHARD_INDEX and not migrate_analytics():
+            return
+        application = build_application()
         
         # Información de inicio
         logger.info("✅ Bot configurado correctamente")
-        logger.info("📡 Iniciando polling...")
+        logger.info(f"📡 Modo de recepción: {BOT_MODE}")
         logger.info("🚀 Bot listo para recibir mensajes")
         logger.info("🛑 Presiona Ctrl+C para detener")
         
@@ -672,12 +5437,15 @@ def main():
         print(f"Hora: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
         print("=" * 60 + "\n")
         
-        # Iniciar polling con configuración mejorada
-        application.run_polling(
-            allowed_updates=Update.ALL_TYPES,
-            drop_pending_updates=True,
-            close_loop=False
-        )
+        if BOT_MODE == 'webhook':
+            asyncio.run(run_webhook(application))
+        else:
+            # Iniciar polling con configuración mejorada
+            application.run_polling(
+                allowed_updates=Update.ALL_TYPES,
+                drop_pending_updates=DROP_PENDING_UPDATES,
+                close_loop=False
+            )
         
     except Exception as e:
         logger.critical(f"Error crítico al iniciar el bot: {e}")
@@ -687,7 +5455,7 @@ def main():
         try:
             analytics = application.bot_data.get('analytics') if 'application' in locals() else None
             if analytics:
-                analytics.save_stats()
+                analytics.close()
         except:
             pass
 
@@ -704,6 +5472,8 @@ if __name__ == '__main__':
         logger.info("🔴 Señal de interrupción recibida")
         logger.info("💾 Guardando datos...")
         print("\n🔄 Cerrando bot de manera segura...")
+        if analytics_middleware:
+            analytics_middleware.close()
         sys.exit(0)
     
     signal.signal(signal.SIGINT, signal_handler)